@@ -0,0 +1,294 @@
+import asyncio
+import functools
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import catalog_cache
+import database
+from config import DB_POOL_SIZE, DB_WRITE_BATCH_SIZE, DB_WRITE_BATCH_WINDOW_MS, DB_ANALYTICS_POOL_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Пул потоков базы данных: у каждого потока своё долгоживущее подключение,
+# поэтому синхронный sqlite3 не блокирует цикл событий aiogram
+_executor = ThreadPoolExecutor(
+    max_workers=DB_POOL_SIZE,
+    thread_name_prefix="db",
+    initializer=database.get_connection,
+)
+
+# Отдельный пул для отчётов админки: тяжёлые запросы идут через подключения
+# только для чтения и не занимают потоки, которые обслуживают покупателей
+_analytics_executor = ThreadPoolExecutor(
+    max_workers=DB_ANALYTICS_POOL_SIZE,
+    thread_name_prefix="db-analytics",
+    initializer=database.get_analytics_connection,
+)
+
+
+async def run(func, *args, **kwargs):
+    """Выполняет синхронную функцию работы с БД в пуле потоков"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def _awaitable(func):
+    """Делает асинхронную версию функции из database.py"""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+
+    return wrapper
+
+
+class AnalyticsTimeout(sqlite3.OperationalError):
+    """Отчёт прерван по таймауту DB_ANALYTICS_TIMEOUT_MS"""
+
+
+def _analytics(func):
+    """Делает асинхронную версию отчёта, которая выполняется в пуле аналитики"""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(_analytics_executor, functools.partial(func, *args, **kwargs))
+        except sqlite3.OperationalError as e:
+            if "interrupted" in str(e):
+                logger.warning(f"Отчёт {func.__name__} прерван по таймауту")
+                raise AnalyticsTimeout(str(e)) from e
+            raise
+
+    return wrapper
+
+
+class WriteQueue:
+    """Единственный писатель для частых мелких записей.
+
+    Обработчики ставят операции в очередь и ждут результат, а писатель
+    собирает их в пакеты (до batch_size операций или window секунд)
+    и фиксирует каждый пакет одной транзакцией.
+    """
+
+    def __init__(self, batch_size: int, window: float):
+        self.batch_size = batch_size
+        self.window = window
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # Отдельный поток: записи пакетов не ждут освобождения пула читателей
+        self._executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="db-writer",
+            initializer=database.get_connection,
+        )
+        self.stats = {"operations": 0, "batches": 0, "errors": 0, "max_batch": 0}
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, func, *args):
+        """Ставит операцию func(cur, *args) в очередь и ждёт её фиксации"""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((func, args, future))
+        return await future
+
+    async def _collect_batch(self, first) -> tuple:
+        """Добирает операции к первой, пока не наполнится пакет или не выйдет окно"""
+        loop = asyncio.get_running_loop()
+        batch = [first]
+        deadline = loop.time() + self.window
+        while len(batch) < self.batch_size:
+            if self._queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = self._queue.get_nowait()
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is None:
+                break
+            batch, stopping = await self._collect_batch(first)
+
+            operations = [(func, args) for func, args, _ in batch]
+            try:
+                results = await loop.run_in_executor(self._executor, database.run_write_batch, operations)
+            except Exception as e:
+                results = [(None, e)] * len(batch)
+
+            self.stats["operations"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+            for (_, _, future), (result, error) in zip(batch, results):
+                if future.done():
+                    continue
+                if error is not None:
+                    self.stats["errors"] += 1
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    async def stop(self):
+        """Дописывает оставшиеся операции и останавливает писателя"""
+        if self._task is not None and not self._task.done():
+            await self._queue.put(None)
+            await self._task
+        self._executor.shutdown(wait=True)
+
+
+write_queue = WriteQueue(DB_WRITE_BATCH_SIZE, DB_WRITE_BATCH_WINDOW_MS / 1000)
+
+
+def _queued(func):
+    """Делает асинхронную версию записи, которая идёт через write_queue"""
+
+    @functools.wraps(func)
+    async def wrapper(*args):
+        return await write_queue.submit(func, *args)
+
+    return wrapper
+
+
+def get_write_queue_stats() -> dict:
+    """Статистика очереди записи: операций, пакетов и средний размер пакета"""
+    stats = dict(write_queue.stats)
+    stats["avg_batch"] = stats["operations"] / stats["batches"] if stats["batches"] else 0.0
+    stats["queued"] = write_queue._queue.qsize() if write_queue._queue else 0
+    return stats
+
+
+async def shutdown():
+    """Дописывает очередь записи и останавливает пул потоков базы данных"""
+    await write_queue.stop()
+    _executor.shutdown(wait=True)
+    _analytics_executor.shutdown(wait=True)
+    database.close_connections()
+
+
+# Бонусы и программа лояльности
+spend_bonus_points = _awaitable(database.spend_bonus_points)
+get_bonus_info = _awaitable(database.get_bonus_info)
+init_user_loyalty = _queued(database.init_user_loyalty_tx)
+add_loyalty_points = _awaitable(database.add_loyalty_points)
+spend_loyalty_points = _awaitable(database.spend_loyalty_points)
+get_loyalty_info = _awaitable(database.get_loyalty_info)
+get_loyalty_history = _awaitable(database.get_loyalty_history)
+add_bonus_points = _awaitable(database.add_bonus_points)
+get_bonus_summary = _analytics(database.get_bonus_summary)
+add_test_bonus_points = _awaitable(database.add_test_bonus_points)
+reset_user_bonus = _awaitable(database.reset_user_bonus)
+
+# Пользователи
+upsert_user = _queued(database.upsert_user_tx)
+
+# Каталог
+cleanup_old_daily_products = _awaitable(database.cleanup_old_daily_products)
+add_product = _awaitable(database.add_product)
+get_daily_products = _awaitable(database.get_daily_products)
+get_product = _awaitable(database.get_product)
+search_products = _awaitable(database.search_products)
+set_product_price = _awaitable(database.set_product_price)
+set_product_photo_file_id = _awaitable(database.set_product_photo_file_id)
+get_pending_price_products = _awaitable(database.get_pending_price_products)
+check_product_availability = _awaitable(database.check_product_availability)
+delete_product = _awaitable(database.delete_product)
+
+
+async def get_catalog(category: str):
+    """Каталог дня из кэша; в базу идём только при промахе"""
+    products = catalog_cache.get(category)
+    if products is None:
+        loaded_generation = catalog_cache.generation()
+        products = await run(database.get_daily_products, category)
+        catalog_cache.put(category, products, loaded_generation)
+    return products
+
+
+# Корзина
+async def add_to_cart(user_id: int, product_id: int):
+    try:
+        return await write_queue.submit(database.add_to_cart_tx, user_id, product_id)
+    except Exception as e:
+        logger.error(f"Ошибка добавления в корзину: {e}")
+        return False
+
+
+get_cart = _awaitable(database.get_cart)
+clear_cart = _awaitable(database.clear_cart)
+decrease_cart_item = _queued(database.decrease_cart_item_tx)
+
+# Заказы
+is_first_order = _awaitable(database.is_first_order)
+create_order = _awaitable(database.create_order)
+get_delivered_orders = _awaitable(database.get_delivered_orders)
+update_order_status = _awaitable(database.update_order_status)
+get_user_orders = _awaitable(database.get_user_orders)
+get_user_order = _awaitable(database.get_user_order)
+get_order_items = _awaitable(database.get_order_items)
+get_order_total = _awaitable(database.get_order_total)
+get_order_user_id = _awaitable(database.get_order_user_id)
+get_orders_page = _analytics(database.get_orders_page)
+get_order_with_user = _awaitable(database.get_order_with_user)
+get_shop_stats = _analytics(database.get_shop_stats)
+rebuild_shop_stats = _awaitable(database.rebuild_shop_stats)
+get_best_sellers = _analytics(database.get_best_sellers)
+get_revenue_by_product = _analytics(database.get_revenue_by_product)
+
+# Отзывы
+add_review = _awaitable(database.add_review)
+get_reviews = _awaitable(database.get_reviews)
+get_reviews_summary = _analytics(database.get_reviews_summary)
+get_reviews_debug_info = _analytics(database.get_reviews_debug_info)
+
+# Сертификаты
+add_certificate_purchase = _awaitable(database.add_certificate_purchase)
+check_certificate_validity = _awaitable(database.check_certificate_validity)
+mark_certificate_used = _awaitable(database.mark_certificate_used)
+add_certificate_attempt = _queued(database.add_certificate_attempt_tx)
+get_certificate_attempts = _awaitable(database.get_certificate_attempts)
+reset_certificate_attempts = _awaitable(database.reset_certificate_attempts)
+
+# Платежи
+save_payment = _awaitable(database.save_payment)
+reserve_payment = _awaitable(database.reserve_payment)
+attach_payment = _awaitable(database.attach_payment)
+update_payment_status = _awaitable(database.update_payment_status)
+get_payment = _awaitable(database.get_payment)
+fulfill_payment = _awaitable(database.fulfill_payment)
+fail_payment = _awaitable(database.fail_payment)
+get_payments_to_check = _awaitable(database.get_payments_to_check)
+schedule_payment_check = _awaitable(database.schedule_payment_check)
+get_reconcile_backlog = _awaitable(database.get_reconcile_backlog)
+
+# Outbox уведомлений
+get_due_outbox = _awaitable(database.get_due_outbox)
+finish_outbox_batch = _awaitable(database.finish_outbox_batch)
+cleanup_outbox = _awaitable(database.cleanup_outbox)
+get_outbox_stats = _awaitable(database.get_outbox_stats)
+
+# Очередь фискальных чеков
+get_due_receipt_jobs = _awaitable(database.get_due_receipt_jobs)
+finish_receipt_jobs = _awaitable(database.finish_receipt_jobs)
+get_receipt_job_stats = _awaitable(database.get_receipt_job_stats)
+
+# Служебное
+init_db = _awaitable(database.init_db)
+init_test_data = _awaitable(database.init_test_data)
@@ -0,0 +1,79 @@
+"""Нагрузочный тест оформления заказа.
+
+Запуск: python benchmark_checkout.py [--orders 20] [--users 1 10 100]
+
+Работает на временной базе данных и показывает, сколько заказов в секунду
+проходит через async_db.create_order при заданном числе одновременных покупателей.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import database
+
+
+def prepare_database(path: str):
+    """Создаёт схему и несколько товаров во временной базе"""
+    database.DB_PATH = path
+    database.init_db()
+    conn = database.get_connection()
+    conn.executemany(
+        "INSERT INTO products (name, price, category) VALUES (?, ?, 'bouquet')",
+        [(f"Букет {i}", 1000 + i * 100) for i in range(10)]
+    )
+    conn.commit()
+
+
+async def customer(adb, user_id: int, orders: int, results: dict):
+    """Один покупатель: кладёт товары в корзину и оформляет заказ"""
+    for n in range(orders):
+        await adb.add_to_cart(user_id, 1 + n % 10)
+        await adb.add_to_cart(user_id, 1 + (n + 3) % 10)
+        order_id = await adb.create_order(
+            user_id, "Тест Покупатель", "+79990000000", "Москва",
+            "01.01", "10:00", "cash", delivery_cost=300
+        )
+        results["ok" if order_id > 0 else "failed"] += 1
+
+
+async def run_level(adb, users: int, orders: int, first_user_id: int) -> dict:
+    results = {"ok": 0, "failed": 0}
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        customer(adb, first_user_id + i, orders, results) for i in range(users)
+    ))
+    elapsed = time.perf_counter() - started
+    results["seconds"] = elapsed
+    results["per_second"] = results["ok"] / elapsed if elapsed else 0
+    return results
+
+
+async def main(levels, orders: int):
+    import async_db as adb
+
+    print(f"Пул базы данных: {adb.DB_POOL_SIZE} потоков")
+    print(f"{'Покупателей':>12} {'Заказов':>8} {'Ошибок':>7} {'Секунд':>8} {'Заказов/с':>10}")
+    first_user_id = 1
+    for users in levels:
+        results = await run_level(adb, users, orders, first_user_id)
+        first_user_id += users
+        print(f"{users:>12} {results['ok']:>8} {results['failed']:>7} "
+              f"{results['seconds']:>8.2f} {results['per_second']:>10.1f}")
+    print(f"Кэш выражений: {database.get_statement_cache_stats()}")
+    print(f"Очередь записи: {adb.get_write_queue_stats()}")
+    await adb.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест оформления заказа")
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 10, 100],
+                        help="Число одновременных покупателей (несколько значений)")
+    parser.add_argument("--orders", type=int, default=20,
+                        help="Заказов на одного покупателя")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        prepare_database(os.path.join(tmp, "bench.db"))
+        asyncio.run(main(args.users, args.orders))
@@ -4,6 +4,12 @@ from aiogram import Bot, Dispatcher
 from user_handlers import router as user_router, auto_cleanup_daily_products, check_pending_payments
 from config import BOT_TOKEN
 from database import init_db
+import async_db
+import outbound
+import notifications
+import outbox
+import receipts
+from payment_gateway import gateway
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -14,7 +20,7 @@ async def main():
     init_db()
     logger.info("База данных инициализирована")
 
-    bot = Bot(token=BOT_TOKEN)
+    bot = outbound.install(Bot(token=BOT_TOKEN))
     dp = Dispatcher()
 
     # Регистрируем роутеры
@@ -23,10 +29,20 @@ async def main():
     # Запускаем фоновые задачи
     asyncio.create_task(auto_cleanup_daily_products())
     asyncio.create_task(check_pending_payments())
+    outbox.dispatcher.start(bot)
+    receipts.worker.start()
 
     # Запускаем бота
     logger.info("Starting bot...")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await outbox.dispatcher.stop()
+        await receipts.worker.stop()
+        await notifications.drain()
+        await outbound.scheduler.close()
+        gateway.shutdown()
+        await async_db.shutdown()
 
 
 if __name__ == "__main__":
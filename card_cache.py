@@ -0,0 +1,126 @@
+import threading
+from collections import OrderedDict
+from typing import Tuple
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from keyboards import format_price, carousel_nav_row
+
+# Готовые карточки товаров: (product_id, version, вид) -> (подпись, клавиатура).
+# products.version увеличивается триггером при изменении товара, поэтому
+# изменённый товар получает новый ключ, а старая карточка вытесняется LRU.
+# Кнопки хранятся кортежами (текст, callback_data, url), а кнопки и
+# InlineKeyboardMarkup создаются заново на каждую отправку: объекты aiogram
+# изменяемы, и правка клавиатуры у вызывающего не должна портить кэш.
+CARD_CACHE_SIZE = 1024
+
+_lock = threading.Lock()
+_cards: "OrderedDict[tuple, Tuple[str, tuple]]" = OrderedDict()
+_stats = {"hits": 0, "misses": 0}
+
+
+def _price_line(product: dict) -> str:
+    return f"💰 <b>Цена: {format_price(product)}</b>"
+
+
+def _bouquet_card(product: dict):
+    text = f"<b>{product['name']}</b>\n{product['description']}\n" + _price_line(product)
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📖 Подробнее", callback_data=f"details_{product['id']}")],
+        [InlineKeyboardButton(text="🛒 В корзину", callback_data=f"add_{product['id']}")]
+    ])
+    return text, kb
+
+
+def _plant_card(product: dict):
+    text = f"<b>{product['name']}</b>\n{product['description']}\n" + _price_line(product)
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📖 Подробнее", callback_data=f"details_{product['id']}")],
+        [InlineKeyboardButton(text="💬 Уточнить цену", url="https://t.me/Therry_Voyager")],
+        [InlineKeyboardButton(text="🛒 В корзину", callback_data=f"add_{product['id']}")]
+    ])
+    return text, kb
+
+
+def _details_card(product: dict):
+    text = (
+        f"<b>{product['name']}</b>\n\n"
+        f"📄 <i>{product['full_description']}</i>\n\n"
+        f"💰 <b>Цена: {product['price']} ₽</b>"
+    )
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🛒 Добавить в корзину", callback_data=f"add_{product['id']}")],
+        [InlineKeyboardButton(text="💬 Спросить у менеджера", url="https://t.me/Therry_Voyager")]
+    ])
+    return text, kb
+
+
+def _pending_card(product: dict):
+    text = (
+        f"🟡 <b>Товар без цены:</b>\n"
+        f"📦 <b>{product['name']}</b>\n"
+        f"📝 {product['description']}\n"
+        f"🆔 <code>{product['id']}</code>"
+    )
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✏️ Установить цену", callback_data=f"set_price_{product['id']}")],
+        [InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_product_{product['id']}")]
+    ])
+    return text, kb
+
+
+_RENDERERS = {
+    "bouquet": _bouquet_card,
+    "plant": _plant_card,
+    "details": _details_card,
+    "pending": _pending_card,
+}
+
+
+def _cached(key, render) -> Tuple[str, InlineKeyboardMarkup]:
+    with _lock:
+        card = _cards.get(key)
+        if card is not None:
+            _cards.move_to_end(key)
+            _stats["hits"] += 1
+        else:
+            _stats["misses"] += 1
+
+    if card is None:
+        text, kb = render()
+        card = (text, tuple(tuple((button.text, button.callback_data, button.url) for button in row)
+                            for row in kb.inline_keyboard))
+        with _lock:
+            _cards[key] = card
+            if len(_cards) > CARD_CACHE_SIZE:
+                _cards.popitem(last=False)
+
+    text, rows = card
+    return text, InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=label, callback_data=callback_data, url=url) for label, callback_data, url in row]
+        for row in rows
+    ])
+
+
+def get_card(product: dict, kind: str) -> Tuple[str, InlineKeyboardMarkup]:
+    """Подпись и клавиатура карточки товара вида kind (из кэша или свежий рендер)"""
+    key = (product['id'], product.get('version', 0), kind)
+    return _cached(key, lambda: _RENDERERS[kind](product))
+
+
+def get_carousel_card(product: dict, category: str, index: int, total: int) -> Tuple[str, InlineKeyboardMarkup]:
+    """Карточка товара для карусели каталога: обычная карточка категории и кнопки листания"""
+    def render():
+        text, kb = _RENDERERS[category](product)
+        rows = list(kb.inline_keyboard)
+        if total > 1:
+            rows.append(carousel_nav_row(category, index, total))
+        return text, InlineKeyboardMarkup(inline_keyboard=rows)
+
+    key = (product['id'], product.get('version', 0), f"carousel_{category}_{index}_{total}")
+    return _cached(key, render)
+
+
+def get_stats() -> dict:
+    with _lock:
+        return dict(_stats, size=len(_cards))
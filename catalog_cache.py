@@ -0,0 +1,54 @@
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+# Кэш каталога дня (букеты и растения) в памяти процесса.
+# Записи привязаны к дате, как в SQL-запросе DATE('now') (UTC), поэтому
+# в полночь кэш сам становится неактуальным. Любое изменение товаров
+# в database.py вызывает invalidate().
+_lock = threading.Lock()
+_entries: Dict[str, tuple] = {}  # category -> (дата, поколение, товары)
+_generation = 0
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def generation() -> int:
+    """Текущее поколение кэша (меняется при каждой инвалидации)"""
+    with _lock:
+        return _generation
+
+
+def get(category: str) -> Optional[List[Dict]]:
+    """Товары категории на сегодня или None, если в кэше их нет"""
+    with _lock:
+        entry = _entries.get(category)
+        if entry and entry[0] == _today() and entry[1] == _generation:
+            _stats["hits"] += 1
+            return entry[2]
+        _stats["misses"] += 1
+        return None
+
+
+def put(category: str, products: List[Dict], loaded_generation: int):
+    """Сохраняет товары, если за время загрузки каталог не менялся"""
+    with _lock:
+        if loaded_generation == _generation:
+            _entries[category] = (_today(), loaded_generation, products)
+
+
+def invalidate():
+    """Сбрасывает кэш после изменения товаров"""
+    global _generation
+    with _lock:
+        _generation += 1
+        _entries.clear()
+        _stats["invalidations"] += 1
+
+
+def get_stats() -> dict:
+    with _lock:
+        return dict(_stats)
@@ -19,9 +19,20 @@ ADMINS = [ADMIN_ID, ADMIN_ID1, ADMIN_ID2]
 # ЮKassa
 YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID", "1037498")
 YOOKASSA_SECRET_KEY = os.getenv("YOOKASSA_SECRET_KEY", "live_jxIub1SHUSUh5F2hw_CjY2kK4a2Rc57yqHx5uSySQ34")
+YOOKASSA_API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3")  # Для тестов - адрес fake_yookassa.py
 
 YOOKASSA_TAX_RATE = os.getenv("YOOKASSA_TAX_RATE", "1")
 YOOKASSA_TAX_SYSTEM = os.getenv("YOOKASSA_TAX_SYSTEM", "1")
+YOOKASSA_RECEIPT_MODE = os.getenv("YOOKASSA_RECEIPT_MODE", "inline")  # inline - чек вместе с платежом, deferred - фоновой очередью
+YOOKASSA_POOL_SIZE = int(os.getenv("YOOKASSA_POOL_SIZE", "4"))  # Одновременных запросов к ЮKassa
+YOOKASSA_TIMEOUT = float(os.getenv("YOOKASSA_TIMEOUT", "15"))  # Максимальное время одного запроса, секунд
+YOOKASSA_TIMEOUT_MIN = float(os.getenv("YOOKASSA_TIMEOUT_MIN", "3"))  # Нижняя граница адаптивного таймаута, секунд
+YOOKASSA_TIMEOUT_FACTOR = float(os.getenv("YOOKASSA_TIMEOUT_FACTOR", "3"))  # Адаптивный таймаут = p99 задержки × множитель
+YOOKASSA_BREAKER_FAILURES = int(os.getenv("YOOKASSA_BREAKER_FAILURES", "5"))  # Ошибок подряд до отключения ЮKassa
+YOOKASSA_BREAKER_COOLDOWN = float(os.getenv("YOOKASSA_BREAKER_COOLDOWN", "30"))  # Секунд до пробного запроса после отключения
+YOOKASSA_NOTIFY_PATH = os.getenv("YOOKASSA_NOTIFY_PATH", "/yookassa/notify")  # Адрес HTTP-уведомлений ЮKassa
+# Доверять X-Forwarded-For (бот за ngrok/nginx) при проверке IP уведомлений
+YOOKASSA_TRUST_FORWARDED = os.getenv("YOOKASSA_TRUST_FORWARDED", "False").lower() == "true"
 
 # Webhook настройки
 WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "")  # Будет установлен автоматически через ngrok
@@ -33,6 +44,43 @@ WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8000"))
 
 # Остальные настройки...
 DB_PATH = os.getenv("DB_PATH", "data/florist.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))  # Потоков (и подключений) в пуле базы данных
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))  # Кэш страниц SQLite на подключение
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(128 * 1024 * 1024)))  # Размер memory-mapped I/O в байтах
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "30000"))  # Ожидание блокировки записи
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))  # Подготовленных выражений на подключение
+DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "64"))  # Мелких записей в одной транзакции
+DB_WRITE_BATCH_WINDOW_MS = int(os.getenv("DB_WRITE_BATCH_WINDOW_MS", "2"))  # Сколько ждать попутные записи
+DB_ANALYTICS_POOL_SIZE = int(os.getenv("DB_ANALYTICS_POOL_SIZE", "1"))  # Потоков для отчётов админки
+DB_ANALYTICS_CACHE_SIZE_KB = int(os.getenv("DB_ANALYTICS_CACHE_SIZE_KB", "8192"))  # Кэш страниц для отчётов
+DB_ANALYTICS_TIMEOUT_MS = int(os.getenv("DB_ANALYTICS_TIMEOUT_MS", "5000"))  # Максимальное время отчёта
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))  # Сообщений в секунду на всего бота
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))  # Сообщений в секунду в один чат
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))  # Сколько сообщений подряд можно отправить в чат
+SEND_GROUP_RATE_PER_MIN = float(os.getenv("SEND_GROUP_RATE_PER_MIN", "20"))  # Сообщений в минуту в группу
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))  # Повторов после ответа 429
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "4"))  # Попыток доставить уведомление админу
+NOTIFY_RETRY_DELAY = float(os.getenv("NOTIFY_RETRY_DELAY", "2"))  # Первая пауза перед повтором, дальше вдвое больше
+NOTIFY_DEAD_LETTER_PATH = os.getenv("NOTIFY_DEAD_LETTER_PATH", "data/dead_letters.jsonl")  # Неотправленные уведомления
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))  # Уведомлений outbox за один проход
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))  # Как часто проверять outbox, секунд
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))  # Попыток до пометки уведомления 'dead'
+OUTBOX_RETRY_DELAY = float(os.getenv("OUTBOX_RETRY_DELAY", "5"))  # Первая пауза перед повтором, дальше вдвое больше
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", "30"))  # Пауза между проходами сверки платежей, секунд
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "20"))  # Платежей за один проход
+RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", "4"))  # Одновременных запросов сверки к ЮKassa
+RECONCILE_RATE = float(os.getenv("RECONCILE_RATE", "5"))  # Запросов сверки в секунду
+RECONCILE_BASE_DELAY = float(os.getenv("RECONCILE_BASE_DELAY", "30"))  # Первая пауза до повторной проверки платежа
+RECONCILE_MAX_DELAY = float(os.getenv("RECONCILE_MAX_DELAY", "3600"))  # Максимальная пауза между проверками
+RECONCILE_MAX_ATTEMPTS = int(os.getenv("RECONCILE_MAX_ATTEMPTS", "48"))  # Проверок, после которых платёж помечается expired
+PAYMENT_STATUS_TTL = float(os.getenv("PAYMENT_STATUS_TTL", "5"))  # Сколько секунд кэшировать статус платежа из ЮKassa
+RECEIPT_BATCH_SIZE = int(os.getenv("RECEIPT_BATCH_SIZE", "20"))  # Чеков за один проход очереди
+RECEIPT_POLL_INTERVAL = float(os.getenv("RECEIPT_POLL_INTERVAL", "5"))  # Как часто проверять очередь чеков, секунд
+RECEIPT_RATE = float(os.getenv("RECEIPT_RATE", "2"))  # Запросов Receipt.create в секунду
+RECEIPT_MAX_ATTEMPTS = int(os.getenv("RECEIPT_MAX_ATTEMPTS", "10"))  # Попыток до пометки задания 'dead'
+RECEIPT_RETRY_DELAY = float(os.getenv("RECEIPT_RETRY_DELAY", "30"))  # Первая пауза перед повтором, дальше вдвое больше
+RECEIPT_MAX_DELAY = float(os.getenv("RECEIPT_MAX_DELAY", "3600"))  # Максимальная пауза между повторами
+CATALOG_MODE = os.getenv("CATALOG_MODE", "list")  # list - карточка на товар, carousel - одно сообщение с листанием
 DEBUG = os.getenv("DEBUG", "False").lower() == "true"
 
 # Создаем необходимые директории
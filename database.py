@@ -2,184 +2,195 @@ import math
 import sqlite3
 import os
 import json
+import logging
+import re
+import threading
+from collections import OrderedDict
 from typing import List, Dict, Optional
 from datetime import datetime, timedelta
-from user_handlers import *
+
+import catalog_cache
+import migrations
+import time
+from config import (DB_CACHE_SIZE_KB, DB_MMAP_SIZE, DB_BUSY_TIMEOUT_MS, DB_STATEMENT_CACHE_SIZE,
+                    DB_ANALYTICS_CACHE_SIZE_KB, DB_ANALYTICS_TIMEOUT_MS, ADMINS, YOOKASSA_RECEIPT_MODE)
+
+logger = logging.getLogger(__name__)
 
 DB_PATH = "data/florist.db"
 
+# Долгоживущие подключения: по одному на поток (см. get_connection)
+_local = threading.local()
+# Подключения только для чтения для отчётов админки (см. get_analytics_connection)
+_analytics_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+
+# Счётчики кэша подготовленных выражений по всем подключениям
+_statement_stats = {"hits": 0, "misses": 0}
+_statement_stats_lock = threading.Lock()
+
+
+class _CountingCursor(sqlite3.Cursor):
+    """Курсор, который учитывает попадания в кэш выражений подключения"""
+
+    def execute(self, sql, parameters=()):
+        self.connection.track_statement(sql)
+        return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.connection.track_statement(sql)
+        return super().executemany(sql, seq_of_parameters)
+
+
+class _PooledConnection(sqlite3.Connection):
+    """Подключение с зеркалом LRU-кэша выражений sqlite3 для счётчиков hit/miss"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._statements = OrderedDict()
+
+    def track_statement(self, sql: str):
+        if sql in self._statements:
+            self._statements.move_to_end(sql)
+            key = "hits"
+        else:
+            self._statements[sql] = True
+            if len(self._statements) > DB_STATEMENT_CACHE_SIZE:
+                self._statements.popitem(last=False)
+            key = "misses"
+        with _statement_stats_lock:
+            _statement_stats[key] += 1
+
+    def cursor(self, factory=_CountingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _open_connection() -> sqlite3.Connection:
+    """Открывает подключение и один раз применяет настройки производительности"""
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        factory=_PooledConnection,
+        cached_statements=DB_STATEMENT_CACHE_SIZE,
+        check_same_thread=False,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")  # Включаем WAL mode для лучшей параллельности
+    conn.execute("PRAGMA synchronous=NORMAL")  # В режиме WAL этого достаточно для надёжности
+    conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
+    conn.execute(f"PRAGMA cache_size=-{int(DB_CACHE_SIZE_KB)}")  # Отрицательное значение - в КБ
+    conn.execute(f"PRAGMA mmap_size={int(DB_MMAP_SIZE)}")
+    return conn
+
+
+def get_connection() -> sqlite3.Connection:
+    """Возвращает долгоживущее подключение текущего потока (открывает при первом обращении)"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _open_connection()
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+def _connect() -> sqlite3.Connection:
+    """Подключение потока со сброшенной row_factory для очередного запроса"""
+    conn = get_connection()
+    conn.row_factory = None
+    return conn
+
+
+def _analytics_deadline_passed() -> int:
+    """progress handler: ненулевой ответ прерывает слишком долгий отчёт"""
+    deadline = getattr(_analytics_local, "deadline", None)
+    return 1 if deadline is not None and time.monotonic() > deadline else 0
+
+
+def get_analytics_connection() -> sqlite3.Connection:
+    """Долгоживущее подключение потока только для чтения (mode=ro) со своим кэшем страниц.
+
+    Отчёты в режиме WAL читают свой снимок и не мешают записи заказов,
+    а запрос дольше DB_ANALYTICS_TIMEOUT_MS прерывается.
+    """
+    conn = getattr(_analytics_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(
+            f"file:{os.path.abspath(DB_PATH)}?mode=ro",
+            uri=True,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            factory=_PooledConnection,
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA query_only=ON")
+        conn.execute(f"PRAGMA cache_size=-{int(DB_ANALYTICS_CACHE_SIZE_KB)}")
+        conn.execute(f"PRAGMA mmap_size={int(DB_MMAP_SIZE)}")
+        conn.set_progress_handler(_analytics_deadline_passed, 10000)
+        _analytics_local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+def _analytics_connect() -> sqlite3.Connection:
+    """Подключение для отчёта с заново взведённым таймаутом выполнения"""
+    conn = get_analytics_connection()
+    conn.row_factory = None
+    _analytics_local.deadline = time.monotonic() + DB_ANALYTICS_TIMEOUT_MS / 1000
+    return conn
+
+
+def close_connections():
+    """Закрывает все долгоживущие подключения (при остановке бота)"""
+    with _connections_lock:
+        connections = list(_connections)
+        _connections.clear()
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            print(f"Ошибка при закрытии подключения к БД: {e}")
+    _local.__dict__.clear()
+    _analytics_local.__dict__.clear()
+
+
+def get_statement_cache_stats() -> dict:
+    """Статистика кэша подготовленных выражений"""
+    with _statement_stats_lock:
+        hits = _statement_stats["hits"]
+        misses = _statement_stats["misses"]
+    total = hits + misses
+    with _connections_lock:
+        connections = len(_connections)
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / total if total else 0.0,
+        "connections": connections,
+        "cache_size": DB_STATEMENT_CACHE_SIZE,
+    }
+
 
 def init_db():
     print("🔧 Инициализация базы данных...")
     os.makedirs("data", exist_ok=True)
     os.makedirs("images", exist_ok=True)
 
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-
-        # Создание таблиц
-        tables = [
-            # products table
-            """
-            CREATE TABLE IF NOT EXISTS products (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                description TEXT,
-                full_description TEXT,
-                price REAL NOT NULL,
-                photo TEXT,
-                category TEXT NOT NULL,
-                created_date DATE DEFAULT CURRENT_DATE,
-                created_by INTEGER,
-                is_daily BOOLEAN DEFAULT TRUE,
-                on_request BOOLEAN DEFAULT FALSE,
-                in_stock BOOLEAN DEFAULT TRUE
-            )
-            """,
-            # cart table
-            """
-            CREATE TABLE IF NOT EXISTS cart (
-                user_id INTEGER NOT NULL,
-                product_id INTEGER NOT NULL,
-                quantity INTEGER DEFAULT 1,
-                PRIMARY KEY(user_id, product_id)
-            )
-            """,
-            # orders table (обновленная с полями для скидок)
-            """
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                items TEXT NOT NULL,
-                total REAL NOT NULL,
-                customer_name TEXT NOT NULL,
-                phone TEXT NOT NULL,
-                address TEXT,
-                delivery_date TEXT,
-                delivery_time TEXT,
-                payment_method TEXT,
-                delivery_cost INTEGER,
-                delivery_type TEXT,
-                bonus_used INTEGER,
-                status TEXT DEFAULT 'new',
-                points_used INTEGER DEFAULT 0,
-                discount_applied REAL DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            """,
-            # Таблица для системы лояльности
-            """
-            CREATE TABLE IF NOT EXISTS loyalty_program (
-                user_id INTEGER PRIMARY KEY,
-                total_spent REAL DEFAULT 0,     -- Всего потрачено
-                current_bonus INTEGER DEFAULT 0, -- Доступные бонусы
-                total_bonus_earned INTEGER DEFAULT 0, -- Всего начислено бонусов
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            """,
-            # loyalty_history table
-            """
-            CREATE TABLE IF NOT EXISTS loyalty_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                order_id INTEGER,
-                points_change INTEGER NOT NULL,
-                reason TEXT NOT NULL,
-                remaining_points INTEGER NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            """,
-            # Таблица для хранения платежей
-            """
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                payment_id TEXT UNIQUE NOT NULL,
-                user_id INTEGER NOT NULL,
-                amount REAL NOT NULL,
-                currency TEXT DEFAULT 'RUB',
-                status TEXT NOT NULL,
-                description TEXT,
-                metadata TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            """,
-            # Таблица для отслеживания попыток ввода сертификатов
-            """
-            CREATE TABLE IF NOT EXISTS certificate_attempts (
-                user_id INTEGER NOT NULL,
-                attempts INTEGER DEFAULT 0,
-                last_attempt TIMESTAMP,
-                blocked_until TIMESTAMP,
-                PRIMARY KEY (user_id)
-            )
-            """,
-            # Таблица для хранения сертификатов
-            """
-            CREATE TABLE IF NOT EXISTS certificates (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                amount INTEGER NOT NULL,
-                cert_code TEXT UNIQUE NOT NULL,
-                payment_id TEXT NOT NULL,
-                used BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            """,
-            # Таблица для отзывов
-            """
-            CREATE TABLE IF NOT EXISTS reviews (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                user_name TEXT,
-                text TEXT NOT NULL,
-                rating INTEGER DEFAULT 5,
-                order_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            """,
-            # Таблица для истории изменений заказов
-            """
-            CREATE TABLE IF NOT EXISTS order_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER NOT NULL,
-                status TEXT NOT NULL,
-                changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (order_id) REFERENCES orders (id)
-            )
-            """,
-            # Таблица пользователей
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                first_name TEXT,
-                last_name TEXT,
-                username TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            """
-        ]
-
-        for table in tables:
-            cur.execute(table)
-
-        # Создание индексов
-        indexes = [
-            "CREATE INDEX IF NOT EXISTS idx_products_category ON products(category)",
-            "CREATE INDEX IF NOT EXISTS idx_products_stock ON products(in_stock)",
-            "CREATE INDEX IF NOT EXISTS idx_payments_user_id ON payments(user_id)",
-            "CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status)",
-            "CREATE INDEX IF NOT EXISTS idx_payments_payment_id ON payments(payment_id)",
-            "CREATE INDEX IF NOT EXISTS idx_loyalty_user_id ON loyalty_program(user_id)",
-            "CREATE INDEX IF NOT EXISTS idx_loyalty_history_user ON loyalty_history(user_id)",
-            "CREATE INDEX IF NOT EXISTS idx_loyalty_history_order ON loyalty_history(order_id)"
-        ]
-
-        for index in indexes:
-            cur.execute(index)
-        # init_test_data()
-        print("✅ База данных инициализирована")
+    conn = _connect()
+    if migrations.get_schema_version(conn) >= migrations.LATEST_VERSION:
+        print("✅ Схема базы данных актуальна")
+        return
+
+    migrations.migrate(conn)
+    # init_test_data()
+    print("✅ База данных инициализирована")
 
 
 def calculate_order_total(cart_items: list, delivery_cost: int, bonus_used: int = 0, user_id: int = None) -> dict:
@@ -208,7 +219,7 @@ def calculate_bonus_from_order(total_amount: float) -> int:
 
 def spend_bonus_points(user_id: int, points_to_spend: int) -> bool:
     """Списывает бонусные баллы"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         cur = conn.cursor()
         cur.execute("SELECT current_bonus FROM loyalty_program WHERE user_id = ?", (user_id,))
         result = cur.fetchone()
@@ -224,7 +235,7 @@ def spend_bonus_points(user_id: int, points_to_spend: int) -> bool:
 
 def get_bonus_info(user_id: int) -> dict:
     """Получает информацию о бонусах пользователя"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.cursor()
         cur.execute("SELECT * FROM loyalty_program WHERE user_id = ?", (user_id,))
@@ -242,14 +253,18 @@ def get_bonus_info(user_id: int) -> dict:
         return dict(result)
 
 
+def init_user_loyalty_tx(cur: sqlite3.Cursor, user_id: int):
+    """Создаёт запись в программе лояльности внутри открытой транзакции"""
+    cur.execute("""
+        INSERT OR IGNORE INTO loyalty_program (user_id) 
+        VALUES (?)
+    """, (user_id,))
+
+
 def init_user_loyalty(user_id: int):
     """Инициализирует запись пользователя в программе лояльности"""
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT OR IGNORE INTO loyalty_program (user_id) 
-            VALUES (?)
-        """, (user_id,))
+    with _connect() as conn:
+        init_user_loyalty_tx(conn.cursor(), user_id)
         conn.commit()
 
 
@@ -261,7 +276,7 @@ def calculate_points_from_order(total_amount: float) -> int:
 
 def add_loyalty_points(user_id: int, order_id: int, total_amount: float):
     """Начисляет баллы за заказ"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.cursor()
 
@@ -314,7 +329,7 @@ def add_loyalty_points(user_id: int, order_id: int, total_amount: float):
 
 def spend_loyalty_points(user_id: int, order_id: int, points_to_spend: int, reason: str = "Оплата заказа"):
     """Списывает баллы"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.cursor()
 
@@ -344,7 +359,7 @@ def spend_loyalty_points(user_id: int, order_id: int, points_to_spend: int, reas
 
 def get_loyalty_info(user_id: int) -> dict:
     """Получает информацию о программе лояльности пользователя"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.cursor()
 
@@ -366,7 +381,7 @@ def get_loyalty_info(user_id: int) -> dict:
 
 def get_loyalty_history(user_id: int, limit: int = 10) -> list:
     """Получает историю операций с баллами"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.cursor()
 
@@ -388,7 +403,7 @@ def get_points_discount_value(points: int) -> float:
 
 def cleanup_old_daily_products():
     """Удаляет букеты дня, которые старше 1 дня"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         cur = conn.cursor()
         cur.execute("""
             DELETE FROM products 
@@ -398,26 +413,44 @@ def cleanup_old_daily_products():
         deleted_count = cur.rowcount
         conn.commit()
         if deleted_count > 0:
+            catalog_cache.invalidate()
             print(f"🗑️ Удалено {deleted_count} старых букетов дня")
         return deleted_count
 
 
+def delete_product(product_id: int) -> bool:
+    """Удаляет товар и убирает его из корзин"""
+    with _connect() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM cart WHERE product_id = ?", (product_id,))
+        cur.execute("DELETE FROM products WHERE id = ?", (product_id,))
+        deleted = cur.rowcount > 0
+        conn.commit()
+    catalog_cache.invalidate()
+    return deleted
+
+
+def add_to_cart_tx(cur: sqlite3.Cursor, user_id: int, product_id: int) -> bool:
+    """Добавляет товар в корзину внутри открытой транзакции"""
+    # Проверяем, есть ли уже товар в корзине
+    cur.execute("SELECT quantity FROM cart WHERE user_id=? AND product_id=?", (user_id, product_id))
+    row = cur.fetchone()
+
+    if row:
+        # Товар уже есть в корзине - увеличиваем количество
+        cur.execute("UPDATE cart SET quantity = quantity + 1 WHERE user_id=? AND product_id=?",
+                    (user_id, product_id))
+    else:
+        # Товара нет в корзине - добавляем с количеством 1
+        cur.execute("INSERT INTO cart (user_id, product_id, quantity) VALUES (?, ?, 1)",
+                    (user_id, product_id))
+    return True
+
+
 def add_to_cart(user_id: int, product_id: int):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cur = conn.cursor()
-            # Проверяем, есть ли уже товар в корзине
-            cur.execute("SELECT quantity FROM cart WHERE user_id=? AND product_id=?", (user_id, product_id))
-            row = cur.fetchone()
-
-            if row:
-                # Товар уже есть в корзине - увеличиваем количество
-                cur.execute("UPDATE cart SET quantity = quantity + 1 WHERE user_id=? AND product_id=?",
-                            (user_id, product_id))
-            else:
-                # Товара нет в корзине - добавляем с количеством 1
-                cur.execute("INSERT INTO cart (user_id, product_id, quantity) VALUES (?, ?, 1)",
-                            (user_id, product_id))
+        with _connect() as conn:
+            add_to_cart_tx(conn.cursor(), user_id, product_id)
             conn.commit()
             return True
     except Exception as e:
@@ -427,20 +460,8 @@ def add_to_cart(user_id: int, product_id: int):
 
 def get_cart(user_id: int) -> List[Dict]:
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT p.id, p.name, p.price, c.quantity, p.in_stock
-                FROM cart c 
-                LEFT JOIN products p ON c.product_id = p.id 
-                WHERE c.user_id=?
-            """, (user_id,))
-
-            cart_items = []
-            for row in cur.fetchall():
-                cart_items.append(dict(row))
-            return cart_items
+        with _connect() as conn:
+            return _select_cart(conn.cursor(), user_id)
     except Exception as e:
         print(f"Error getting cart: {e}")
         return []
@@ -448,7 +469,7 @@ def get_cart(user_id: int) -> List[Dict]:
 
 def clear_cart(user_id: int):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with _connect() as conn:
             cur = conn.cursor()
             cur.execute("DELETE FROM cart WHERE user_id=?", (user_id,))
             conn.commit()
@@ -460,7 +481,7 @@ def clear_cart(user_id: int):
 
 def add_bonus_points(user_id: int, order_id: int, total_amount: float):
     """Начисляет бонусы (5% от суммы заказа)"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.cursor()
 
@@ -508,123 +529,181 @@ def add_bonus_points(user_id: int, order_id: int, total_amount: float):
 
 
 def add_product(name: str, description: str, full_description: str, price: float,
-                photo: str, category: str, is_daily: bool = True, on_request: bool = False) -> int:
-    with sqlite3.connect(DB_PATH) as conn:
+                photo: str, category: str, is_daily: bool = True, on_request: bool = False,
+                photo_file_id: str = None) -> int:
+    with _connect() as conn:
         cur = conn.cursor()
         cur.execute("""
             INSERT INTO products 
-            (name, description, full_description, price, photo, category, is_daily, on_request)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (name, description, full_description, price, photo, category, is_daily, on_request))
+            (name, description, full_description, price, photo, category, is_daily, on_request, photo_file_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (name, description, full_description, price, photo, category, is_daily, on_request, photo_file_id))
         conn.commit()
-        return cur.lastrowid
+    catalog_cache.invalidate()
+    return cur.lastrowid
 
 
 def is_first_order(user_id: int) -> bool:
     """Проверяет, является ли заказ первым для пользователя"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         cur = conn.cursor()
         cur.execute("SELECT COUNT(*) FROM orders WHERE user_id = ?", (user_id,))
         order_count = cur.fetchone()[0]
         return order_count == 0
 
 
+def _begin_immediate(conn: sqlite3.Connection):
+    """Начинает транзакцию записи, сразу захватывая блокировку базы"""
+    if conn.in_transaction:
+        # Незавершённая транзакция от предыдущего запроса этого потока
+        conn.rollback()
+    conn.execute("BEGIN IMMEDIATE")
+
+
+def _select_cart(cur: sqlite3.Cursor, user_id: int) -> List[Dict]:
+    """Корзина пользователя в рамках уже открытой транзакции"""
+    cur.execute("""
+        SELECT p.id, p.name, p.price, c.quantity, p.in_stock
+        FROM cart c 
+        LEFT JOIN products p ON c.product_id = p.id 
+        WHERE c.user_id=?
+    """, (user_id,))
+    columns = [column[0] for column in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
 def create_order(user_id: int, name: str, phone: str, address: str,
                  delivery_date: str, delivery_time: str, payment: str,
                  delivery_cost: int = 0, delivery_type: str = "delivery",
                  bonus_used: int = 0) -> int:
+    """Оформляет заказ одной транзакцией: корзина, скидки, бонусы, заказ, очистка корзины"""
+    conn = _connect()
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-
-        # Создаем/обновляем пользователя
-        cur.execute("""
-            INSERT OR IGNORE INTO users (id, first_name)
-            VALUES (?, ?)
-        """, (user_id, name.split()[0] if name else 'Пользователь'))
-
-        # Получаем корзину
-        cart_items = get_cart(user_id)
-        products_total = sum(item['price'] * item['quantity'] for item in cart_items)
+        # Блокировку записи берём сразу, чтобы параллельные заказы не списали
+        # одни и те же бонусы и не получили "database is locked" посреди заказа
+        _begin_immediate(conn)
+        order_id = create_order_tx(conn.cursor(), user_id, name, phone, address, delivery_date,
+                                   delivery_time, payment, delivery_cost, delivery_type, bonus_used)
+        if order_id == -1:
+            conn.rollback()
+            return -1
+        conn.commit()
+        return order_id
 
-        # Проверяем, первый ли заказ
-        is_first = is_first_order(user_id)
+    except Exception as e:
+        print(f"Ошибка при создании заказа: {e}")
+        conn.rollback()
+        return -1
 
-        # Проверяем доступность бонусов
-        actual_bonus_used = 0
-        if bonus_used > 0:
-            bonus_info = get_bonus_info(user_id)
-            max_bonus_allowed = int(products_total * 0.3)
-            actual_bonus_used = min(bonus_used, bonus_info['current_bonus'], max_bonus_allowed)
-            if actual_bonus_used < bonus_used:
-                return -1  # Ошибка
 
-        # Рассчитываем скидку на первый заказ
-        discount_applied = 0
-        if is_first:
-            discount_applied = int(products_total * 0.1)  # 10% от стоимости товаров
+def create_order_tx(cur: sqlite3.Cursor, user_id: int, name: str, phone: str, address: str,
+                    delivery_date: str, delivery_time: str, payment: str,
+                    delivery_cost: int = 0, delivery_type: str = "delivery",
+                    bonus_used: int = 0, cart_items: List[Dict] = None) -> int:
+    """Создаёт заказ внутри открытой транзакции; -1 - не хватает бонусов (транзакцию откатывает вызывающий).
+    cart_items - уже оплаченные товары, иначе берётся текущая корзина"""
+    # Создаем/обновляем пользователя
+    cur.execute("""
+        INSERT OR IGNORE INTO users (id, first_name)
+        VALUES (?, ?)
+    """, (user_id, name.split()[0] if name else 'Пользователь'))
+    cur.execute("INSERT OR IGNORE INTO loyalty_program (user_id) VALUES (?)", (user_id,))
+
+    # Получаем корзину
+    if cart_items is None:
+        cart_items = _select_cart(cur, user_id)
+    products_total = sum(item['price'] * item['quantity'] for item in cart_items)
 
-        # Рассчитываем итоговую сумму
-        subtotal = products_total + delivery_cost - actual_bonus_used
-        final_total = max(0, subtotal - discount_applied)  # ← ВАЖНО: вычитаем скидку
+    # Проверяем, первый ли заказ
+    cur.execute("SELECT COUNT(*) FROM orders WHERE user_id = ?", (user_id,))
+    is_first = cur.fetchone()[0] == 0
 
-        # Создаём заказ
+    # Проверяем доступность бонусов
+    actual_bonus_used = 0
+    if bonus_used > 0:
+        cur.execute("SELECT current_bonus FROM loyalty_program WHERE user_id = ?", (user_id,))
+        current_bonus = cur.fetchone()[0] or 0
+        max_bonus_allowed = int(products_total * 0.3)
+        actual_bonus_used = min(bonus_used, current_bonus, max_bonus_allowed)
+        if actual_bonus_used < bonus_used:
+            return -1  # Ошибка
+
+    # Рассчитываем скидку на первый заказ
+    discount_applied = 0
+    if is_first:
+        discount_applied = int(products_total * 0.1)  # 10% от стоимости товаров
+
+    # Рассчитываем итоговую сумму
+    subtotal = products_total + delivery_cost - actual_bonus_used
+    final_total = max(0, subtotal - discount_applied)  # ← ВАЖНО: вычитаем скидку
+
+    # Создаём заказ
+    cur.execute("""
+        INSERT INTO orders 
+        (user_id, items, total, customer_name, phone, address, 
+         delivery_date, delivery_time, payment_method, delivery_cost, 
+         delivery_type, status, bonus_used, discount_applied)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (user_id, json.dumps(cart_items), final_total, name, phone, address,
+          delivery_date, delivery_time, payment, delivery_cost,
+          delivery_type, 'new', actual_bonus_used, discount_applied))
+
+    order_id = cur.lastrowid
+
+    # Товары заказа
+    cur.executemany("""
+        INSERT INTO order_items (order_id, product_id, name, price, quantity)
+        VALUES (?, ?, ?, ?, ?)
+    """, [(order_id, item['id'], item['name'], item['price'], item['quantity']) for item in cart_items])
+
+    # Уведомление админам уходит через outbox и фиксируется вместе с заказом
+    enqueue_outbox_tx(cur, f"order:{order_id}:new", ADMINS, "new_order", {
+        "order_id": order_id, "user_id": user_id, "name": name, "phone": phone,
+        "address": address, "delivery_date": delivery_date, "delivery_time": delivery_time,
+        "payment_method": payment, "delivery_type": delivery_type, "delivery_cost": delivery_cost,
+        "bonus_used": actual_bonus_used, "discount": discount_applied, "total": final_total,
+        "items": [{"name": item['name'], "price": item['price'], "quantity": item['quantity']}
+                  for item in cart_items],
+    })
+
+    # Списываем бонусы, если использовались
+    if actual_bonus_used > 0:
         cur.execute("""
-            INSERT INTO orders 
-            (user_id, items, total, customer_name, phone, address, 
-             delivery_date, delivery_time, payment_method, delivery_cost, 
-             delivery_type, status, bonus_used, discount_applied)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (user_id, json.dumps(cart_items), final_total, name, phone, address,
-              delivery_date, delivery_time, payment, delivery_cost,
-              delivery_type, 'new', actual_bonus_used, discount_applied))
-
-        order_id = cur.lastrowid
-
-        # Списываем бонусы, если использовались
-        if actual_bonus_used > 0:
-            cur.execute("""
-                UPDATE loyalty_program 
-                SET current_bonus = current_bonus - ? 
-                WHERE user_id = ?
-            """, (actual_bonus_used, user_id))
-            cur.execute("""
-                INSERT INTO loyalty_history 
-                (user_id, order_id, points_change, reason, remaining_points)
-                SELECT ?, ?, -?, ?, current_bonus FROM loyalty_program WHERE user_id = ?
-            """, (user_id, order_id, actual_bonus_used, f"Списание за заказ #{order_id}", user_id))
-
-        # Начисляем бонусы: 5% от итоговой суммы (после всех скидок)
-        bonus_earned = max(0, math.ceil(final_total * 0.05))
-        if bonus_earned > 0:
-            cur.execute("""
-                UPDATE loyalty_program 
-                SET current_bonus = current_bonus + ?,
-                    total_bonus_earned = total_bonus_earned + ?,
-                    total_spent = total_spent + ?,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE user_id = ?
-            """, (bonus_earned, bonus_earned, final_total, user_id))
-            cur.execute("""
-                INSERT INTO loyalty_history 
-                (user_id, order_id, points_change, reason, remaining_points)
-                SELECT ?, ?, ?, ?, current_bonus FROM loyalty_program WHERE user_id = ?
-            """, (user_id, order_id, bonus_earned, f"Начисление за заказ #{order_id}", user_id))
+            UPDATE loyalty_program 
+            SET current_bonus = current_bonus - ? 
+            WHERE user_id = ?
+        """, (actual_bonus_used, user_id))
+        cur.execute("""
+            INSERT INTO loyalty_history 
+            (user_id, order_id, points_change, reason, remaining_points)
+            SELECT ?, ?, -?, ?, current_bonus FROM loyalty_program WHERE user_id = ?
+        """, (user_id, order_id, actual_bonus_used, f"Списание за заказ #{order_id}", user_id))
 
-        # Очищаем корзину
-        cur.execute("DELETE FROM cart WHERE user_id = ?", (user_id,))
-        conn.commit()
-        return order_id
+    # Начисляем бонусы: 5% от итоговой суммы (после всех скидок)
+    bonus_earned = max(0, math.ceil(final_total * 0.05))
+    if bonus_earned > 0:
+        cur.execute("""
+            UPDATE loyalty_program 
+            SET current_bonus = current_bonus + ?,
+                total_bonus_earned = total_bonus_earned + ?,
+                total_spent = total_spent + ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = ?
+        """, (bonus_earned, bonus_earned, final_total, user_id))
+        cur.execute("""
+            INSERT INTO loyalty_history 
+            (user_id, order_id, points_change, reason, remaining_points)
+            SELECT ?, ?, ?, ?, current_bonus FROM loyalty_program WHERE user_id = ?
+        """, (user_id, order_id, bonus_earned, f"Начисление за заказ #{order_id}", user_id))
 
-    except Exception as e:
-        print(f"Ошибка при создании заказа: {e}")
-        conn.rollback()
-        return -1
+    # Очищаем корзину
+    cur.execute("DELETE FROM cart WHERE user_id = ?", (user_id,))
+    return order_id
 
 
 def add_certificate_purchase(user_id: int, amount: int, cert_code: str, payment_id: str):
     """Сохраняет информацию о покупке сертификата"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         cur = conn.cursor()
         cur.execute("""
             INSERT INTO certificates (user_id, amount, cert_code, payment_id)
@@ -635,11 +714,11 @@ def add_certificate_purchase(user_id: int, amount: int, cert_code: str, payment_
 
 def get_delivered_orders(user_id: int) -> List[Dict]:
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cur = conn.cursor()
             cur.execute("""
-                SELECT id, items, total, created_at, delivery_date 
+                SELECT id, total, created_at, delivery_date 
                 FROM orders 
                 WHERE user_id=? AND status='delivered' 
                 ORDER BY created_at DESC
@@ -658,7 +737,7 @@ def get_delivered_orders(user_id: int) -> List[Dict]:
 
 def update_order_status(order_id: int, status: str):
     """Обновляет статус заказа и записывает в историю"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         cur = conn.cursor()
 
         # Получаем текущий статус для проверки
@@ -675,6 +754,12 @@ def update_order_status(order_id: int, status: str):
                 VALUES (?, ?, CURRENT_TIMESTAMP)
             """, (order_id, status))
 
+            # Уведомление покупателю о новом статусе
+            cur.execute("SELECT user_id FROM orders WHERE id = ?", (order_id,))
+            user_id = cur.fetchone()[0]
+            enqueue_outbox_tx(cur, f"order:{order_id}:status:{status}", [user_id], "order_status",
+                              {"order_id": order_id, "status": status})
+
             conn.commit()
             return True
         return False
@@ -682,11 +767,11 @@ def update_order_status(order_id: int, status: str):
 
 def get_user_orders(user_id: int) -> List[Dict]:
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cur = conn.cursor()
             cur.execute("""
-                SELECT id, items, total, status, created_at, delivery_date, delivery_time
+                SELECT id, total, status, created_at, delivery_date, delivery_time
                 FROM orders WHERE user_id=? ORDER BY created_at DESC
             """, (user_id,))
 
@@ -698,6 +783,7 @@ def get_user_orders(user_id: int) -> List[Dict]:
                     moscow_time = utc_time + timedelta(hours=3)
                     order['created_at'] = moscow_time.strftime("%Y-%m-%d %H:%M:%S")
                 orders.append(order)
+            _attach_order_items(cur, orders)
             return orders
     except Exception as e:
         print(f"Error getting orders: {e}")
@@ -705,7 +791,7 @@ def get_user_orders(user_id: int) -> List[Dict]:
 
 
 def add_review(user_id: int, user_name: str, text: str, rating: int = 5, order_id: int = None):
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         cur = conn.cursor()
         cur.execute("""
             INSERT INTO reviews (user_id, user_name, text, rating, order_id) 
@@ -715,7 +801,7 @@ def add_review(user_id: int, user_name: str, text: str, rating: int = 5, order_i
 
 
 def get_reviews(limit: int = 10) -> List[Dict]:
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.cursor()
         cur.execute("""
@@ -728,7 +814,7 @@ def get_reviews(limit: int = 10) -> List[Dict]:
 
 
 def check_product_availability(product_id: int) -> bool:
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         cur = conn.cursor()
         cur.execute("SELECT in_stock FROM products WHERE id=?", (product_id,))
         result = cur.fetchone()
@@ -765,7 +851,7 @@ def get_delivery_time_slots():
 
 def check_certificate_validity(cert_code: str) -> dict:
     """Проверяет валидность сертификата"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.cursor()
         cur.execute("""
@@ -780,16 +866,160 @@ def check_certificate_validity(cert_code: str) -> dict:
 
 def mark_certificate_used(cert_code: str):
     """Помечает сертификат как использованный"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         cur = conn.cursor()
         cur.execute("UPDATE certificates SET used = TRUE WHERE cert_code = ?", (cert_code,))
         conn.commit()
 
 
+# --- OUTBOX УВЕДОМЛЕНИЙ ---
+def enqueue_outbox_tx(cur: sqlite3.Cursor, dedup_key: str, chat_ids: List[int], kind: str, payload: dict):
+    """Ставит уведомление в outbox внутри открытой транзакции.
+    Повтор с тем же dedup_key для того же получателя игнорируется"""
+    payload_json = json.dumps(payload, ensure_ascii=False)
+    cur.executemany("""
+        INSERT OR IGNORE INTO outbox (dedup_key, chat_id, kind, payload)
+        VALUES (?, ?, ?, ?)
+    """, [(dedup_key, chat_id, kind, payload_json) for chat_id in chat_ids])
+
+
+def get_due_outbox(limit: int = 50) -> List[Dict]:
+    """Неотправленные уведомления, время отправки которых подошло"""
+    conn = _connect()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, dedup_key, chat_id, kind, payload, attempts FROM outbox
+        WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+        ORDER BY next_attempt_at, id
+        LIMIT ?
+    """, (limit,))
+    columns = [c[0] for c in cur.description]
+    rows = [dict(zip(columns, row)) for row in cur.fetchall()]
+    for row in rows:
+        row['payload'] = json.loads(row['payload'])
+    return rows
+
+
+def finish_outbox_batch(sent_ids: List[int], failures: List[tuple]):
+    """Отмечает итог рассылки пакета одной транзакцией.
+    failures - (id, ошибка, пауза перед повтором в секундах или None, если повторять не нужно)"""
+    conn = _connect()
+    try:
+        _begin_immediate(conn)
+        cur = conn.cursor()
+        cur.executemany("""
+            UPDATE outbox SET status = 'sent', attempts = attempts + 1, sent_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        """, [(outbox_id,) for outbox_id in sent_ids])
+        cur.executemany("""
+            UPDATE outbox SET
+                attempts = attempts + 1,
+                last_error = ?,
+                status = CASE WHEN ? IS NULL THEN 'dead' ELSE 'pending' END,
+                next_attempt_at = datetime('now', '+' || COALESCE(?, 0) || ' seconds')
+            WHERE id = ?
+        """, [(error, delay, delay, outbox_id) for outbox_id, error, delay in failures])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def cleanup_outbox(days: int = 7) -> int:
+    """Удаляет давно отправленные уведомления"""
+    with _connect() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            DELETE FROM outbox WHERE status = 'sent' AND sent_at < datetime('now', ?)
+        """, (f"-{days} days",))
+        conn.commit()
+        return cur.rowcount
+
+
+def get_outbox_stats() -> Dict:
+    """Число уведомлений в outbox по статусам и возраст самого старого неотправленного"""
+    conn = _connect()
+    cur = conn.cursor()
+    cur.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status")
+    stats = {"pending": 0, "sent": 0, "dead": 0}
+    stats.update(dict(cur.fetchall()))
+    cur.execute("""
+        SELECT CAST((julianday('now') - julianday(MIN(created_at))) * 86400 AS INTEGER)
+        FROM outbox WHERE status = 'pending'
+    """)
+    stats["oldest_pending_sec"] = cur.fetchone()[0] or 0
+    return stats
+
+
+def enqueue_receipt_tx(cur: sqlite3.Cursor, payment_id: str):
+    """Ставит создание чека по платежу в очередь внутри открытой транзакции (один чек на платёж)"""
+    cur.execute("INSERT OR IGNORE INTO receipt_jobs (payment_id) VALUES (?)", (payment_id,))
+
+
+def get_due_receipt_jobs(limit: int = 20) -> List[Dict]:
+    """Задания на чеки, время которых подошло, вместе с данными платежа"""
+    conn = _connect()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT j.id, j.payment_id, j.attempts, p.amount, p.description, p.metadata
+        FROM receipt_jobs j
+        LEFT JOIN payments p ON p.payment_id = j.payment_id
+        WHERE j.status = 'pending' AND j.next_attempt_at <= CURRENT_TIMESTAMP
+        ORDER BY j.next_attempt_at, j.id
+        LIMIT ?
+    """, (limit,))
+    columns = [c[0] for c in cur.description]
+    rows = [dict(zip(columns, row)) for row in cur.fetchall()]
+    for row in rows:
+        row['metadata'] = json.loads(row['metadata']) if row['metadata'] else {}
+    return rows
+
+
+def finish_receipt_jobs(done: List[tuple], failures: List[tuple]):
+    """Отмечает итог пакета чеков одной транзакцией.
+    done - (id, receipt_id); failures - (id, ошибка, пауза перед повтором или None, если повторять не нужно)"""
+    conn = _connect()
+    try:
+        _begin_immediate(conn)
+        cur = conn.cursor()
+        cur.executemany("""
+            UPDATE receipt_jobs SET status = 'done', attempts = attempts + 1, receipt_id = ?,
+                done_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        """, [(receipt_id, job_id) for job_id, receipt_id in done])
+        cur.executemany("""
+            UPDATE receipt_jobs SET
+                attempts = attempts + 1,
+                last_error = ?,
+                status = CASE WHEN ? IS NULL THEN 'dead' ELSE 'pending' END,
+                next_attempt_at = datetime('now', '+' || COALESCE(?, 0) || ' seconds')
+            WHERE id = ?
+        """, [(error, delay, delay, job_id) for job_id, error, delay in failures])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def get_receipt_job_stats() -> Dict:
+    """Число заданий на чеки по статусам и возраст самого старого невыполненного"""
+    conn = _connect()
+    cur = conn.cursor()
+    cur.execute("SELECT status, COUNT(*) FROM receipt_jobs GROUP BY status")
+    stats = {"pending": 0, "done": 0, "dead": 0}
+    stats.update(dict(cur.fetchall()))
+    cur.execute("""
+        SELECT CAST((julianday('now') - julianday(MIN(created_at))) * 86400 AS INTEGER)
+        FROM receipt_jobs WHERE status = 'pending'
+    """)
+    stats["oldest_pending_sec"] = cur.fetchone()[0] or 0
+    return stats
+
+
 def save_payment(payment_id: str, user_id: int, amount: float, status: str,
                  description: str = "", metadata: dict = None):
     """Сохранение информации о платеже"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         cur = conn.cursor()
         cur.execute("""
             INSERT OR REPLACE INTO payments 
@@ -800,9 +1030,49 @@ def save_payment(payment_id: str, user_id: int, amount: float, status: str,
         conn.commit()
 
 
+def reserve_payment(idempotency_key: str, user_id: int, amount: float,
+                    description: str = "", metadata: dict = None) -> Dict:
+    """Записывает платёж с ключом идемпотентности до запроса в ЮKassa.
+    Пока ЮKassa не ответила, строка хранит ключ вместо payment_id и статус
+    'creating'. Если ключ уже есть, возвращает сохранённую строку как есть"""
+    conn = _connect()
+    try:
+        _begin_immediate(conn)
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT OR IGNORE INTO payments
+            (payment_id, user_id, amount, status, description, metadata, idempotency_key)
+            VALUES (?, ?, ?, 'creating', ?, ?, ?)
+        """, (idempotency_key, user_id, amount, description,
+              json.dumps(metadata) if metadata else None, idempotency_key))
+        cur.execute("""
+            SELECT payment_id, status, amount, confirmation_url, metadata FROM payments
+            WHERE idempotency_key = ?
+        """, (idempotency_key,))
+        columns = [c[0] for c in cur.description]
+        row = dict(zip(columns, cur.fetchone()))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    row['metadata'] = json.loads(row['metadata']) if row['metadata'] else {}
+    return row
+
+
+def attach_payment(idempotency_key: str, payment_id: str, status: str, confirmation_url: str = None):
+    """Привязывает созданный в ЮKassa платёж к строке, записанной reserve_payment"""
+    with _connect() as conn:
+        conn.execute("""
+            UPDATE payments
+            SET payment_id = ?, status = ?, confirmation_url = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE idempotency_key = ? AND status = 'creating'
+        """, (payment_id, status, confirmation_url, idempotency_key))
+
+
 def update_payment_status(payment_id: str, status: str):
     """Обновление статуса платежа"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         cur = conn.cursor()
         cur.execute("""
             UPDATE payments 
@@ -812,9 +1082,163 @@ def update_payment_status(payment_id: str, status: str):
         conn.commit()
 
 
+def fail_payment_tx(cur: sqlite3.Cursor, payment_id: str, status: str, error: str):
+    """Переводит платёж в окончательный статус неудачи (fulfill_failed, expired)
+    и ставит админам уведомление в outbox внутри открытой транзакции"""
+    cur.execute("""
+        UPDATE payments SET status = ?, last_error = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE payment_id = ?
+    """, (status, error, payment_id))
+    cur.execute("SELECT user_id, amount FROM payments WHERE payment_id = ?", (payment_id,))
+    user_id, amount = cur.fetchone()
+    enqueue_outbox_tx(cur, f"payment:{payment_id}:{status}", ADMINS, "payment_failed", {
+        "payment_id": payment_id, "user_id": user_id, "amount": amount, "status": status, "error": error,
+    })
+
+
+def fail_payment(payment_id: str, status: str, error: str) -> bool:
+    """Окончательная неудача ещё не выполненного pending-платежа с уведомлением
+    админам (см. fail_payment_tx). False - платёж тем временем выполнен или закрыт"""
+    conn = _connect()
+    try:
+        _begin_immediate(conn)
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT 1 FROM payments WHERE payment_id = ? AND status = 'pending' AND fulfilled_at IS NULL
+        """, (payment_id,))
+        if cur.fetchone() is None:
+            conn.rollback()
+            return False
+        fail_payment_tx(cur, payment_id, status, error)
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def fulfill_payment(payment_id: str, notify_user: bool = True) -> Optional[Dict]:
+    """Выполняет оплаченный платёж ровно один раз: создаёт заказ или сертификат
+    и отмечает платёж выполненным в той же транзакции. Повторный вызов
+    возвращает созданное в первый раз (created=False). Если заказ создать
+    нельзя (не хватает бонусов), платёж окончательно переходит в fulfill_failed,
+    админам уходит уведомление, а результат приходит с failed=True.
+    None - платежа нет или ошибка базы (можно повторить).
+    notify_user - поставить покупателю сообщение об оплате в outbox
+    (если обработчик не отвечает сам)"""
+    conn = _connect()
+    try:
+        _begin_immediate(conn)
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT user_id, amount, metadata, order_id, fulfilled_at, status, last_error
+            FROM payments WHERE payment_id = ?
+        """, (payment_id,))
+        row = cur.fetchone()
+        if row is None:
+            conn.rollback()
+            return None
+
+        user_id, amount, metadata, order_id, fulfilled_at, status, last_error = row
+        metadata = json.loads(metadata) if metadata else {}
+        result = {"type": metadata.get("type", "order"), "order_id": order_id,
+                  "cert_code": metadata.get("cert_code"), "amount": amount, "created": False,
+                  "failed": False}
+        if fulfilled_at:
+            conn.rollback()
+            return result
+        if status == 'fulfill_failed':
+            # Повтор уведомления или проверки ничего не изменит - платёж уже у админов
+            conn.rollback()
+            return dict(result, failed=True, error=last_error)
+
+        if result["type"] == "certificate":
+            cur.execute("""
+                INSERT OR IGNORE INTO certificates (user_id, amount, cert_code, payment_id)
+                VALUES (?, ?, ?, ?)
+            """, (user_id, int(amount), result["cert_code"], payment_id))
+        else:
+            # Старые платежи хранили данные заказа в order_data
+            order = metadata.get("order_data") or metadata
+            order_id = create_order_tx(
+                cur, user_id, order.get("name", ""), order.get("phone", ""), order.get("address", ""),
+                order.get("delivery_date", ""), order.get("delivery_time", ""),
+                order.get("payment_method", "online"), order.get("delivery_cost", 0),
+                order.get("delivery_type", "delivery"), order.get("bonus_used", 0),
+                cart_items=order.get("cart_items")
+            )
+            if order_id == -1:
+                error = "не хватает бонусов для заказа"
+                logger.error(f"Не удалось создать заказ по оплаченному платежу {payment_id}: {error}")
+                conn.rollback()
+                _begin_immediate(conn)
+                fail_payment_tx(cur, payment_id, 'fulfill_failed', error)
+                conn.commit()
+                return dict(result, failed=True, error=error)
+            result["order_id"] = order_id
+
+        cur.execute("""
+            UPDATE payments
+            SET status = 'succeeded', order_id = ?, fulfilled_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+            WHERE payment_id = ?
+        """, (result["order_id"], payment_id))
+        if notify_user:
+            enqueue_outbox_tx(cur, f"payment:{payment_id}:fulfilled", [user_id], "payment_fulfilled", result)
+        if YOOKASSA_RECEIPT_MODE == "deferred":
+            enqueue_receipt_tx(cur, payment_id)
+        conn.commit()
+        result["created"] = True
+        return result
+
+    except Exception as e:
+        logger.error(f"Ошибка при выполнении платежа {payment_id}: {e}")
+        conn.rollback()
+        return None
+
+
+def get_payments_to_check(limit: int = 20) -> List[Dict]:
+    """Платежи в статусе pending, которые пора сверить с ЮKassa.
+    Невыполнимые (fulfill_failed) и брошенные сверкой (expired) сюда не попадают"""
+    conn = _connect()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT payment_id, user_id, check_attempts, created_at, next_check_at FROM payments
+        WHERE status = 'pending' AND (next_check_at IS NULL OR next_check_at <= CURRENT_TIMESTAMP)
+        ORDER BY next_check_at
+        LIMIT ?
+    """, (limit,))
+    columns = [c[0] for c in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def schedule_payment_check(payment_id: str, delay_seconds: float):
+    """Откладывает следующую сверку платежа и учитывает попытку"""
+    with _connect() as conn:
+        conn.execute("""
+            UPDATE payments
+            SET check_attempts = check_attempts + 1,
+                next_check_at = datetime('now', '+' || ? || ' seconds')
+            WHERE payment_id = ?
+        """, (int(delay_seconds), payment_id))
+
+
+def get_reconcile_backlog() -> Dict:
+    """Сколько платежей ждут сверки и насколько просрочена самая старая"""
+    conn = _connect()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT COUNT(*),
+               SUM(next_check_at IS NULL OR next_check_at <= CURRENT_TIMESTAMP),
+               CAST((julianday('now') - julianday(MIN(COALESCE(next_check_at, created_at)))) * 86400 AS INTEGER)
+        FROM payments WHERE status = 'pending'
+    """)
+    pending, due, lag = cur.fetchone()
+    return {"pending": pending, "due": due or 0, "lag_sec": max(lag or 0, 0)}
+
+
 def get_payment(payment_id: str) -> Optional[Dict]:
     """Получение информации о платеже"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.cursor()
         cur.execute("SELECT * FROM payments WHERE payment_id = ?", (payment_id,))
@@ -822,30 +1246,34 @@ def get_payment(payment_id: str) -> Optional[Dict]:
         return dict(row) if row else None
 
 
+def add_certificate_attempt_tx(cur: sqlite3.Cursor, user_id: int):
+    """Учитывает попытку ввода сертификата внутри открытой транзакции"""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    cur.execute("""
+        INSERT OR REPLACE INTO certificate_attempts 
+        (user_id, attempts, last_attempt, blocked_until)
+        VALUES (?, 
+                COALESCE((SELECT attempts FROM certificate_attempts WHERE user_id = ?), 0) + 1,
+                ?,
+                CASE 
+                    WHEN COALESCE((SELECT attempts FROM certificate_attempts WHERE user_id = ?), 0) + 1 >= 3 
+                    THEN datetime(?, '+30 minutes')
+                    ELSE NULL
+                END)
+    """, (user_id, user_id, now, user_id, now))
+
+
 def add_certificate_attempt(user_id: int):
     """Добавляет попытку ввода сертификата"""
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        cur.execute("""
-            INSERT OR REPLACE INTO certificate_attempts 
-            (user_id, attempts, last_attempt, blocked_until)
-            VALUES (?, 
-                    COALESCE((SELECT attempts FROM certificate_attempts WHERE user_id = ?), 0) + 1,
-                    ?,
-                    CASE 
-                        WHEN COALESCE((SELECT attempts FROM certificate_attempts WHERE user_id = ?), 0) + 1 >= 3 
-                        THEN datetime(?, '+30 minutes')
-                        ELSE NULL
-                    END)
-        """, (user_id, user_id, now, user_id, now))
+    with _connect() as conn:
+        add_certificate_attempt_tx(conn.cursor(), user_id)
         conn.commit()
 
 
 def get_certificate_attempts(user_id: int) -> dict:
     """Получает информацию о попытках ввода"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.cursor()
         cur.execute("SELECT * FROM certificate_attempts WHERE user_id = ?", (user_id,))
@@ -855,16 +1283,499 @@ def get_certificate_attempts(user_id: int) -> dict:
 
 def reset_certificate_attempts(user_id: int):
     """Сбрасывает счетчик попыток"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         cur = conn.cursor()
         cur.execute("DELETE FROM certificate_attempts WHERE user_id = ?", (user_id,))
         conn.commit()
 
 
+def get_daily_products(category: str) -> List[Dict]:
+    """Товары категории, добавленные сегодня"""
+    with _connect() as conn:
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT id, name, description, full_description, price, photo, photo_file_id,
+                   category, is_daily, on_request, in_stock, version 
+            FROM products 
+            WHERE category = ? AND is_daily = TRUE 
+            AND created_date = DATE('now') 
+            ORDER BY id DESC
+        """, (category,))
+        return [dict(row) for row in cur.fetchall()]
+
+
+# Окончания, которые отбрасываются при поиске: "пионы" и "пионов" ищутся как "пион*"
+_SEARCH_ENDINGS = ("ами", "ями", "ого", "ему", "ой", "ый", "ий", "ая", "ое", "ые", "ие",
+                   "ов", "ев", "ей", "ам", "ям", "ах", "ях", "ом", "ем",
+                   "ы", "и", "а", "я", "о", "е", "у", "ю", "ь", "й")
+
+
+def _search_query(text: str) -> str:
+    """Строит запрос FTS5: каждое слово - префикс его основы, слова через AND"""
+    terms = []
+    for word in re.findall(r"\w+", text.lower()):
+        for ending in _SEARCH_ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= 3:
+                word = word[:-len(ending)]
+                break
+        terms.append(f'"{word}"*')
+    return " ".join(terms)
+
+
+def search_products(text: str, limit: int = 10) -> List[Dict]:
+    """Товары текущего каталога по поисковому запросу, лучшие совпадения первыми"""
+    query = _search_query(text)
+    if not query:
+        return []
+
+    with _connect() as conn:
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+        # Вес совпадения: название важнее краткого описания, оно важнее полного
+        cur.execute("""
+            SELECT p.id, p.name, p.description, p.price, p.photo, p.category, p.on_request
+            FROM products_fts
+            JOIN products p ON p.id = products_fts.rowid
+            WHERE products_fts MATCH ?
+            AND (p.is_daily = FALSE OR p.created_date = DATE('now'))
+            ORDER BY bm25(products_fts, 10.0, 3.0, 1.0)
+            LIMIT ?
+        """, (query, limit))
+        return [dict(row) for row in cur.fetchall()]
+
+
+def get_product(product_id: int) -> Optional[Dict]:
+    """Получает товар по ID"""
+    with _connect() as conn:
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM products WHERE id = ?", (product_id,))
+        row = cur.fetchone()
+        return dict(row) if row else None
+
+
+def set_product_price(product_id: int, price: float):
+    """Устанавливает цену товара и снимает флаг 'по запросу'"""
+    with _connect() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE products 
+            SET price = ?, on_request = FALSE 
+            WHERE id = ?
+        """, (price, product_id))
+        conn.commit()
+    catalog_cache.invalidate()
+
+
+def set_product_photo_file_id(product_id: int, file_id: Optional[str]):
+    """Запоминает file_id фото товара в Telegram (None - забыть отклонённый)"""
+    with _connect() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE products SET photo_file_id = ? WHERE id = ?", (file_id, product_id))
+        conn.commit()
+
+
+def get_pending_price_products() -> List[Dict]:
+    """Товары дня с ценой 'по запросу'"""
+    with _connect() as conn:
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT id, name, description, photo, photo_file_id, created_date, version
+            FROM products
+            WHERE (price = 0 OR on_request = TRUE)
+            AND is_daily = TRUE
+            ORDER BY created_date DESC
+        """)
+        return [dict(row) for row in cur.fetchall()]
+
+
+def decrease_cart_item_tx(cur: sqlite3.Cursor, user_id: int, product_id: int):
+    """Убирает единицу товара из корзины внутри открытой транзакции"""
+    cur.execute("SELECT quantity FROM cart WHERE user_id=? AND product_id=?", (user_id, product_id))
+    row = cur.fetchone()
+
+    if row and row[0] > 1:
+        cur.execute("UPDATE cart SET quantity = quantity - 1 WHERE user_id=? AND product_id=?",
+                    (user_id, product_id))
+    else:
+        cur.execute("DELETE FROM cart WHERE user_id=? AND product_id=?", (user_id, product_id))
+
+
+def decrease_cart_item(user_id: int, product_id: int):
+    """Уменьшает количество товара в корзине, удаляя последнюю единицу"""
+    with _connect() as conn:
+        decrease_cart_item_tx(conn.cursor(), user_id, product_id)
+        conn.commit()
+
+
+def upsert_user_tx(cur: sqlite3.Cursor, user_id: int, first_name: str = None,
+                   last_name: str = None, username: str = None):
+    """Сохраняет или обновляет данные пользователя Telegram внутри открытой транзакции"""
+    cur.execute("""
+        INSERT INTO users (id, first_name, last_name, username)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            first_name = excluded.first_name,
+            last_name = excluded.last_name,
+            username = excluded.username
+    """, (user_id, first_name, last_name, username))
+
+
+def upsert_user(user_id: int, first_name: str = None, last_name: str = None, username: str = None):
+    """Сохраняет или обновляет данные пользователя Telegram"""
+    with _connect() as conn:
+        upsert_user_tx(conn.cursor(), user_id, first_name, last_name, username)
+        conn.commit()
+
+
+def run_write_batch(operations: list) -> list:
+    """Выполняет пакет мелких записей одной транзакцией (один commit на пакет).
+
+    operations - список (функция_tx, args); каждая операция в своей точке сохранения,
+    поэтому ошибка одной не откатывает остальные. Возвращает (результат, ошибка) по порядку.
+    """
+    conn = _connect()
+    results = []
+    try:
+        _begin_immediate(conn)
+        cur = conn.cursor()
+        for func, args in operations:
+            cur.execute("SAVEPOINT write_op")
+            try:
+                results.append((func(cur, *args), None))
+            except Exception as e:
+                cur.execute("ROLLBACK TO write_op")
+                results.append((None, e))
+            cur.execute("RELEASE write_op")
+        conn.commit()
+    except Exception as e:
+        print(f"Ошибка пакетной записи в БД: {e}")
+        if conn.in_transaction:
+            conn.rollback()
+        return [(None, e)] * len(operations)
+    return results
+
+
+def _attach_order_items(cur: sqlite3.Cursor, orders: List[Dict]):
+    """Подставляет в заказы список товаров из order_items (ключ 'items')"""
+    if not orders:
+        return
+    items_by_order = {order['id']: [] for order in orders}
+    placeholders = ",".join("?" * len(items_by_order))
+    cur.execute(f"""
+        SELECT order_id, product_id, name, price, quantity
+        FROM order_items
+        WHERE order_id IN ({placeholders})
+        ORDER BY id
+    """, list(items_by_order))
+    for order_id, product_id, name, price, quantity in cur.fetchall():
+        items_by_order[order_id].append({
+            'id': product_id,
+            'name': name,
+            'price': price,
+            'quantity': quantity
+        })
+    for order in orders:
+        order['items'] = items_by_order[order['id']]
+
+
+def get_order_items(order_id: int) -> Optional[List[Dict]]:
+    """Список товаров заказа (None, если заказа нет)"""
+    with _connect() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM orders WHERE id = ?", (order_id,))
+        if not cur.fetchone():
+            return None
+
+        order = {'id': order_id}
+        _attach_order_items(cur, [order])
+        return order['items']
+
+
+def get_user_order(order_id: int, user_id: int) -> Optional[Dict]:
+    """Заказ пользователя по ID (вместе с товарами)"""
+    with _connect() as conn:
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM orders WHERE id = ? AND user_id = ?", (order_id, user_id))
+        row = cur.fetchone()
+        if not row:
+            return None
+
+        order = dict(row)
+        _attach_order_items(cur, [order])
+        return order
+
+
+def get_order_total(order_id: int) -> float:
+    """Итоговая сумма заказа"""
+    with _connect() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT total FROM orders WHERE id = ?", (order_id,))
+        row = cur.fetchone()
+        return row[0] if row else 0
+
+
+def get_order_user_id(order_id: int) -> Optional[int]:
+    """ID пользователя, оформившего заказ"""
+    with _connect() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT user_id FROM orders WHERE id = ?", (order_id,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+
+def get_orders_page(status: Optional[str] = None, direction: str = "next",
+                    anchor_id: int = 0, limit: int = 5) -> Dict:
+    """Страница заказов для админки (новые сверху) по ключу (created_at, id).
+
+    direction="next" - заказы старше заказа anchor_id, "prev" - новее него;
+    anchor_id=0 - первая страница. Один индексный диапазонный запрос на страницу.
+    """
+    conditions = []
+    params = []
+    if status:
+        conditions.append("o.status = ?")
+        params.append(status)
+
+    anchor = "(SELECT created_at, id FROM orders WHERE id = ?)"
+    if anchor_id and direction == "prev":
+        conditions.append(f"(o.created_at, o.id) > {anchor}")
+        params.append(anchor_id)
+        order_by = "o.created_at ASC, o.id ASC"
+    else:
+        if anchor_id:
+            conditions.append(f"(o.created_at, o.id) < {anchor}")
+            params.append(anchor_id)
+        order_by = "o.created_at DESC, o.id DESC"
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    with _analytics_connect() as conn:
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+        # Берём на одну запись больше, чтобы понять, есть ли следующая страница
+        cur.execute(f"""
+            SELECT o.id, o.status, o.total, o.created_at, o.customer_name
+            FROM orders o
+            {where}
+            ORDER BY {order_by}
+            LIMIT ?
+        """, params + [limit + 1])
+        orders = [dict(row) for row in cur.fetchall()]
+
+    has_more = len(orders) > limit
+    orders = orders[:limit]
+    if anchor_id and direction == "prev":
+        orders.reverse()
+        return {"orders": orders, "has_prev": has_more, "has_next": True}
+    return {"orders": orders, "has_prev": bool(anchor_id), "has_next": has_more}
+
+
+def get_order_with_user(order_id: int) -> Optional[Dict]:
+    """Заказ с данными пользователя"""
+    with _connect() as conn:
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT o.*, u.first_name, u.last_name, u.username 
+            FROM orders o 
+            LEFT JOIN users u ON o.user_id = u.id 
+            WHERE o.id = ?
+        """, (order_id,))
+        row = cur.fetchone()
+        if not row:
+            return None
+
+        order = dict(row)
+        _attach_order_items(cur, [order])
+        return order
+
+
+def _read_shop_stats(cur: sqlite3.Cursor) -> Dict[str, float]:
+    """Все счётчики из shop_stats (поддерживаются триггерами, см. миграцию 4)"""
+    cur.execute("SELECT metric, value FROM shop_stats")
+    return {metric: value for metric, value in cur.fetchall()}
+
+
+def _reviews_summary(counters: Dict[str, float]) -> Dict:
+    rated = counters.get('rated_reviews', 0)
+    return {
+        "total_reviews": int(counters.get('reviews', 0)),
+        "avg_rating": counters.get('rating_sum', 0) / rated if rated else 0,
+    }
+
+
+def get_reviews_summary() -> Dict:
+    """Количество отзывов и средний рейтинг"""
+    with _analytics_connect() as conn:
+        counters = _read_shop_stats(conn.cursor())
+    return _reviews_summary(counters)
+
+
+def get_shop_stats() -> Dict:
+    """Статистика магазина для админ-панели (без сканирования заказов)"""
+    with _analytics_connect() as conn:
+        counters = _read_shop_stats(conn.cursor())
+
+    stats = {
+        "total_orders": int(counters.get('orders', 0)),
+        "delivered_orders": int(counters.get('orders:delivered', 0)),
+        "new_orders": int(counters.get('orders:new', 0)),
+        "total_revenue": counters.get('delivered_revenue', 0),
+        "active_clients": int(counters.get('customers', 0)),
+    }
+    stats.update(_reviews_summary(counters))
+    return stats
+
+
+def rebuild_shop_stats():
+    """Пересчитывает shop_stats по таблицам заказов и отзывов (для восстановления)"""
+    conn = _connect()
+    try:
+        _begin_immediate(conn)
+        for statement in migrations.SHOP_STATS_REBUILD:
+            conn.execute(statement)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def get_best_sellers(limit: int = 5) -> List[Dict]:
+    """Самые продаваемые товары (все заказы, кроме отменённых)"""
+    with _analytics_connect() as conn:
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT oi.product_id, oi.name,
+                   SUM(oi.quantity) AS quantity,
+                   SUM(oi.price * oi.quantity) AS revenue
+            FROM order_items oi
+            JOIN orders o ON o.id = oi.order_id
+            WHERE o.status != 'cancelled'
+            GROUP BY oi.product_id, oi.name
+            ORDER BY quantity DESC
+            LIMIT ?
+        """, (limit,))
+        return [dict(row) for row in cur.fetchall()]
+
+
+def get_revenue_by_product(limit: int = 5) -> List[Dict]:
+    """Выручка по товарам (только доставленные заказы)"""
+    with _analytics_connect() as conn:
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT oi.product_id, oi.name,
+                   SUM(oi.quantity) AS quantity,
+                   SUM(oi.price * oi.quantity) AS revenue
+            FROM order_items oi
+            JOIN orders o ON o.id = oi.order_id
+            WHERE o.status = 'delivered'
+            GROUP BY oi.product_id, oi.name
+            ORDER BY revenue DESC
+            LIMIT ?
+        """, (limit,))
+        return [dict(row) for row in cur.fetchall()]
+
+
+def get_bonus_summary() -> Dict:
+    """Сводка по бонусной программе"""
+    with _analytics_connect() as conn:
+        cur = conn.cursor()
+
+        cur.execute("SELECT COUNT(*) FROM loyalty_program WHERE current_bonus > 0")
+        users_with_bonuses = cur.fetchone()[0]
+
+        cur.execute("SELECT SUM(current_bonus) FROM loyalty_program")
+        total_bonuses = cur.fetchone()[0] or 0
+
+        cur.execute("SELECT SUM(total_bonus_earned) FROM loyalty_program")
+        total_earned = cur.fetchone()[0] or 0
+
+    return {
+        "users_with_bonuses": users_with_bonuses,
+        "total_bonuses": total_bonuses,
+        "total_earned": total_earned,
+    }
+
+
+def get_reviews_debug_info() -> Optional[Dict]:
+    """Отладочная информация по таблице отзывов (None, если таблицы нет)"""
+    with _analytics_connect() as conn:
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='reviews'")
+        if not cur.fetchone():
+            return None
+
+        cur.execute("SELECT COUNT(*) FROM reviews")
+        count = cur.fetchone()[0]
+
+        cur.execute("SELECT COUNT(*) FROM reviews WHERE order_id IS NOT NULL")
+        order_reviews = cur.fetchone()[0]
+
+        cur.execute("SELECT COUNT(*) FROM reviews WHERE order_id IS NULL")
+        general_reviews = cur.fetchone()[0]
+
+        cur.execute("SELECT * FROM reviews ORDER BY created_at DESC LIMIT 5")
+        latest = [dict(row) for row in cur.fetchall()]
+
+    return {
+        "count": count,
+        "order_reviews": order_reviews,
+        "general_reviews": general_reviews,
+        "latest": latest,
+    }
+
+
+def add_test_bonus_points(user_id: int, amount: int):
+    """Тестовое начисление бонусов"""
+    with _connect() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE loyalty_program 
+            SET current_bonus = current_bonus + ?,
+                total_bonus_earned = total_bonus_earned + ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = ?
+        """, (amount, amount, user_id))
+
+        cur.execute("""
+            INSERT INTO loyalty_history 
+            (user_id, points_change, reason, remaining_points)
+            SELECT ?, ?, ?, current_bonus 
+            FROM loyalty_program 
+            WHERE user_id = ?
+        """, (user_id, amount, "Тестовое начисление бонусов", user_id))
+
+        conn.commit()
+
+
+def reset_user_bonus(user_id: int):
+    """Сбрасывает бонусы пользователя к начальному состоянию"""
+    with _connect() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE loyalty_program 
+            SET current_bonus = 0,
+                total_bonus_earned = 0,
+                total_spent = 0,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = ?
+        """, (user_id,))
+
+        cur.execute("DELETE FROM loyalty_history WHERE user_id = ?", (user_id,))
+        conn.commit()
+
+
 # В начало файла database.py добавить:
 def init_test_data():
     """Инициализация тестовых данных"""
-    with sqlite3.connect(DB_PATH) as conn:
+    with _connect() as conn:
         cur = conn.cursor()
 
         # Проверяем есть ли тестовый товар
@@ -877,11 +1788,5 @@ def init_test_data():
                         2500, 'bouquet', TRUE, TRUE)
             """)
             conn.commit()
+            catalog_cache.invalidate()
             print("✅ Тестовый товар добавлен")
-
-
-def get_connection():
-    """Создает подключение с правильными настройками"""
-    conn = sqlite3.connect(DB_PATH, timeout=30)  # Увеличиваем timeout
-    conn.execute("PRAGMA journal_mode=WAL")  # Включаем WAL mode для лучшей параллельности
-    return conn
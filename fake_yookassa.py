@@ -0,0 +1,215 @@
+"""Локальная замена API ЮKassa для сквозных и нагрузочных тестов.
+
+Запуск: python fake_yookassa.py [--port 8081] [--latency 200] [--error-rate 0.05]
+
+Затем бот запускается с YOOKASSA_API_URL=http://127.0.0.1:8081/v3 - SDK ЮKassa
+ходит сюда, а не в настоящий API. Поддерживаются запросы, которые делает бот:
+POST /v3/payments, GET /v3/payments/{id}, POST /v3/receipts. Платёж создаётся
+в статусе pending и через --succeed-after секунд становится succeeded (или
+canceled с вероятностью --cancel-rate). Ссылка оплаты /checkout/{id} сразу
+проводит платёж (с ?cancel=1 - отменяет). Счётчики запросов - GET /fake/stats.
+"""
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def _error(status: int, code: str, description: str) -> web.Response:
+    return web.json_response({"type": "error", "id": str(uuid.uuid4()), "code": code,
+                              "description": description}, status=status)
+
+
+class FakeYooKassa:
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, error_rate: float = 0,
+                 rate_limit_rate: float = 0, hang_rate: float = 0, succeed_after: float = 5,
+                 cancel_rate: float = 0, seed: int = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.hang_rate = hang_rate
+        self.succeed_after = succeed_after
+        self.cancel_rate = cancel_rate
+        self.random = random.Random(seed)
+        self.payments = {}
+        self.receipts = {}
+        self._idempotency = {}
+        self.stats = {"payments_created": 0, "payments_found": 0, "receipts_created": 0,
+                      "idempotent_replays": 0, "errors": 0, "rate_limited": 0, "hung": 0}
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._faults])
+        app.router.add_post("/v3/payments", self.create_payment)
+        app.router.add_get("/v3/payments/{payment_id}", self.find_payment)
+        app.router.add_post("/v3/receipts", self.create_receipt)
+        app.router.add_get("/checkout/{payment_id}", self.checkout)
+        app.router.add_get("/fake/stats", self.get_stats)
+        return app
+
+    @web.middleware
+    async def _faults(self, request: web.Request, handler):
+        """Задержка, ошибки и зависания для запросов к API"""
+        if not request.path.startswith("/v3/"):
+            return await handler(request)
+        if not request.headers.get("Authorization"):
+            return _error(401, "invalid_credentials", "Authorization header is missing")
+
+        delay = max(0.0, self.random.gauss(self.latency_ms, self.jitter_ms)) / 1000
+        await asyncio.sleep(delay)
+
+        roll = self.random.random()
+        if roll < self.hang_rate:
+            # Ответ, которого клиент не дождётся
+            self.stats["hung"] += 1
+            await asyncio.sleep(3600)
+        roll -= self.hang_rate
+        if roll < self.rate_limit_rate:
+            self.stats["rate_limited"] += 1
+            return _error(429, "too_many_requests", "Too many requests")
+        roll -= self.rate_limit_rate
+        if roll < self.error_rate:
+            self.stats["errors"] += 1
+            return _error(500, "internal_server_error", "Fake internal error")
+        return await handler(request)
+
+    async def _replay_or_run(self, request: web.Request, create, view=dict) -> web.Response:
+        """Повтор с тем же Idempotence-Key возвращает первый ответ"""
+        key = request.headers.get("Idempotence-Key")
+        if not key:
+            return _error(400, "invalid_request", "Idempotence-Key header is missing")
+        stored = self._idempotency.get((request.path, key))
+        if stored is not None:
+            self.stats["idempotent_replays"] += 1
+            return web.json_response(view(stored))
+
+        try:
+            body = await request.json()
+        except ValueError:
+            return _error(400, "invalid_request", "Body is not valid JSON")
+        result = create(body, request)
+        if isinstance(result, web.Response):
+            return result
+        self._idempotency[(request.path, key)] = result
+        return web.json_response(view(result))
+
+    async def create_payment(self, request: web.Request) -> web.Response:
+        return await self._replay_or_run(request, self._new_payment, self._view)
+
+    def _new_payment(self, body: dict, request: web.Request):
+        amount = body.get("amount") or {}
+        if not amount.get("value"):
+            return _error(400, "invalid_request", "Amount is required")
+
+        payment_id = str(uuid.uuid4())
+        payment = {
+            "id": payment_id,
+            "status": "pending",
+            "paid": False,
+            "amount": {"value": f"{float(amount['value']):.2f}", "currency": amount.get("currency", "RUB")},
+            "description": body.get("description", ""),
+            "metadata": body.get("metadata") or {},
+            "recipient": {"account_id": "fake", "gateway_id": "fake"},
+            "created_at": _now_iso(),
+            "test": True,
+            "refundable": False,
+            "confirmation": {
+                "type": "redirect",
+                "confirmation_url": f"{request.scheme}://{request.host}/checkout/{payment_id}",
+            },
+            # Служебные поля: когда и чем закончится платёж
+            "_settle_at": time.monotonic() + self.succeed_after,
+            "_outcome": "canceled" if self.random.random() < self.cancel_rate else "succeeded",
+        }
+        self.payments[payment_id] = payment
+        self.stats["payments_created"] += 1
+        return payment
+
+    def _view(self, payment: dict) -> dict:
+        """Платёж в том виде, в каком его вернул бы API на текущий момент"""
+        if payment["status"] == "pending" and time.monotonic() >= payment["_settle_at"]:
+            self._settle(payment, payment["_outcome"])
+        return {key: value for key, value in payment.items() if not key.startswith("_")}
+
+    @staticmethod
+    def _settle(payment: dict, outcome: str):
+        payment["status"] = outcome
+        payment.pop("confirmation", None)
+        if outcome == "succeeded":
+            payment["paid"] = True
+            payment["captured_at"] = _now_iso()
+            payment["income_amount"] = dict(payment["amount"])
+        else:
+            payment["cancellation_details"] = {"party": "yoo_money", "reason": "expired_on_confirmation"}
+
+    async def find_payment(self, request: web.Request) -> web.Response:
+        payment = self.payments.get(request.match_info["payment_id"])
+        if payment is None:
+            return _error(404, "not_found", "Payment not found")
+        self.stats["payments_found"] += 1
+        return web.json_response(self._view(payment))
+
+    async def create_receipt(self, request: web.Request) -> web.Response:
+        return await self._replay_or_run(request, self._new_receipt)
+
+    def _new_receipt(self, body: dict, request: web.Request):
+        if not body.get("items"):
+            return _error(400, "invalid_request", "Receipt items are required")
+        receipt = {
+            "id": str(uuid.uuid4()),
+            "type": body.get("type", "payment"),
+            "payment_id": body.get("payment_id"),
+            "status": "succeeded",
+            "items": body["items"],
+            "settlements": body.get("settlements") or [],
+        }
+        if body.get("tax_system_code"):
+            receipt["tax_system_code"] = body["tax_system_code"]
+        self.receipts[receipt["id"]] = receipt
+        self.stats["receipts_created"] += 1
+        return receipt
+
+    async def checkout(self, request: web.Request) -> web.Response:
+        """Страница оплаты: переход по ссылке сразу проводит или отменяет платёж"""
+        payment = self.payments.get(request.match_info["payment_id"])
+        if payment is None:
+            return web.Response(status=404, text="Платёж не найден")
+        if payment["status"] == "pending":
+            self._settle(payment, "canceled" if request.query.get("cancel") else "succeeded")
+        return web.Response(text=f"Платёж {payment['id']}: {payment['status']}. Вернитесь в бота.")
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        statuses = {}
+        for payment in self.payments.values():
+            status = self._view(payment)["status"]
+            statuses[status] = statuses.get(status, 0) + 1
+        return web.json_response(dict(self.stats, payments=statuses, receipts=len(self.receipts)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальная замена API ЮKassa")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0, help="Средняя задержка ответа, мс")
+    parser.add_argument("--jitter", type=float, default=0, help="Разброс задержки (σ), мс")
+    parser.add_argument("--error-rate", type=float, default=0, help="Доля ответов 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="Доля ответов 429")
+    parser.add_argument("--hang-rate", type=float, default=0, help="Доля запросов без ответа")
+    parser.add_argument("--succeed-after", type=float, default=5,
+                        help="Через сколько секунд pending-платёж завершается")
+    parser.add_argument("--cancel-rate", type=float, default=0, help="Доля платежей, которые будут отменены")
+    parser.add_argument("--seed", type=int, default=None, help="Зерно случайных ошибок для воспроизводимости")
+    args = parser.parse_args()
+
+    fake = FakeYooKassa(args.latency, args.jitter, args.error_rate, args.rate_limit_rate, args.hang_rate,
+                        args.succeed_after, args.cancel_rate, args.seed)
+    print(f"Фейковая ЮKassa: YOOKASSA_API_URL=http://{args.host}:{args.port}/v3")
+    web.run_app(fake.app(), host=args.host, port=args.port, print=None)
@@ -43,6 +43,33 @@ def product_keyboard(product_id: int):
     )
 
 
+def format_price(product: dict) -> str:
+    """Цена товара для списков"""
+    if product['on_request'] or product['price'] == 0:
+        return "по запросу"
+    return f"{product['price']} ₽"
+
+
+# Листание карусели каталога: carousel_{категория}_{номер товара}
+def carousel_nav_row(category: str, index: int, total: int):
+    return [
+        InlineKeyboardButton(text="◀️", callback_data=f"carousel_{category}_{(index - 1) % total}"),
+        InlineKeyboardButton(text=f"{index + 1} / {total}", callback_data=f"carousel_{category}_{index}"),
+        InlineKeyboardButton(text="▶️", callback_data=f"carousel_{category}_{(index + 1) % total}"),
+    ]
+
+
+# Результаты поиска: по кнопке на товар
+def search_results_keyboard(products):
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+    for product in products:
+        keyboard.inline_keyboard.append([
+            InlineKeyboardButton(text=f"{product['name']} — {format_price(product)}",
+                                 callback_data=f"details_{product['id']}")
+        ])
+    return keyboard
+
+
 # Клавиатура "Подробнее"
 def details_keyboard(product_id: int):
     return InlineKeyboardMarkup(
@@ -79,6 +106,19 @@ def delivery_keyboard():
     )
 
 
+# Способы оплаты заказа; online=False - ЮKassa недоступна, остаются оплата при получении и менеджер
+def payment_methods_keyboard(online: bool = True):
+    rows = []
+    if online:
+        rows.append([InlineKeyboardButton(text="💳 Онлайн картой", callback_data="pay_online")])
+    rows.append([InlineKeyboardButton(text="💵 Наличными при получении", callback_data="pay_cash")])
+    if online:
+        rows.append([InlineKeyboardButton(text="🔄 СБП", callback_data="pay_sbp")])
+    rows.append([InlineKeyboardButton(text="🎁 Сертификат", callback_data="pay_cert")])
+    rows.append([InlineKeyboardButton(text="💬 Через менеджера", callback_data="pay_manager")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
 def loyalty_keyboard():
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -138,14 +178,28 @@ def reviews_management_keyboard():
 
 
 # Клавиатура для списка заказов
-def orders_list_keyboard(orders, page=0, per_page=5):
+# Фильтры списка заказов в админке: (статус в callback_data, подпись)
+ORDER_STATUS_FILTERS = [
+    ("all", "Все"),
+    ("new", "🆕 Новые"),
+    ("delivered", "✅ Доставлены"),
+]
+
+
+def orders_list_keyboard(orders, page=0, status="all", has_prev=False, has_next=False):
+    """Страница списка заказов; в callback_data - направление, заказ-якорь, номер страницы и фильтр"""
     keyboard = InlineKeyboardMarkup(inline_keyboard=[])
 
-    start_idx = page * per_page
-    end_idx = start_idx + per_page
-    current_orders = orders[start_idx:end_idx]
+    # Фильтр по статусу (всегда с первой страницы)
+    keyboard.inline_keyboard.append([
+        InlineKeyboardButton(
+            text=f"• {label} •" if value == status else label,
+            callback_data=f"orders_page_next_0_0_{value}"
+        )
+        for value, label in ORDER_STATUS_FILTERS
+    ])
 
-    for order in current_orders:
+    for order in orders:
         keyboard.inline_keyboard.append([
             InlineKeyboardButton(
                 text=f"Заказ #{order['id']} - {order['status']}",
@@ -155,10 +209,12 @@ def orders_list_keyboard(orders, page=0, per_page=5):
 
     # Кнопки навигации
     nav_buttons = []
-    if page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"orders_page_{page - 1}"))
-    if end_idx < len(orders):
-        nav_buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"orders_page_{page + 1}"))
+    if has_prev and orders:
+        nav_buttons.append(InlineKeyboardButton(
+            text="⬅️ Назад", callback_data=f"orders_page_prev_{orders[0]['id']}_{page - 1}_{status}"))
+    if has_next and orders:
+        nav_buttons.append(InlineKeyboardButton(
+            text="Вперед ➡️", callback_data=f"orders_page_next_{orders[-1]['id']}_{page + 1}_{status}"))
 
     if nav_buttons:
         keyboard.inline_keyboard.append(nav_buttons)
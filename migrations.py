@@ -0,0 +1,468 @@
+import json
+import sqlite3
+
+# История схемы базы данных. Каждая миграция применяется один раз,
+# номер последней применённой хранится в таблице schema_version.
+# Новые изменения схемы добавляются только в конец списка.
+
+# Полный пересчёт shop_stats (миграция 4 и команда /rebuild_stats)
+SHOP_STATS_REBUILD = [
+    "DELETE FROM shop_stats",
+    """
+    INSERT INTO shop_stats (metric, value)
+    SELECT 'orders', COUNT(*) FROM orders
+    UNION ALL
+    SELECT 'orders:' || status, COUNT(*) FROM orders GROUP BY status
+    UNION ALL
+    SELECT 'delivered_revenue', COALESCE(SUM(total), 0) FROM orders WHERE status = 'delivered'
+    UNION ALL
+    SELECT 'customers', COUNT(DISTINCT user_id) FROM orders
+    UNION ALL
+    SELECT 'reviews', COUNT(*) FROM reviews
+    UNION ALL
+    SELECT 'rated_reviews', COUNT(*) FROM reviews WHERE rating > 0
+    UNION ALL
+    SELECT 'rating_sum', COALESCE(SUM(rating), 0) FROM reviews WHERE rating > 0
+    """,
+]
+
+MIGRATIONS = [
+    (1, "Базовая схема", [
+        # products table
+        """
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            description TEXT,
+            full_description TEXT,
+            price REAL NOT NULL,
+            photo TEXT,
+            category TEXT NOT NULL,
+            created_date DATE DEFAULT CURRENT_DATE,
+            created_by INTEGER,
+            is_daily BOOLEAN DEFAULT TRUE,
+            on_request BOOLEAN DEFAULT FALSE,
+            in_stock BOOLEAN DEFAULT TRUE
+        )
+        """,
+        # cart table
+        """
+        CREATE TABLE IF NOT EXISTS cart (
+            user_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER DEFAULT 1,
+            PRIMARY KEY(user_id, product_id)
+        )
+        """,
+        # orders table (обновленная с полями для скидок)
+        """
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            items TEXT NOT NULL,
+            total REAL NOT NULL,
+            customer_name TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            address TEXT,
+            delivery_date TEXT,
+            delivery_time TEXT,
+            payment_method TEXT,
+            delivery_cost INTEGER,
+            delivery_type TEXT,
+            bonus_used INTEGER,
+            status TEXT DEFAULT 'new',
+            points_used INTEGER DEFAULT 0,
+            discount_applied REAL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Таблица для системы лояльности
+        """
+        CREATE TABLE IF NOT EXISTS loyalty_program (
+            user_id INTEGER PRIMARY KEY,
+            total_spent REAL DEFAULT 0,     -- Всего потрачено
+            current_bonus INTEGER DEFAULT 0, -- Доступные бонусы
+            total_bonus_earned INTEGER DEFAULT 0, -- Всего начислено бонусов
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # loyalty_history table
+        """
+        CREATE TABLE IF NOT EXISTS loyalty_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            order_id INTEGER,
+            points_change INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            remaining_points INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Таблица для хранения платежей
+        """
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payment_id TEXT UNIQUE NOT NULL,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            currency TEXT DEFAULT 'RUB',
+            status TEXT NOT NULL,
+            description TEXT,
+            metadata TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Таблица для отслеживания попыток ввода сертификатов
+        """
+        CREATE TABLE IF NOT EXISTS certificate_attempts (
+            user_id INTEGER NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            last_attempt TIMESTAMP,
+            blocked_until TIMESTAMP,
+            PRIMARY KEY (user_id)
+        )
+        """,
+        # Таблица для хранения сертификатов
+        """
+        CREATE TABLE IF NOT EXISTS certificates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            cert_code TEXT UNIQUE NOT NULL,
+            payment_id TEXT NOT NULL,
+            used BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Таблица для отзывов
+        """
+        CREATE TABLE IF NOT EXISTS reviews (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            user_name TEXT,
+            text TEXT NOT NULL,
+            rating INTEGER DEFAULT 5,
+            order_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Таблица для истории изменений заказов
+        """
+        CREATE TABLE IF NOT EXISTS order_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (order_id) REFERENCES orders (id)
+        )
+        """,
+        # Таблица пользователей
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            first_name TEXT,
+            last_name TEXT,
+            username TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_products_category ON products(category)",
+        "CREATE INDEX IF NOT EXISTS idx_products_stock ON products(in_stock)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_user_id ON payments(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_payment_id ON payments(payment_id)",
+        "CREATE INDEX IF NOT EXISTS idx_loyalty_user_id ON loyalty_program(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_loyalty_history_user ON loyalty_history(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_loyalty_history_order ON loyalty_history(order_id)",
+    ]),
+    (2, "Индексы для частых запросов", [
+        # is_first_order, get_user_orders
+        "CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id)",
+        # Статистика и списки заказов в админке
+        "CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at)",
+        # История бонусов пользователя (заменяет idx_loyalty_history_user)
+        "CREATE INDEX IF NOT EXISTS idx_loyalty_history_user_created ON loyalty_history(user_id, created_at)",
+        "DROP INDEX IF EXISTS idx_loyalty_history_user",
+        # Последние отзывы
+        "CREATE INDEX IF NOT EXISTS idx_reviews_created ON reviews(created_at)",
+        # Каталог дня: show_bouquets / show_plants (заменяет idx_products_category)
+        "CREATE INDEX IF NOT EXISTS idx_products_daily ON products(category, is_daily, created_date)",
+        "DROP INDEX IF EXISTS idx_products_category",
+    ]),
+    (3, "Таблица товаров заказа", [
+        """
+        CREATE TABLE IF NOT EXISTS order_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            product_id INTEGER,
+            name TEXT NOT NULL,
+            price REAL NOT NULL,
+            quantity INTEGER NOT NULL,
+            FOREIGN KEY (order_id) REFERENCES orders (id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id)",
+        "CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items(product_id)",
+        lambda conn: _backfill_order_items(conn),
+    ]),
+    (4, "Сводная статистика магазина", [
+        """
+        CREATE TABLE IF NOT EXISTS shop_stats (
+            metric TEXT PRIMARY KEY,
+            value REAL NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_shop_stats_order_insert AFTER INSERT ON orders
+        BEGIN
+            INSERT INTO shop_stats (metric, value) VALUES ('orders', 1)
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO shop_stats (metric, value) VALUES ('orders:' || NEW.status, 1)
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO shop_stats (metric, value) VALUES ('delivered_revenue', CASE WHEN NEW.status = 'delivered' THEN NEW.total ELSE 0 END)
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO shop_stats (metric, value) VALUES ('customers', (SELECT COUNT(*) = 1 FROM orders WHERE user_id = NEW.user_id))
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_shop_stats_order_update AFTER UPDATE OF status, total ON orders
+        BEGIN
+            INSERT INTO shop_stats (metric, value) VALUES ('orders:' || OLD.status, -1)
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO shop_stats (metric, value) VALUES ('orders:' || NEW.status, 1)
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO shop_stats (metric, value) VALUES ('delivered_revenue', CASE WHEN NEW.status = 'delivered' THEN NEW.total ELSE 0 END - CASE WHEN OLD.status = 'delivered' THEN OLD.total ELSE 0 END)
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_shop_stats_order_delete AFTER DELETE ON orders
+        BEGIN
+            INSERT INTO shop_stats (metric, value) VALUES ('orders', -1)
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO shop_stats (metric, value) VALUES ('orders:' || OLD.status, -1)
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO shop_stats (metric, value) VALUES ('delivered_revenue', CASE WHEN OLD.status = 'delivered' THEN -OLD.total ELSE 0 END)
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO shop_stats (metric, value) VALUES ('customers', -(SELECT COUNT(*) = 0 FROM orders WHERE user_id = OLD.user_id))
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_shop_stats_review_insert AFTER INSERT ON reviews
+        BEGIN
+            INSERT INTO shop_stats (metric, value) VALUES ('reviews', 1)
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO shop_stats (metric, value) VALUES ('rated_reviews', NEW.rating > 0)
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO shop_stats (metric, value) VALUES ('rating_sum', CASE WHEN NEW.rating > 0 THEN NEW.rating ELSE 0 END)
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_shop_stats_review_update AFTER UPDATE OF rating ON reviews
+        BEGIN
+            INSERT INTO shop_stats (metric, value) VALUES ('rated_reviews', (NEW.rating > 0) - (OLD.rating > 0))
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO shop_stats (metric, value) VALUES ('rating_sum', CASE WHEN NEW.rating > 0 THEN NEW.rating ELSE 0 END - CASE WHEN OLD.rating > 0 THEN OLD.rating ELSE 0 END)
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_shop_stats_review_delete AFTER DELETE ON reviews
+        BEGIN
+            INSERT INTO shop_stats (metric, value) VALUES ('reviews', -1)
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO shop_stats (metric, value) VALUES ('rated_reviews', -(OLD.rating > 0))
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO shop_stats (metric, value) VALUES ('rating_sum', CASE WHEN OLD.rating > 0 THEN -OLD.rating ELSE 0 END)
+                ON CONFLICT(metric) DO UPDATE SET value = value + excluded.value;
+        END
+        """,
+    ] + SHOP_STATS_REBUILD),
+    (5, "Индекс для постраничного списка заказов", [
+        # Ключ пагинации (created_at, id): id входит в индекс как rowid
+        "CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at)",
+    ]),
+    (6, "Полнотекстовый поиск по товарам", [
+        # Внешнее содержимое: текст хранится только в products, в индексе - токены
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            name, description, full_description,
+            content='products', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_products_fts_insert AFTER INSERT ON products
+        BEGIN
+            INSERT INTO products_fts (rowid, name, description, full_description)
+            VALUES (NEW.id, NEW.name, NEW.description, NEW.full_description);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_products_fts_delete AFTER DELETE ON products
+        BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description, full_description)
+            VALUES ('delete', OLD.id, OLD.name, OLD.description, OLD.full_description);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_products_fts_update
+        AFTER UPDATE OF name, description, full_description ON products
+        BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description, full_description)
+            VALUES ('delete', OLD.id, OLD.name, OLD.description, OLD.full_description);
+            INSERT INTO products_fts (rowid, name, description, full_description)
+            VALUES (NEW.id, NEW.name, NEW.description, NEW.full_description);
+        END
+        """,
+        "INSERT INTO products_fts (products_fts) VALUES ('rebuild')",
+    ]),
+    (7, "file_id фото товаров в Telegram", [
+        "ALTER TABLE products ADD COLUMN photo_file_id TEXT",
+    ]),
+    (8, "Версия товара для кэша карточек", [
+        "ALTER TABLE products ADD COLUMN version INTEGER NOT NULL DEFAULT 1",
+        # Только поля, которые попадают в карточку (photo_file_id не в счёт)
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_products_version
+        AFTER UPDATE OF name, description, full_description, price, on_request, in_stock, category ON products
+        BEGIN
+            UPDATE products SET version = version + 1 WHERE id = NEW.id;
+        END
+        """,
+    ]),
+    (9, "Outbox уведомлений", [
+        # Уведомления пишутся в одной транзакции с заказом и рассылаются
+        # outbox.py; одна строка - одно сообщение одному получателю
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedup_key TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP,
+            UNIQUE (dedup_key, chat_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(next_attempt_at) WHERE status = 'pending'",
+    ]),
+    (10, "Сверка платежей с ЮKassa", [
+        "ALTER TABLE payments ADD COLUMN order_id INTEGER",
+        "ALTER TABLE payments ADD COLUMN fulfilled_at TIMESTAMP",
+        "ALTER TABLE payments ADD COLUMN check_attempts INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE payments ADD COLUMN next_check_at TIMESTAMP",
+        "DROP INDEX IF EXISTS idx_payments_status",
+        "CREATE INDEX IF NOT EXISTS idx_payments_status_check ON payments(status, next_check_at)",
+    ]),
+    (11, "Ключи идемпотентности платежей", [
+        "ALTER TABLE payments ADD COLUMN idempotency_key TEXT",
+        "ALTER TABLE payments ADD COLUMN confirmation_url TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_idempotency ON payments(idempotency_key)",
+    ]),
+    (12, "Очередь фискальных чеков", [
+        # Задание пишется в одной транзакции с выполнением платежа и
+        # обрабатывается receipts.py; одно задание - один чек на платёж
+        """
+        CREATE TABLE IF NOT EXISTS receipt_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payment_id TEXT UNIQUE NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_error TEXT,
+            receipt_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            done_at TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_receipt_jobs_pending ON receipt_jobs(next_attempt_at) WHERE status = 'pending'",
+    ]),
+    (13, "Причина неудачи платежа", [
+        # Оплаченный, но не выполненный платёж (fulfill_failed) или брошенный сверкой (expired)
+        "ALTER TABLE payments ADD COLUMN last_error TEXT",
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _backfill_order_items(conn: sqlite3.Connection):
+    """Переносит товары из JSON в orders.items в таблицу order_items"""
+    rows = conn.execute("""
+        SELECT id, items FROM orders
+        WHERE id NOT IN (SELECT DISTINCT order_id FROM order_items)
+    """).fetchall()
+
+    order_items = []
+    for order_id, items_json in rows:
+        try:
+            items = json.loads(items_json) or []
+        except (TypeError, ValueError) as e:
+            print(f"⚠️ Заказ #{order_id}: не удалось разобрать items ({e})")
+            continue
+        for item in items:
+            order_items.append((order_id, item.get('id'), item.get('name') or '',
+                                item.get('price') or 0, item.get('quantity') or 1))
+
+    conn.executemany("""
+        INSERT INTO order_items (order_id, product_id, name, price, quantity)
+        VALUES (?, ?, ?, ?, ?)
+    """, order_items)
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """Текущая версия схемы (0 для новой базы)"""
+    try:
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] or 0
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Применяет недостающие миграции, возвращает их количество"""
+    if get_schema_version(conn) >= LATEST_VERSION:
+        return 0
+
+    applied = 0
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    for version, description, steps in MIGRATIONS:
+        # BEGIN IMMEDIATE: второй процесс дождётся и не применит миграцию повторно
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"✅ Миграция {version}: {description}")
+        applied += 1
+    return applied
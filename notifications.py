@@ -0,0 +1,83 @@
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Iterable, Set
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+import outbound
+from config import ADMINS, NOTIFY_MAX_ATTEMPTS, NOTIFY_RETRY_DELAY, NOTIFY_DEAD_LETTER_PATH
+
+logger = logging.getLogger(__name__)
+
+# Рассылка уведомлений администраторам в фоне: обработчик покупателя не ждёт
+# доставки. Каждому получателю - свои повторы, неотправленное пишется в
+# NOTIFY_DEAD_LETTER_PATH (JSON на строку), чтобы его можно было разобрать вручную.
+_tasks: Set[asyncio.Task] = set()
+_stats = {"sent": 0, "retries": 0, "dead": 0}
+
+
+def notify_admins(bot, message_text: str, parse_mode: str = "HTML") -> asyncio.Task:
+    """Запускает рассылку всем администраторам и сразу возвращает управление"""
+    return notify(bot, ADMINS, message_text, parse_mode)
+
+
+def notify(bot, chat_ids: Iterable[int], message_text: str, parse_mode: str = "HTML") -> asyncio.Task:
+    """Фоновая рассылка сообщения списку получателей"""
+    task = asyncio.create_task(_fan_out(bot, list(chat_ids), message_text, parse_mode))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+async def _fan_out(bot, chat_ids, message_text: str, parse_mode: str):
+    with outbound.priority(outbound.NOTIFY):
+        await asyncio.gather(*(_deliver(bot, chat_id, message_text, parse_mode) for chat_id in chat_ids))
+
+
+async def _deliver(bot, chat_id: int, message_text: str, parse_mode: str):
+    for attempt in range(1, NOTIFY_MAX_ATTEMPTS + 1):
+        try:
+            await bot.send_message(chat_id, message_text, parse_mode=parse_mode)
+            _stats["sent"] += 1
+            return
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Бот заблокирован или текст не принят - повтор не поможет
+            _dead_letter(chat_id, message_text, e, attempt)
+            return
+        except Exception as e:
+            if attempt == NOTIFY_MAX_ATTEMPTS:
+                _dead_letter(chat_id, message_text, e, attempt)
+                return
+            _stats["retries"] += 1
+            delay = NOTIFY_RETRY_DELAY * 2 ** (attempt - 1)
+            logger.warning(f"Уведомление для {chat_id} не отправлено ({e}), повтор через {delay} с")
+            await asyncio.sleep(delay)
+
+
+def _dead_letter(chat_id: int, message_text: str, error: Exception, attempts: int):
+    _stats["dead"] += 1
+    logger.error(f"Не удалось отправить уведомление {chat_id} после {attempts} попыток: {error}")
+    record = {
+        "time": datetime.now().isoformat(),
+        "chat_id": chat_id,
+        "attempts": attempts,
+        "error": f"{type(error).__name__}: {error}",
+        "text": message_text,
+    }
+    try:
+        with open(NOTIFY_DEAD_LETTER_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError as e:
+        logger.error(f"Не удалось записать неотправленное уведомление: {e}")
+
+
+def get_stats() -> dict:
+    return dict(_stats, pending=len(_tasks))
+
+
+async def drain(timeout: float = 10):
+    """Даёт начатым рассылкам завершиться при остановке бота"""
+    if _tasks:
+        await asyncio.wait(set(_tasks), timeout=timeout)
@@ -0,0 +1,251 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import (SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_GROUP_RATE_PER_MIN,
+                    SEND_MAX_RETRIES)
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета исходящих сообщений: меньше - важнее
+PAYMENT = 0   # подтверждения оплаты, сертификаты
+DEFAULT = 1   # обычные ответы пользователю
+NOTIFY = 2    # уведомления администраторам
+CATALOG = 3   # массовые карточки товаров и списки
+
+PRIORITY_NAMES = {PAYMENT: "payment", DEFAULT: "default", NOTIFY: "notify", CATALOG: "catalog"}
+
+_priority = contextvars.ContextVar("send_priority", default=DEFAULT)
+
+# Методы Bot API, которые Telegram ограничивает как отправку сообщений
+_LIMITED_PREFIXES = ("send", "copy", "forward", "edit")
+
+
+@contextmanager
+def priority(level: int):
+    """Все отправки внутри блока идут с приоритетом level"""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class PriorityMiddleware(BaseMiddleware):
+    """Обработчик с флагом send_priority отправляет всё с этим приоритетом:
+    @router.callback_query(..., flags={"send_priority": outbound.PAYMENT})
+    """
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any,
+                       data: Dict[str, Any]) -> Any:
+        level = get_flag(data, "send_priority")
+        if level is None:
+            return await handler(event, data)
+        with priority(level):
+            return await handler(event, data)
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен (0 - уже доступен)"""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.paused_until
+
+
+class _Waiter:
+    __slots__ = ("key", "chat_id", "future", "queued_at")
+
+    def __init__(self, key, chat_id, future):
+        self.key = key
+        self.chat_id = chat_id
+        self.future = future
+        self.queued_at = time.monotonic()
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """Планировщик исходящих запросов к Bot API.
+
+    Подключается middleware к сессии бота, поэтому через него проходят все
+    отправки. Общее ведро ограничивает бота целиком, ведро на чат - каждый
+    чат. Из ожидающих первым выпускается самый приоритетный запрос, чьё
+    ведро чата не пусто. Ответ 429 приостанавливает чат на retry_after
+    секунд, после чего запрос повторяется.
+    """
+
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self):
+        self._global = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        self._chats: Dict[object, TokenBucket] = {}
+        self._waiters = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {
+            "acquired": 0, "sent": 0, "retry_after": 0, "failed": 0,
+            "max_depth": 0, "wait_total": 0.0, "wait_max": 0.0,
+        }
+
+    async def __call__(self, make_request, bot, method):
+        if not method.__api_method__.startswith(_LIMITED_PREFIXES):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        level = _priority.get()
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            await self._acquire(chat_id, level)
+            try:
+                result = await make_request(bot, method)
+                self._stats["sent"] += 1
+                return result
+            except TelegramRetryAfter as e:
+                self._stats["retry_after"] += 1
+                logger.warning(f"Telegram просит подождать {e.retry_after} с ({method.__api_method__}, чат {chat_id})")
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self._global
+                bucket.pause(e.retry_after)
+                if attempt == SEND_MAX_RETRIES:
+                    self._stats["failed"] += 1
+                    raise
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                now = time.monotonic()
+                for idle_id in [cid for cid, b in self._chats.items() if b.idle(now)]:
+                    del self._chats[idle_id]
+            # Группы Telegram ограничивает сильнее, чем личные чаты
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(SEND_GROUP_RATE_PER_MIN / 60, 1)
+            else:
+                bucket = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id, level: int):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch())
+
+        waiter = _Waiter((level, next(self._seq)), chat_id, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self._stats["max_depth"] = max(self._stats["max_depth"], len(self._waiters))
+        self._wakeup.set()
+        await waiter.future
+
+        waited = time.monotonic() - waiter.queued_at
+        self._stats["acquired"] += 1
+        self._stats["wait_total"] += waited
+        self._stats["wait_max"] = max(self._stats["wait_max"], waited)
+
+    async def _dispatch(self):
+        """Выпускает ожидающие запросы по мере появления токенов"""
+        while True:
+            self._waiters = [w for w in self._waiters if not w.future.done()]
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            sleep_for = self._global.delay(now)
+            best = None
+            if sleep_for == 0:
+                sleep_for = float("inf")
+                for waiter in self._waiters:
+                    delay = 0.0 if waiter.chat_id is None else self._chat_bucket(waiter.chat_id).delay(now)
+                    if delay == 0:
+                        if best is None or waiter.key < best.key:
+                            best = waiter
+                    else:
+                        sleep_for = min(sleep_for, delay)
+
+            if best is not None:
+                self._global.take(now)
+                if best.chat_id is not None:
+                    self._chat_bucket(best.chat_id).take(now)
+                self._waiters.remove(best)
+                best.future.set_result(None)
+                continue
+
+            # Новый запрос может прийти в свободный чат - просыпаемся и по нему
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=sleep_for)
+            except asyncio.TimeoutError:
+                pass
+
+    def get_stats(self) -> dict:
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for waiter in self._waiters:
+            if not waiter.future.done():
+                depth[PRIORITY_NAMES.get(waiter.key[0], str(waiter.key[0]))] += 1
+        granted = self._stats["acquired"]
+        return {
+            "queued": sum(depth.values()),
+            "depth": depth,
+            "max_depth": self._stats["max_depth"],
+            "sent": self._stats["sent"],
+            "retry_after": self._stats["retry_after"],
+            "failed": self._stats["failed"],
+            "avg_wait_ms": round(self._stats["wait_total"] / granted * 1000, 1) if granted else 0.0,
+            "max_wait_ms": round(self._stats["wait_max"] * 1000, 1),
+            "chats": len(self._chats),
+        }
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for waiter in self._waiters:
+            if not waiter.future.done():
+                waiter.future.cancel()
+        self._waiters = []
+
+
+scheduler = SendScheduler()
+
+
+def install(bot):
+    """Пускает все запросы бота через общий планировщик"""
+    if scheduler not in bot.session.middleware:
+        bot.session.middleware(scheduler)
+    return bot
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+import async_db as adb
+import outbound
+from config import OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_DELAY
+
+logger = logging.getLogger(__name__)
+
+# Outbox уведомлений: database.py пишет строки outbox в той же транзакции,
+# что и заказ, а диспетчер здесь рассылает их пакетами. Строка помечается
+# отправленной только после ответа Telegram, поэтому после падения бота
+# уведомление уйдёт повторно (at-least-once); повторная постановка того же
+# события отсекается уникальным (dedup_key, chat_id).
+
+# Вид уведомления -> функция payload -> (текст, клавиатура) или None, если отправлять нечего
+_renderers: Dict[str, Callable] = {}
+
+# Приоритет отправки по виду уведомления
+PRIORITIES = {"new_order": outbound.NOTIFY, "order_status": outbound.DEFAULT, "payment_fulfilled": outbound.PAYMENT,
+              "payment_failed": outbound.NOTIFY}
+
+CLEANUP_INTERVAL = 3600
+
+
+def renderer(kind: str):
+    """Регистрирует функцию, которая превращает payload уведомления в сообщение"""
+    def decorator(func):
+        _renderers[kind] = func
+        return func
+    return decorator
+
+
+class OutboxDispatcher:
+    def __init__(self):
+        self.bot = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_cleanup = 0.0
+        self._stats = {"batches": 0, "sent": 0, "retried": 0, "dead": 0}
+
+    def start(self, bot):
+        """Запускает фоновую рассылку outbox"""
+        self.bot = bot
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            rows = []
+            try:
+                rows = await adb.get_due_outbox(OUTBOX_BATCH_SIZE)
+                if rows:
+                    await self._dispatch(rows)
+                if time.monotonic() - self._last_cleanup > CLEANUP_INTERVAL:
+                    self._last_cleanup = time.monotonic()
+                    await adb.cleanup_outbox()
+            except Exception as e:
+                logger.error(f"Ошибка рассылки outbox: {e}")
+
+            # Полный пакет - за ним, скорее всего, есть ещё
+            if len(rows) == OUTBOX_BATCH_SIZE:
+                continue
+            await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+    async def _dispatch(self, rows):
+        results = await asyncio.gather(*(self._send(row) for row in rows))
+        sent_ids, failures = [], []
+        for row, failure in zip(rows, results):
+            if failure is None:
+                sent_ids.append(row['id'])
+            else:
+                failures.append(failure)
+        await adb.finish_outbox_batch(sent_ids, failures)
+
+        self._stats["batches"] += 1
+        self._stats["sent"] += len(sent_ids)
+
+    async def _send(self, row) -> Optional[tuple]:
+        """Отправляет одно уведомление; None - успех, иначе (id, ошибка, пауза перед повтором)"""
+        render = _renderers.get(row['kind'])
+        if render is None:
+            return self._dead(row, f"нет обработчика для вида {row['kind']}")
+
+        try:
+            message = render(row['payload'])
+        except Exception as e:
+            # Битый payload не должен задерживать остальные строки пакета
+            return self._dead(row, f"ошибка подготовки сообщения: {e}")
+        if message is None:
+            return None
+        text, reply_markup = message
+
+        with outbound.priority(PRIORITIES.get(row['kind'], outbound.DEFAULT)):
+            try:
+                await self.bot.send_message(row['chat_id'], text, reply_markup=reply_markup, parse_mode="HTML")
+                return None
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Бот заблокирован или сообщение не принято - повтор не поможет
+                return self._dead(row, str(e))
+            except Exception as e:
+                if row['attempts'] + 1 >= OUTBOX_MAX_ATTEMPTS:
+                    return self._dead(row, str(e))
+                self._stats["retried"] += 1
+                delay = OUTBOX_RETRY_DELAY * 2 ** row['attempts']
+                logger.warning(f"Уведомление {row['dedup_key']} для {row['chat_id']} не отправлено ({e}), "
+                               f"повтор через {delay:.0f} с")
+                return row['id'], str(e), delay
+
+    def _dead(self, row, error: str) -> tuple:
+        self._stats["dead"] += 1
+        logger.error(f"Уведомление {row['dedup_key']} для {row['chat_id']} не доставлено: {error}")
+        return row['id'], error, None
+
+    def get_stats(self) -> dict:
+        return dict(self._stats)
+
+
+dispatcher = OutboxDispatcher()
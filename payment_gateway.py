@@ -0,0 +1,255 @@
+import asyncio
+import bisect
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from yookassa import Configuration, Payment, Receipt
+from yookassa.domain.exceptions import (AuthorizeError, BadRequestError, ForbiddenError, NotFoundError,
+                                        UnauthorizedError)
+
+from config import (YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, YOOKASSA_API_URL, YOOKASSA_POOL_SIZE, YOOKASSA_TIMEOUT,
+                    YOOKASSA_TIMEOUT_MIN, YOOKASSA_TIMEOUT_FACTOR, YOOKASSA_BREAKER_FAILURES,
+                    YOOKASSA_BREAKER_COOLDOWN)
+
+logger = logging.getLogger(__name__)
+
+# Настройка ЮKassa
+Configuration.account_id = YOOKASSA_SHOP_ID
+Configuration.secret_key = YOOKASSA_SECRET_KEY
+Configuration.api_url = YOOKASSA_API_URL
+
+# Ошибки в самом запросе: ЮKassa ответила, значит она работает
+_CLIENT_ERRORS = (BadRequestError, ForbiddenError, NotFoundError, UnauthorizedError, AuthorizeError)
+
+# Границы корзин гистограммы задержек, мс
+LATENCY_BUCKETS_MS = (100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class PaymentGatewayError(Exception):
+    """ЮKassa не ответила вовремя или все подключения заняты"""
+
+
+class PaymentGatewayUnavailable(PaymentGatewayError):
+    """ЮKassa отключена автоматом после серии ошибок - запрос не отправлялся"""
+
+
+class CircuitBreaker:
+    """Автомат защиты: после failure_threshold ошибок подряд размыкается, и
+    запросы сразу получают отказ. Через recovery_time секунд пропускает один
+    пробный запрос (half_open): успех замыкает автомат, ошибка - снова размыкает.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int, recovery_time: float):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened_count = 0
+        self._probe_started = None
+
+    def available(self) -> bool:
+        """Пропустит ли автомат запрос прямо сейчас (без захвата пробы)"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= self.recovery_time
+        return not self._probing()
+
+    def _probing(self) -> bool:
+        # Проба, прерванная отменой обработчика, не держит автомат вечно
+        return self._probe_started is not None and time.monotonic() - self._probe_started < self.recovery_time
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.recovery_time:
+            self.state = self.HALF_OPEN
+            self._probe_started = None
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self._probing():
+            self._probe_started = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("ЮKassa снова отвечает, автомат замкнут")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opened_count += 1
+                logger.warning(f"ЮKassa отключена на {self.recovery_time:g} с после {self.failures} ошибок подряд")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probe_started = None
+
+
+class LatencyTracker:
+    """Задержки одного метода: гистограмма с запуска и последние замеры для перцентилей"""
+
+    MIN_SAMPLES = 20
+
+    def __init__(self, window: int = 200):
+        self.samples = deque(maxlen=window)
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def timeout(self) -> float:
+        """p99 × YOOKASSA_TIMEOUT_FACTOR в пределах [YOOKASSA_TIMEOUT_MIN, YOOKASSA_TIMEOUT]"""
+        if len(self.samples) < self.MIN_SAMPLES:
+            return YOOKASSA_TIMEOUT
+        adaptive = self.percentile(0.99) * YOOKASSA_TIMEOUT_FACTOR
+        return min(YOOKASSA_TIMEOUT, max(YOOKASSA_TIMEOUT_MIN, adaptive))
+
+
+class YooKassaGateway:
+    """Асинхронная обёртка над синхронным SDK ЮKassa.
+
+    Запросы SDK выполняются в отдельном пуле потоков, поэтому не блокируют
+    цикл событий бота. Одновременно выполняется не больше YOOKASSA_POOL_SIZE
+    запросов; каждый вызов (ожидание места в пуле и сам запрос) ограничен
+    таймаутом. SDK не умеет прерывать HTTP-запрос, поэтому зависший запрос
+    занимает своё место в пуле, пока не завершится, - остальные вызовы в это
+    время получают PaymentGatewayError, а не копятся в очереди.
+
+    Таймаут метода подстраивается под его недавние задержки (p99), а после
+    серии ошибок автомат защиты отключает ЮKassa: вызовы сразу получают
+    PaymentGatewayUnavailable, и бот предлагает другие способы оплаты.
+    """
+
+    def __init__(self, max_workers: int, timeout: float):
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(YOOKASSA_BREAKER_FAILURES, YOOKASSA_BREAKER_COOLDOWN)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="yookassa")
+        self._max_workers = max_workers
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._in_flight = 0
+        self._latency: Dict[str, LatencyTracker] = {}
+        self._stats = {"calls": 0, "errors": 0, "timeouts": 0, "busy": 0, "rejected": 0, "time_total": 0.0}
+
+    def available(self) -> bool:
+        """Можно ли сейчас рассчитывать на ЮKassa (автомат не разомкнут)"""
+        return self.breaker.available()
+
+    def _tracker(self, name: str) -> LatencyTracker:
+        if name not in self._latency:
+            self._latency[name] = LatencyTracker()
+        return self._latency[name]
+
+    async def _call(self, name: str, func, *args, timeout: float = None):
+        if not self.breaker.allow():
+            self._stats["rejected"] += 1
+            raise PaymentGatewayUnavailable(f"ЮKassa временно отключена ({name})")
+
+        tracker = self._tracker(name)
+        timeout = timeout or min(self.timeout, tracker.timeout())
+        loop = asyncio.get_running_loop()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._max_workers)
+
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self._stats["busy"] += 1
+            self.breaker.record_failure()
+            raise PaymentGatewayError(f"ЮKassa: нет свободных подключений для {name}")
+
+        # Место в пуле освобождается, только когда поток действительно закончил
+        self._in_flight += 1
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+
+        try:
+            remaining = timeout - (time.monotonic() - started)
+            result = await asyncio.wait_for(asyncio.wrap_future(future), remaining)
+            tracker.observe(time.monotonic() - started)
+            self.breaker.record_success()
+            return result
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            self.breaker.record_failure()
+            raise PaymentGatewayError(f"ЮKassa не ответила за {timeout:g} с ({name})")
+        except (ValueError, TypeError):
+            # SDK отверг данные до отправки запроса - о ЮKassa это ничего не говорит
+            self._stats["errors"] += 1
+            raise
+        except _CLIENT_ERRORS:
+            self._stats["errors"] += 1
+            tracker.observe(time.monotonic() - started)
+            self.breaker.record_success()
+            raise
+        except Exception:
+            self._stats["errors"] += 1
+            self.breaker.record_failure()
+            raise
+        finally:
+            self._stats["calls"] += 1
+            self._stats["time_total"] += time.monotonic() - started
+
+    def _release(self):
+        self._in_flight -= 1
+        self._slots.release()
+
+    async def create_payment(self, params: dict, idempotency_key: str = None, timeout: float = None):
+        """Создаёт платёж (Payment.create)"""
+        return await self._call("create_payment", Payment.create, params, idempotency_key, timeout=timeout)
+
+    async def find_payment(self, payment_id: str, timeout: float = None):
+        """Получает платёж по ID (Payment.find_one)"""
+        return await self._call("find_payment", Payment.find_one, payment_id, timeout=timeout)
+
+    async def create_receipt(self, params: dict, idempotency_key: str = None, timeout: float = None):
+        """Создаёт чек (Receipt.create)"""
+        return await self._call("create_receipt", Receipt.create, params, idempotency_key, timeout=timeout)
+
+    def get_stats(self) -> dict:
+        calls = self._stats["calls"]
+        latency = {}
+        for name, tracker in self._latency.items():
+            p50, p99 = tracker.percentile(0.5), tracker.percentile(0.99)
+            latency[name] = {
+                "histogram": dict(zip([f"≤{b}" for b in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}"],
+                                      tracker.histogram)),
+                "p50_ms": round(p50 * 1000) if p50 is not None else None,
+                "p99_ms": round(p99 * 1000) if p99 is not None else None,
+                "timeout_s": round(min(self.timeout, tracker.timeout()), 1),
+            }
+        return {
+            "calls": calls,
+            "errors": self._stats["errors"],
+            "timeouts": self._stats["timeouts"],
+            "busy": self._stats["busy"],
+            "rejected": self._stats["rejected"],
+            "in_flight": self._in_flight,
+            "avg_ms": round(self._stats["time_total"] / calls * 1000, 1) if calls else 0.0,
+            "breaker": self.breaker.state,
+            "breaker_failures": self.breaker.failures,
+            "breaker_opened": self.breaker.opened_count,
+            "latency": latency,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+gateway = YooKassaGateway(YOOKASSA_POOL_SIZE, YOOKASSA_TIMEOUT)
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import time
+from typing import Dict
+
+import async_db as adb
+from config import (RECONCILE_INTERVAL, RECONCILE_BATCH_SIZE, RECONCILE_CONCURRENCY, RECONCILE_RATE,
+                    RECONCILE_BASE_DELAY, RECONCILE_MAX_DELAY, RECONCILE_MAX_ATTEMPTS)
+from outbound import TokenBucket
+from payment_gateway import gateway
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentReconciler:
+    """Сверка платежей в статусе pending с ЮKassa.
+
+    Берёт из payments пачку платежей, которые пора проверить, и опрашивает
+    ЮKassa параллельно (не больше RECONCILE_CONCURRENCY запросов сразу и не
+    чаще RECONCILE_RATE в секунду). Оплаченный платёж выполняется через
+    fulfill_payment - заказ или сертификат создаются один раз, даже если
+    покупатель одновременно нажал «Проверить оплату». Неоплаченный платёж
+    откладывается с экспоненциально растущей паузой, а после
+    RECONCILE_MAX_ATTEMPTS проверок помечается expired с уведомлением админам.
+    Оплаченный, но невыполнимый платёж fulfill_payment сам переводит в
+    fulfill_failed - больше он не проверяется.
+    """
+
+    def __init__(self):
+        self._bucket = TokenBucket(RECONCILE_RATE, RECONCILE_RATE)
+        self._semaphore = None
+        self._stats = {
+            "runs": 0, "checked": 0, "fulfilled": 0, "canceled": 0, "failed": 0, "expired": 0, "errors": 0,
+            "last_run_at": None, "last_batch": 0, "last_batch_sec": 0.0,
+        }
+
+    async def run_forever(self):
+        while True:
+            checked = 0
+            try:
+                checked = await self.run_once()
+            except Exception as e:
+                logger.error(f"Pending payments check failed: {e}")
+            # Полная пачка - наверняка есть ещё платежи к сверке
+            if checked < RECONCILE_BATCH_SIZE:
+                await asyncio.sleep(RECONCILE_INTERVAL)
+
+    async def run_once(self) -> int:
+        """Одна пачка сверки; возвращает число проверенных платежей"""
+        payments = await adb.get_payments_to_check(RECONCILE_BATCH_SIZE)
+        if not payments:
+            return 0
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+        started = time.monotonic()
+        await asyncio.gather(*(self._check(payment) for payment in payments))
+
+        self._stats["runs"] += 1
+        self._stats["last_run_at"] = time.time()
+        self._stats["last_batch"] = len(payments)
+        self._stats["last_batch_sec"] = time.monotonic() - started
+        return len(payments)
+
+    async def _throttle(self):
+        while True:
+            delay = self._bucket.delay(time.monotonic())
+            if delay == 0:
+                self._bucket.take(time.monotonic())
+                return
+            await asyncio.sleep(delay)
+
+    async def _check(self, payment: Dict):
+        payment_id = payment['payment_id']
+        async with self._semaphore:
+            await self._throttle()
+            try:
+                remote = await gateway.find_payment(payment_id)
+                status = remote.status
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.warning(f"Не удалось проверить платёж {payment_id}: {e}")
+                status = None
+        self._stats["checked"] += 1
+
+        if status == 'succeeded':
+            result = await adb.fulfill_payment(payment_id)
+            if result is not None and result['failed']:
+                self._stats["failed"] += 1
+                logger.error(f"Платёж {payment_id} оплачен, но не выполнен: {result['error']}")
+                return
+            if result is not None:
+                self._stats["fulfilled"] += 1
+                logger.info(f"Платёж {payment_id} выполнен сверкой: {result}")
+                return
+            self._stats["errors"] += 1
+        elif status == 'canceled':
+            self._stats["canceled"] += 1
+            await adb.update_payment_status(payment_id, 'canceled')
+            return
+
+        if payment['check_attempts'] + 1 >= RECONCILE_MAX_ATTEMPTS:
+            self._stats["expired"] += 1
+            logger.error(f"Платёж {payment_id} не подтверждён за {RECONCILE_MAX_ATTEMPTS} проверок (статус {status})")
+            await adb.fail_payment(payment_id, 'expired',
+                                   f"не подтверждён за {RECONCILE_MAX_ATTEMPTS} проверок, статус ЮKassa: {status}")
+            return
+
+        # pending, waiting_for_capture или ошибка - проверим позже
+        delay = min(RECONCILE_MAX_DELAY, RECONCILE_BASE_DELAY * 2 ** payment['check_attempts'])
+        await adb.schedule_payment_check(payment_id, delay)
+
+    def get_stats(self) -> dict:
+        stats = dict(self._stats)
+        batch_sec = stats.pop("last_batch_sec")
+        stats["per_second"] = round(stats["last_batch"] / batch_sec, 1) if batch_sec else 0.0
+        return stats
+
+
+reconciler = PaymentReconciler()
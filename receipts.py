@@ -1,9 +1,15 @@
 import asyncio
-import logging
-from yookassa import Receipt
-from config import YOOKASSA_TAX_RATE, YOOKASSA_TAX_SYSTEM
-from database import get_payment
 import json
+import logging
+import time
+from typing import Optional
+
+import async_db as adb
+from config import (YOOKASSA_TAX_RATE, YOOKASSA_TAX_SYSTEM, RECEIPT_BATCH_SIZE, RECEIPT_POLL_INTERVAL,
+                    RECEIPT_RATE, RECEIPT_MAX_ATTEMPTS, RECEIPT_RETRY_DELAY, RECEIPT_MAX_DELAY)
+from outbound import TokenBucket
+from payment_gateway import gateway, PaymentGatewayUnavailable
+from yookassa.domain.exceptions import BadRequestError, ForbiddenError
 
 logger = logging.getLogger(__name__)
 
@@ -12,9 +18,71 @@ class ReceiptManager:
     def __init__(self):
         self.default_email = "client@example.com"
 
+    def build_receipt(self, payment_id: str, amount: float, metadata: dict, user_email: str = None,
+                      description: str = None) -> dict:
+        """Данные чека прихода по сохранённому платежу"""
+        # Prepare items
+        items = []
+        if metadata.get("type") == "order":
+            cart_items = metadata.get("cart_items", [])
+            for i in cart_items:
+                items.append({
+                    "description": i.get("name", "")[:128],
+                    "quantity": f"{int(i.get('quantity', 1)):.2f}",
+                    "amount": {"value": f"{float(i.get('price', 0)):.2f}", "currency": "RUB"},
+                    "vat_code": int(YOOKASSA_TAX_RATE),
+                    "payment_mode": "full_payment",
+                    "payment_subject": "commodity"
+                })
+            delivery_cost = float(metadata.get("delivery_cost", 0))
+            if delivery_cost > 0:
+                items.append({
+                    "description": "Доставка",
+                    "quantity": "1.00",
+                    "amount": {"value": f"{delivery_cost:.2f}", "currency": "RUB"},
+                    "vat_code": int(YOOKASSA_TAX_RATE),
+                    "payment_mode": "full_payment",
+                    "payment_subject": "service"
+                })
+        elif metadata.get("type") == "certificate":
+            items.append({
+                "description": f"Подарочный сертификат {metadata.get('cert_code', '')}"[:128],
+                "quantity": "1.00",
+                "amount": {"value": f"{float(amount):.2f}", "currency": "RUB"},
+                "vat_code": int(YOOKASSA_TAX_RATE),
+                "payment_mode": "full_payment",
+                "payment_subject": "service"
+            })
+
+        # Скидка и бонусы уменьшают оплату - тогда чек одной позицией на сумму платежа
+        items_total = sum(float(i["quantity"]) * float(i["amount"]["value"]) for i in items)
+        if not items or abs(items_total - float(amount)) >= 0.01:
+            items = [{
+                "description": (description or f"Оплата заказа {payment_id}")[:128],
+                "quantity": "1.00",
+                "amount": {"value": f"{float(amount):.2f}", "currency": "RUB"},
+                "vat_code": int(YOOKASSA_TAX_RATE),
+                "payment_mode": "full_payment",
+                "payment_subject": "commodity"
+            }]
+
+        customer = {"email": user_email or metadata.get("email") or self.default_email}
+        if not (user_email or metadata.get("email")) and metadata.get("phone"):
+            customer = {"phone": metadata["phone"]}
+
+        return {
+            "type": "payment",
+            "payment_id": payment_id,
+            "customer": customer,
+            "items": items,
+            "settlements": [{"type": "cashless", "amount": {"value": f"{float(amount):.2f}", "currency": "RUB"}}],
+            "tax_system_code": int(YOOKASSA_TAX_SYSTEM),
+            "send": True
+        }
+
     async def create_receipt(self, payment_id: str, user_email: str = None) -> bool:
         try:
-            payment_info = get_payment(payment_id)
+            payment_info = await adb.get_payment(payment_id)
             if not payment_info:
                 logger.error("Payment not found for receipt")
                 return False
@@ -23,53 +91,9 @@ class ReceiptManager:
             if isinstance(metadata, str):
                 metadata = json.loads(metadata) if metadata else {}
 
-            # Prepare items
-            items = []
-            if metadata.get("type") == "order":
-                cart_items = metadata.get("cart_items", [])
-                for i in cart_items:
-                    items.append({
-                        "description": i.get("name", "")[:128],
-                        "quantity": f"{int(i.get('quantity', 1)):.2f}",
-                        "amount": {"value": f"{float(i.get('price', 0)):.2f}", "currency": "RUB"},
-                        "vat_code": YOOKASSA_TAX_RATE,
-                        "payment_mode": "full_payment",
-                        "payment_subject": "commodity"
-                    })
-                delivery_cost = float(metadata.get("delivery_cost", 0))
-                if delivery_cost > 0:
-                    items.append({
-                        "description": "Доставка",
-                        "quantity": "1.00",
-                        "amount": {"value": f"{delivery_cost:.2f}", "currency": "RUB"},
-                        "vat_code": YOOKASSA_TAX_RATE,
-                        "payment_mode": "full_payment",
-                        "payment_subject": "service"
-                    })
-            elif metadata.get("type") == "certificate":
-                items.append({
-                    "description": f"Подарочный сертификат {metadata.get('cert_code', '')}"[:128],
-                    "quantity": "1.00",
-                    "amount": {"value": f"{float(payment_info['amount']):.2f}", "currency": "RUB"},
-                    "vat_code": YOOKASSA_TAX_RATE,
-                    "payment_mode": "full_payment",
-                    "payment_subject": "service"
-                })
-
-            receipt_data = {
-                "type": "payment",
-                "payment_id": payment_id,
-                "customer": {"email": user_email or metadata.get("email") or self.default_email},
-                "items": items,
-                "tax_system_code": YOOKASSA_TAX_SYSTEM,
-                "send": True
-            }
-
-            # blocking -> thread
-            def create_call():
-                return Receipt.create(receipt_data)
-
-            receipt = await asyncio.to_thread(create_call)
+            receipt_data = self.build_receipt(payment_id, payment_info['amount'], metadata or {}, user_email,
+                                              payment_info.get('description'))
+            receipt = await gateway.create_receipt(receipt_data, f"receipt:{payment_id}")
             logger.info(f"Receipt created {receipt.id} for payment {payment_id}")
             return True
         except Exception as e:
@@ -77,4 +101,104 @@ class ReceiptManager:
             return False
 
 
+class ReceiptWorker:
+    """Фоновая очередь фискальных чеков (режим YOOKASSA_RECEIPT_MODE=deferred).
+
+    fulfill_payment ставит задание в receipt_jobs в той же транзакции, что и
+    заказ, а здесь чеки создаются пакетами, не чаще RECEIPT_RATE в секунду.
+    Ключ идемпотентности - ID платежа, поэтому повтор после таймаута не
+    пробьёт второй чек. Ошибка откладывает задание с растущей паузой, после
+    RECEIPT_MAX_ATTEMPTS попыток или отказа ЮKassa в данных - 'dead'.
+    """
+
+    def __init__(self):
+        self._bucket = TokenBucket(RECEIPT_RATE, RECEIPT_RATE)
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {"batches": 0, "created": 0, "retried": 0, "dead": 0}
+
+    def start(self):
+        """Запускает фоновую обработку очереди чеков"""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            jobs = []
+            try:
+                # Пока ЮKassa отключена автоматом, задания просто ждут
+                if gateway.available():
+                    jobs = await adb.get_due_receipt_jobs(RECEIPT_BATCH_SIZE)
+                    if jobs:
+                        await self._process(jobs)
+            except Exception as e:
+                logger.error(f"Ошибка обработки очереди чеков: {e}")
+
+            # Полный пакет - за ним, скорее всего, есть ещё
+            if len(jobs) == RECEIPT_BATCH_SIZE:
+                continue
+            await asyncio.sleep(RECEIPT_POLL_INTERVAL)
+
+    async def _throttle(self):
+        while True:
+            delay = self._bucket.delay(time.monotonic())
+            if delay == 0:
+                self._bucket.take(time.monotonic())
+                return
+            await asyncio.sleep(delay)
+
+    async def _process(self, jobs):
+        results = await asyncio.gather(*(self._create(job) for job in jobs))
+        done, failures = [], []
+        for job, (receipt_id, failure) in zip(jobs, results):
+            if failure is None:
+                done.append((job['id'], receipt_id))
+            else:
+                failures.append(failure)
+        await adb.finish_receipt_jobs(done, failures)
+
+        self._stats["batches"] += 1
+        self._stats["created"] += len(done)
+
+    async def _create(self, job) -> tuple:
+        """Создаёт один чек; (receipt_id, None) - успех, иначе (None, (id, ошибка, пауза перед повтором))"""
+        if job['amount'] is None:
+            return None, self._dead(job, "платёж не найден")
+
+        await self._throttle()
+        try:
+            params = receipt_manager.build_receipt(job['payment_id'], job['amount'], job['metadata'],
+                                                   description=job['description'])
+            receipt = await gateway.create_receipt(params, f"receipt:{job['payment_id']}")
+            logger.info(f"Чек {receipt.id} создан по платежу {job['payment_id']}")
+            return receipt.id, None
+        except (BadRequestError, ForbiddenError, ValueError, TypeError) as e:
+            # Данные чека не приняты - повтор не поможет, нужен разбор вручную
+            return None, self._dead(job, str(e))
+        except Exception as e:
+            if job['attempts'] + 1 >= RECEIPT_MAX_ATTEMPTS:
+                return None, self._dead(job, str(e))
+            delay = min(RECEIPT_MAX_DELAY, RECEIPT_RETRY_DELAY * 2 ** job['attempts'])
+            if not isinstance(e, PaymentGatewayUnavailable):
+                self._stats["retried"] += 1
+                logger.warning(f"Чек по платежу {job['payment_id']} не создан ({e}), повтор через {delay:.0f} с")
+            return None, (job['id'], str(e), delay)
+
+    def _dead(self, job, error: str) -> tuple:
+        self._stats["dead"] += 1
+        logger.error(f"Чек по платежу {job['payment_id']} не создан: {error}")
+        return job['id'], error, None
+
+    def get_stats(self) -> dict:
+        return dict(self._stats)
+
+
 receipt_manager = ReceiptManager()
+worker = ReceiptWorker()
@@ -1,26 +1,67 @@
 import traceback
 
-from yookassa import Payment, Configuration
+import json
+import time
 import uuid
 import asyncio
-from typing import Optional
+from typing import Dict, Optional
 import logging
-from config import YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY
+import async_db as adb
+from config import PAYMENT_STATUS_TTL, YOOKASSA_RECEIPT_MODE
+from payment_gateway import gateway, PaymentGatewayUnavailable
 
 logger = logging.getLogger(__name__)
 
-# Настройка ЮKassa
-Configuration.account_id = YOOKASSA_SHOP_ID
-Configuration.secret_key = YOOKASSA_SECRET_KEY
+# Статусы, после которых платёж в ЮKassa уже не меняется
+FINAL_STATUSES = ('succeeded', 'canceled')
 
 
 class SimplePaymentManager:
     def __init__(self):
         self.retry_attempts = 3
-        self.retry_delay = 2
+        self.retry_delay = 0.5
+        self._status_cache: Dict[str, tuple] = {}
+        self._status_lookups: Dict[str, asyncio.Task] = {}
+        self._status_stats = {"checks": 0, "local": 0, "cached": 0, "coalesced": 0, "upstream": 0, "errors": 0}
 
-    async def create_payment(self, amount: int, description: str, metadata: dict) -> dict:
+    @staticmethod
+    def idempotency_key(user_id: int, checkout_id: str, kind: str, amount: int, items: list = None) -> str:
+        """Стабильный ключ попытки оформления: та же попытка, сумма и корзина дают тот же ключ"""
+        cart = sorted((item.get('id'), item.get('quantity')) for item in items or [])
+        source = json.dumps([user_id, checkout_id, kind, amount, cart])
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, source))
+
+    async def create_payment(self, amount: int, description: str, metadata: dict,
+                             idempotency_key: str = None, local_metadata: dict = None) -> dict:
+        """Создаёт платёж ЮKassa не больше одного раза на ключ идемпотентности.
+
+        Строка payments с ключом записывается до запроса, поэтому повторный
+        вызов с тем же ключом (повторное нажатие, повтор после таймаута)
+        возвращает уже созданный платёж, а не создаёт второй. local_metadata -
+        полные данные для выполнения платежа (в ЮKassa уходит сокращённая
+        metadata); в ответе они возвращаются как сохранены в первый раз.
+        """
         logger.info(f"Создание платежа: {amount} RUB, {description}")
+        # Один ключ на все попытки: повтор после таймаута не создаст второй платёж
+        idempotency_key = idempotency_key or str(uuid.uuid4())
+        local_metadata = local_metadata or metadata
+
+        stored = await adb.reserve_payment(idempotency_key, metadata.get("user_id", 0), amount,
+                                           description, local_metadata)
+        if stored["status"] != "creating":
+            logger.info(f"Платеж по ключу {idempotency_key} уже создан: {stored['payment_id']}")
+            return {
+                "id": stored["payment_id"],
+                "status": stored["status"],
+                "confirmation_url": stored["confirmation_url"],
+                "amount": amount,
+                "metadata": stored["metadata"]
+            }
+
+        # ЮKassa отключена автоматом - сразу предлагаем другой способ оплаты
+        if not gateway.available():
+            logger.warning("ЮKassa недоступна, платеж не создаётся")
+            return None
 
         for attempt in range(self.retry_attempts):
             try:
@@ -57,26 +98,88 @@ class SimplePaymentManager:
                     }
                 }
 
-                # Убираем receipt для очень маленьких сумм (менее 1 рубля)
-                if amount < 1:
+                # Убираем receipt для очень маленьких сумм (менее 1 рубля); в режиме
+                # deferred чек создаёт очередь receipts.py после оплаты
+                if amount < 1 or YOOKASSA_RECEIPT_MODE == "deferred":
                     payment_data.pop("receipt", None)
 
-                payment = Payment.create(payment_data)
+                payment = await gateway.create_payment(payment_data, idempotency_key)
 
                 logger.info(f"Платеж создан: {payment.id}, статус: {payment.status}")
 
+                confirmation_url = payment.confirmation.confirmation_url if payment.confirmation else None
+                await adb.attach_payment(idempotency_key, payment.id, payment.status, confirmation_url)
                 return {
                     "id": payment.id,
                     "status": payment.status,
-                    "confirmation_url": payment.confirmation.confirmation_url if payment.confirmation else None,
-                    "amount": amount
+                    "confirmation_url": confirmation_url,
+                    "amount": amount,
+                    "metadata": stored["metadata"]
                 }
+            except PaymentGatewayUnavailable as e:
+                logger.warning(f"Attempt {attempt + 1} rejected: {e}")
+                break
             except Exception as e:
                 logger.error(f"Attempt {attempt + 1} failed: {e}")
                 logger.error(traceback.format_exc())
-                if attempt < self.retry_attempts - 1:
-                    await asyncio.sleep(self.retry_delay)
+                # Ключ тот же, поэтому повтор безопасен; пауза растёт, пока автомат не разомкнётся
+                if attempt < self.retry_attempts - 1 and gateway.available():
+                    await asyncio.sleep(self.retry_delay * 2 ** attempt)
         return None
 
+    async def check_payment_status(self, payment_id: str) -> Optional[str]:
+        """Статус платежа: сначала из payments, затем из ЮKassa.
+
+        Окончательный статус из базы возвращается без запроса. Ответ ЮKassa
+        кэшируется на PAYMENT_STATUS_TTL секунд, а одновременные проверки
+        одного платежа ждут один общий запрос - сколько бы раз покупатель ни
+        нажал «Проверить оплату». None - статус узнать не удалось.
+        """
+        self._status_stats["checks"] += 1
+        local = await adb.get_payment(payment_id)
+        if local and local['fulfilled_at']:
+            self._status_stats["local"] += 1
+            return 'succeeded'
+        if local and local['status'] in FINAL_STATUSES:
+            self._status_stats["local"] += 1
+            return local['status']
+
+        cached = self._status_cache.get(payment_id)
+        if cached and cached[1] > time.monotonic():
+            self._status_stats["cached"] += 1
+            return cached[0]
+
+        task = self._status_lookups.get(payment_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch_status(payment_id, local is not None))
+            self._status_lookups[payment_id] = task
+            task.add_done_callback(lambda _: self._status_lookups.pop(payment_id, None))
+        else:
+            self._status_stats["coalesced"] += 1
+        # Отмена одного обработчика не должна отменять общий запрос
+        return await asyncio.shield(task)
+
+    async def _fetch_status(self, payment_id: str, is_local: bool) -> Optional[str]:
+        self._status_stats["upstream"] += 1
+        try:
+            payment = await gateway.find_payment(payment_id)
+        except Exception as e:
+            self._status_stats["errors"] += 1
+            logger.error(f"Не удалось получить статус платежа {payment_id}: {e}")
+            return None
+
+        now = time.monotonic()
+        if len(self._status_cache) > 1000:
+            self._status_cache = {pid: entry for pid, entry in self._status_cache.items() if entry[1] > now}
+        self._status_cache[payment_id] = (payment.status, now + PAYMENT_STATUS_TTL)
+
+        # succeeded в базу пишет только fulfill_payment - вместе с заказом
+        if is_local and payment.status == 'canceled':
+            await adb.update_payment_status(payment_id, 'canceled')
+        return payment.status
+
+    def get_status_stats(self) -> dict:
+        return dict(self._status_stats, in_flight=len(self._status_lookups))
+
 
 payment_manager = SimplePaymentManager()
@@ -1,23 +1,30 @@
 from aiogram import Router, F, Bot
-from aiogram.types import Message, CallbackQuery, FSInputFile
-from aiogram.filters import Command
+from aiogram.types import (Message, CallbackQuery, FSInputFile, InlineQuery, InlineQueryResultArticle,
+                           InputTextMessageContent, InputMediaPhoto)
+from aiogram.filters import Command, CommandObject
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from typing import Union, Optional, Dict, List
-import sqlite3
 from keyboards import *
 from database import *
 from certificates import *
 from config import *
-from yookassa import Configuration
 import os
-import json
+import html
 import uuid
-import sqlite3
 from aiogram.filters.state import StateFilter
 from certificates import CertificateState, generate_certificate
 from simple_payments import payment_manager
-from database import save_payment, update_payment_status, get_payment
+from payment_gateway import gateway
+import receipts
+import async_db as adb
+import catalog_cache
+import card_cache
+import outbound
+import notifications
+import outbox
+from payment_reconciler import reconciler
 import asyncio
 import logging
 import random
@@ -32,7 +39,7 @@ logging.basicConfig(level=logging.DEBUG)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=BOT_TOKEN)
+bot = outbound.install(Bot(token=BOT_TOKEN))
 
 # Список всех текстовых команд из меню
 MENU_COMMANDS = {
@@ -42,6 +49,8 @@ MENU_COMMANDS = {
 }
 
 router = Router()
+# Приоритет отправки задаётся флагом send_priority у обработчика
+router.callback_query.middleware(outbound.PriorityMiddleware())
 
 
 # --- FSM для оформления заказа ---
@@ -99,12 +108,8 @@ def is_admin(user_id: int) -> bool:
 
 
 async def notify_admins(message_text: str, parse_mode: str = "HTML"):
-    """Отправляет уведомление всем администраторам"""
-    for admin_id in ADMINS:
-        try:
-            await bot.send_message(admin_id, message_text, parse_mode=parse_mode)
-        except Exception as e:
-            print(f"Не удалось отправить сообщение админу {admin_id}: {e}")
+    """Отправляет уведомление всем администраторам в фоне, не дожидаясь доставки"""
+    notifications.notify_admins(bot, message_text, parse_mode)
 
 
 def get_payment_method_name(method_code):
@@ -123,14 +128,8 @@ async def debug_cart(user_id: int):
     """Отладка корзины — выводит содержимое в консоль"""
     logger.debug(f"=== DEBUG CART FOR USER {user_id} ===")
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cur = conn.cursor()
-            cur.execute(
-                "SELECT name, quantity, price FROM cart c JOIN products p ON c.product_id = p.id WHERE c.user_id=?",
-                (user_id,))
-            items = cur.fetchall()
-            for item in items:
-                logger.debug(f" - {item[0]} ×{item[1]} = {item[2] * item[1]} ₽")
+        for item in await adb.get_cart(user_id):
+            logger.debug(f" - {item['name']} ×{item['quantity']} = {item['price'] * item['quantity']} ₽")
     except Exception as e:
         logger.error(f"Debug error: {e}")
 
@@ -150,13 +149,37 @@ def simplify_order_data(data: dict) -> dict:
     }
 
 
+async def create_checkout_payment(state: FSMContext, user_id: int, kind: str, amount: int, description: str,
+                                  metadata: dict, local_metadata: dict = None, items: list = None):
+    """Создаёт платёж для текущей попытки оформления.
+
+    checkout_id в FSM живёт до state.clear() после оплаты, поэтому повторное
+    нажатие «Оплатить» с той же суммой и корзиной возвращает уже созданный
+    платёж. Если он отменён, попытка начинается заново с новым ключом.
+    """
+    for _ in range(2):
+        data = await state.get_data()
+        checkout_id = data.get('checkout_id')
+        if not checkout_id:
+            checkout_id = uuid.uuid4().hex
+            await state.update_data(checkout_id=checkout_id)
+
+        key = payment_manager.idempotency_key(user_id, checkout_id, kind, amount, items)
+        payment = await payment_manager.create_payment(amount, description, metadata,
+                                                       idempotency_key=key, local_metadata=local_metadata)
+        if not payment or payment["status"] != "canceled":
+            return payment
+        await state.update_data(checkout_id=None)
+    return None
+
+
 async def calculate_order_total_with_bonuses(user_id: int, delivery_cost: int = 0, bonus_to_use: int = 0) -> dict:
     """Рассчитывает итоговую сумму заказа с учетом бонусов и скидок"""
-    cart_items = get_cart(user_id)
+    cart_items = await adb.get_cart(user_id)
     original_products_total = sum(item['price'] * item['quantity'] for item in cart_items)
 
     # Проверяем первый ли это заказ
-    is_first = is_first_order(user_id)
+    is_first = await adb.is_first_order(user_id)
     discount = 0
     if is_first:
         discount = int(original_products_total * FIRST_ORDER_DISCOUNT)
@@ -166,7 +189,7 @@ async def calculate_order_total_with_bonuses(user_id: int, delivery_cost: int =
     products_total_after_discount = max(0, original_products_total - discount)
 
     # Получаем информацию о бонусах пользователя
-    bonus_info = get_bonus_info(user_id)
+    bonus_info = await adb.get_bonus_info(user_id)
     available_bonus = bonus_info['current_bonus']
 
     # Максимально можно использовать бонусов - 30% от суммы товаров после скидки
@@ -200,13 +223,13 @@ async def apply_bonus_to_order(user_id: int, order_id: int, bonus_used: int, ord
         return False
 
     # Списываем бонусы
-    success = spend_bonus_points(user_id, order_id, bonus_used, order_total)
+    success = await adb.spend_bonus_points(user_id, order_id, bonus_used, order_total)
 
     if success:
         # Начисляем новые бонусы (10% от итоговой суммы после применения скидки)
         bonus_earned = int((order_total - bonus_used) * BONUS_EARN_PERCENTAGE)
         if bonus_earned > 0:
-            add_bonus_points(user_id, order_id, bonus_earned)
+            await adb.add_bonus_points(user_id, order_id, bonus_earned)
 
         return True
     return False
@@ -229,7 +252,7 @@ async def send_bonus_notification(user_id: int, order_id: int, bonus_used: int,
             text += f"💎 <b>Начислено бонусов:</b> {bonus_earned} ₽ (5% от суммы заказа)\n"
 
         # Получаем информацию о заказе для отображения итоговой суммы
-        orders = get_user_orders(user_id)
+        orders = await adb.get_user_orders(user_id)
         current_order = next((order for order in orders if order['id'] == order_id), None)
 
         if current_order:
@@ -244,8 +267,17 @@ async def send_bonus_notification(user_id: int, order_id: int, bonus_used: int,
 
 # --- START ---
 @router.message(Command("start"))
-async def start_cmd(message: Message):
+async def start_cmd(message: Message, command: CommandObject):
     """Обработчик команды /start - приветствие и главное меню"""
+    user = message.from_user
+    await adb.upsert_user(user.id, user.first_name, user.last_name, user.username)
+    await adb.init_user_loyalty(user.id)
+
+    # Ссылка из инлайн-поиска: /start product_<id>
+    if command.args and command.args.startswith("product_"):
+        product_id = command.args.split("_", 1)[1]
+        if product_id.isdigit() and await send_product_details(message, int(product_id)):
+            return
     await message.answer(
         f"Привет! 👋 Рады видеть вас в <b>Лавке цветочных историй</b>! 🌸\n\n"
         "Создаем прекрасные букеты и дарим выгоду нашим гостям:\n\n"
@@ -274,18 +306,7 @@ async def show_catalog(message: Message):
 async def show_bouquets(message: Message):
     """Показывает букеты на сегодня"""
     try:
-        cleanup_old_daily_products()
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT id, name, description, full_description, price, photo, category, is_daily, on_request, in_stock 
-                FROM products 
-                WHERE category = 'bouquet' AND is_daily = TRUE 
-                AND created_date = DATE('now') 
-                ORDER BY id DESC
-            """)
-            bouquets = [dict(row) for row in cur.fetchall()]
+        bouquets = await adb.get_catalog('bouquet')
 
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="💬 Спросить у менеджера", url="https://t.me/Therry_Voyager")],
@@ -304,28 +325,21 @@ async def show_bouquets(message: Message):
             )
             return
 
+        if CATALOG_MODE == "carousel":
+            await send_catalog_carousel(message, 'bouquet', bouquets)
+            return
+
         today = datetime.now().strftime("%d.%m.%Y")
         await message.answer(
             f"🌸 <b>Букеты на сегодня</b>\n📅 <i>{today}</i>",
             parse_mode="HTML"
         )
 
-        for bouquet in bouquets:
-            text = f"<b>{bouquet['name']}</b>\n{bouquet['description']}\n"
-            if bouquet['on_request'] or bouquet['price'] == 0:
-                text += "💰 <b>Цена: по запросу</b>"
-            else:
-                text += f"💰 <b>Цена: {bouquet['price']} ₽</b>"
-            kb = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="📖 Подробнее", callback_data=f"details_{bouquet['id']}")],
-                [InlineKeyboardButton(text="🛒 В корзину", callback_data=f"add_{bouquet['id']}")]
-            ])
-
-            if bouquet.get('photo') and os.path.exists(bouquet['photo']):
-                photo = FSInputFile(bouquet['photo'])
-                await message.answer_photo(photo=photo, caption=text, reply_markup=kb, parse_mode="HTML")
-            else:
-                await message.answer(text, reply_markup=kb, parse_mode="HTML")
+        with outbound.priority(outbound.CATALOG):
+            for bouquet in bouquets:
+                text, kb = card_cache.get_card(bouquet, "bouquet")
+                if not await answer_product_photo(message, bouquet, text, kb):
+                    await message.answer(text, reply_markup=kb, parse_mode="HTML")
 
     except Exception as e:
         logger.error(f"Error showing bouquets: {e}")
@@ -339,18 +353,7 @@ async def show_bouquets(message: Message):
 async def show_plants(message: Message):
     """Показывает горшечные растения"""
     try:
-        cleanup_old_daily_products()
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT id, name, description, full_description, price, photo, category, is_daily, on_request, in_stock 
-                FROM products 
-                WHERE category = 'plant' AND is_daily = TRUE 
-                AND created_date = DATE('now') 
-                ORDER BY id DESC
-            """)
-            plants = [dict(row) for row in cur.fetchall()]
+        plants = await adb.get_catalog('plant')
 
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="💬 Спросить у менеджера", url="https://t.me/Therry_Voyager")],
@@ -363,29 +366,21 @@ async def show_plants(message: Message):
             )
             return
 
+        if CATALOG_MODE == "carousel":
+            await send_catalog_carousel(message, 'plant', plants)
+            return
+
         await message.answer(
             "🌱 <b>Наши горшечные растения</b>\n\n"
             "Постоянные жители нашего магазина:",
             parse_mode="HTML"
         )
 
-        for plant in plants:
-            text = f"<b>{plant['name']}</b>\n{plant['description']}\n"
-            if plant['on_request'] or plant['price'] == 0:
-                text += "💰 <b>Цена: по запросу</b>"
-            else:
-                text += f"💰 <b>Цена: {plant['price']} ₽</b>"
-            kb = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="📖 Подробнее", callback_data=f"details_{plant['id']}")],
-                [InlineKeyboardButton(text="💬 Уточнить цену", url="https://t.me/Therry_Voyager")],
-                [InlineKeyboardButton(text="🛒 В корзину", callback_data=f"add_{plant['id']}")]
-            ])
-
-            if plant.get('photo') and os.path.exists(plant['photo']):
-                photo = FSInputFile(plant['photo'])
-                await message.answer_photo(photo=photo, caption=text, reply_markup=kb, parse_mode="HTML")
-            else:
-                await message.answer(text, reply_markup=kb, parse_mode="HTML")
+        with outbound.priority(outbound.CATALOG):
+            for plant in plants:
+                text, kb = card_cache.get_card(plant, "plant")
+                if not await answer_product_photo(message, plant, text, kb):
+                    await message.answer(text, reply_markup=kb, parse_mode="HTML")
 
     except Exception as e:
         logger.error(f"Error showing plants: {e}")
@@ -395,36 +390,210 @@ async def show_plants(message: Message):
         )
 
 
+async def send_catalog_carousel(message: Message, category: str, products: List[Dict]):
+    """Каталог одним сообщением: первый товар и кнопки листания"""
+    text, kb = card_cache.get_carousel_card(products[0], category, 0, len(products))
+    if not await answer_product_photo(message, products[0], text, kb):
+        await message.answer(text, reply_markup=kb, parse_mode="HTML")
+
+
+@router.callback_query(F.data.startswith("carousel_"))
+async def catalog_carousel(callback: CallbackQuery):
+    """Листание карусели каталога: carousel_{категория}_{номер товара}"""
+    try:
+        _, category, index = callback.data.split("_")
+        index = int(index)
+    except ValueError:
+        await callback.answer("❌ Неверная страница")
+        return
+
+    if category not in ('bouquet', 'plant'):
+        await callback.answer("❌ Неверная категория")
+        return
+
+    products = await adb.get_catalog(category)
+    if not products:
+        await callback.answer("Товары закончились, загляните позже 🌸", show_alert=True)
+        return
+
+    # Каталог мог измениться с момента отправки сообщения
+    index %= len(products)
+    product = products[index]
+    text, kb = card_cache.get_carousel_card(product, category, index, len(products))
+    try:
+        await edit_product_card(callback.message, product, text, kb)
+    except TelegramBadRequest as e:
+        # Повторное нажатие на ту же карточку
+        if "message is not modified" not in str(e):
+            logger.warning(f"Не удалось перелистнуть карусель: {e}")
+    await callback.answer()
+
+
+def is_file_id_error(error: TelegramBadRequest) -> bool:
+    """Telegram не принял именно file_id (отозван или другого типа), а не само сообщение"""
+    text = str(error).lower()
+    return any(marker in text for marker in ("wrong file identifier", "file reference expired",
+                                             "wrong type of", "wrong remote file"))
+
+
+async def forget_photo_file_id(product: dict, error: TelegramBadRequest) -> bool:
+    """Сбрасывает отозванный file_id, если есть локальный файл для повторной загрузки.
+    Без файла file_id - единственная копия фото, его не трогаем"""
+    logger.warning(f"Telegram отклонил file_id фото товара #{product['id']}: {error}")
+    if not (product.get('photo') and os.path.exists(product['photo'])):
+        return False
+    product['photo_file_id'] = None
+    await adb.set_product_photo_file_id(product['id'], None)
+    return True
+
+
+async def edit_product_card(message: Message, product: dict, caption: str, reply_markup):
+    """Показывает в уже отправленном сообщении другой товар одним запросом
+    (editMessageMedia или editMessageText)"""
+    file_id = product.get('photo_file_id')
+    has_file = bool(product.get('photo') and os.path.exists(product['photo']))
+
+    if message.photo and file_id:
+        try:
+            await message.edit_media(
+                InputMediaPhoto(media=file_id, caption=caption, parse_mode="HTML"), reply_markup=reply_markup
+            )
+            return
+        except TelegramBadRequest as e:
+            if not is_file_id_error(e):
+                raise
+            await forget_photo_file_id(product, e)
+
+    if message.photo and has_file:
+        edited = await message.edit_media(
+            InputMediaPhoto(media=FSInputFile(product['photo']), caption=caption, parse_mode="HTML"),
+            reply_markup=reply_markup
+        )
+        if isinstance(edited, Message) and edited.photo:
+            product['photo_file_id'] = edited.photo[-1].file_id
+            await adb.set_product_photo_file_id(product['id'], product['photo_file_id'])
+        return
+
+    if not message.photo and not (file_id or has_file):
+        await message.edit_text(caption, reply_markup=reply_markup, parse_mode="HTML")
+        return
+
+    # Текстовое сообщение нельзя превратить в фото и наоборот - отправляем карточку заново
+    try:
+        await message.delete()
+    except TelegramBadRequest:
+        pass
+    if not await answer_product_photo(message, product, caption, reply_markup):
+        await message.answer(caption, reply_markup=reply_markup, parse_mode="HTML")
+
+
 # --- ПОДРОБНОЕ ОПИСАНИЕ ---
 @router.callback_query(F.data.startswith("details_"))
 async def show_details(callback: CallbackQuery):
     """Показывает подробную информацию о товаре"""
     product_id = int(callback.data.split("_")[1])
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM products WHERE id=?", (product_id,))
-        product = cur.fetchone()
+    await send_product_details(callback.message, product_id)
+    await callback.answer()
 
-    if product:
-        text = (
-            f"<b>{product['name']}</b>\n\n"
-            f"📄 <i>{product['full_description']}</i>\n\n"
-            f"💰 <b>Цена: {product['price']} ₽</b>"
+
+async def send_product_details(message: Message, product_id: int) -> bool:
+    """Отправляет подробную карточку товара, False если товара нет"""
+    product = await adb.get_product(product_id)
+
+    if not product:
+        return False
+
+    text, kb = card_cache.get_card(product, "details")
+
+    if not await answer_product_photo(message, product, text, kb):
+        await message.answer(text, reply_markup=kb, parse_mode="HTML")
+    return True
+
+
+async def answer_product_photo(message: Message, product: dict, caption: str, reply_markup) -> bool:
+    """Отправляет фото товара по сохранённому file_id, а без него загружает файл
+    и запоминает полученный file_id. False - фото у товара нет"""
+    file_id = product.get('photo_file_id')
+    if file_id:
+        try:
+            await message.answer_photo(photo=file_id, caption=caption, reply_markup=reply_markup, parse_mode="HTML")
+            return True
+        except TelegramBadRequest as e:
+            if not is_file_id_error(e):
+                raise
+            if not await forget_photo_file_id(product, e):
+                return False
+
+    if not (product.get('photo') and os.path.exists(product['photo'])):
+        return False
+
+    sent = await message.answer_photo(
+        photo=FSInputFile(product['photo']), caption=caption, reply_markup=reply_markup, parse_mode="HTML"
+    )
+    # Словарь товара может лежать в кэше каталога - обновляем и его
+    product['photo_file_id'] = sent.photo[-1].file_id
+    await adb.set_product_photo_file_id(product['id'], product['photo_file_id'])
+    return True
+
+
+# --- ПОИСК ---
+@router.message(Command("search"))
+async def search_cmd(message: Message, command: CommandObject):
+    """Поиск товаров: /search пионы"""
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer(
+            "🔍 Напишите, что ищете, после команды.\n"
+            "Например: <code>/search пионы</code>",
+            parse_mode="HTML"
         )
+        return
 
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🛒 Добавить в корзину", callback_data=f"add_{product['id']}")],
-            [InlineKeyboardButton(text="💬 Спросить у менеджера", url="https://t.me/Therry_Voyager")]
-        ])
+    products = await adb.search_products(query)
+    if not products:
+        await message.answer(
+            f"🔍 По запросу «{html.escape(query)}» ничего не нашлось.\n\n"
+            "💡 Загляните в каталог или спросите менеджера — подберём букет под ваш запрос!",
+            parse_mode="HTML"
+        )
+        return
 
-        if product['photo'] and os.path.exists(product['photo']):
-            photo = FSInputFile(product['photo'])
-            await callback.message.answer_photo(photo=photo, caption=text, reply_markup=kb, parse_mode="HTML")
-        else:
-            await callback.message.answer(text, reply_markup=kb, parse_mode="HTML")
+    await message.answer(
+        f"🔍 <b>Найдено по запросу «{html.escape(query)}»:</b>",
+        reply_markup=search_results_keyboard(products),
+        parse_mode="HTML"
+    )
 
-    await callback.answer()
+
+@router.inline_query()
+async def search_inline(inline_query: InlineQuery, bot: Bot):
+    """Инлайн-поиск товаров: @бот пионы"""
+    query = inline_query.query.strip()
+    products = await adb.search_products(query) if query else []
+    me = await bot.me()
+
+    results = []
+    for product in products:
+        price = format_price(product)
+        results.append(InlineQueryResultArticle(
+            id=str(product['id']),
+            title=product['name'],
+            description=f"{price} · {product['description'] or ''}",
+            input_message_content=InputTextMessageContent(
+                message_text=f"<b>{html.escape(product['name'])}</b>\n"
+                             f"{html.escape(product['description'] or '')}\n"
+                             f"💰 <b>Цена: {price}</b>",
+                parse_mode="HTML"
+            ),
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+                InlineKeyboardButton(
+                    text="📖 Открыть в боте",
+                    url=f"https://t.me/{me.username}?start=product_{product['id']}"
+                )
+            ]])
+        ))
+
+    await inline_query.answer(results, cache_time=60, is_personal=False)
 
 
 # --- НАЗАД ---
@@ -717,13 +886,15 @@ async def handle_certificate_purchase(callback: CallbackQuery, state: FSMContext
             "type": "certificate"
         }
 
-        payment = await payment_manager.create_payment(
-            amount=amount,
+        payment = await create_checkout_payment(
+            state, callback.from_user.id, "certificate", amount,
             description=f"Подарочный сертификат на {amount}₽",
             metadata=simplified_metadata
         )
 
         if payment and payment.get("confirmation_url"):
+            # Повторное нажатие возвращает прежний платёж вместе с его кодом
+            cert_code = payment["metadata"].get("cert_code", cert_code)
             await state.update_data(
                 payment_id=payment["id"],
                 cert_amount=amount,
@@ -764,13 +935,9 @@ async def create_certificate_payment(user_id: int, amount: int, callback: Callba
     cert_code = f"CERT-{uuid.uuid4().hex[:8].upper()}"
 
     try:
-        # Настройка ЮKassa
-        Configuration.account_id = YOOKASSA_SHOP_ID
-        Configuration.secret_key = YOOKASSA_SECRET_KEY
-
         # Создаем реальный платеж
         payment_id = str(uuid.uuid4())
-        payment = Payment.create({
+        payment = await gateway.create_payment({
             "amount": {"value": str(amount), "currency": "RUB"},
             "confirmation": {
                 "type": "redirect",
@@ -843,13 +1010,15 @@ async def handle_certificate_purchase(callback: CallbackQuery, state: FSMContext
         }
 
         # Создаём платеж через единый менеджер
-        payment = await payment_manager.create_payment(
-            amount=amount,
+        payment = await create_checkout_payment(
+            state, callback.from_user.id, "certificate", amount,
             description=f"Подарочный сертификат на {amount}₽",
             metadata=metadata
         )
 
         if payment and payment.get("confirmation_url"):
+            # Повторное нажатие возвращает прежний платёж вместе с его кодом
+            cert_code = payment["metadata"].get("cert_code", cert_code)
             # Сохраняем данные в FSM
             await state.update_data(
                 payment_id=payment["id"],
@@ -888,12 +1057,12 @@ async def handle_certificate_purchase(callback: CallbackQuery, state: FSMContext
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("check_cert_payment_"))
+@router.callback_query(F.data.startswith("check_cert_payment_"), flags={"send_priority": outbound.PAYMENT})
 async def check_cert_payment(callback: CallbackQuery, state: FSMContext):
     payment_id = callback.data.split("_")[-1]
 
     try:
-        payment = Payment.find_one(payment_id)
+        payment = await gateway.find_payment(payment_id)
         if payment.status == "succeeded":
             data = await state.get_data()
             amount = data.get("cert_amount")
@@ -918,13 +1087,17 @@ async def check_cert_payment(callback: CallbackQuery, state: FSMContext):
                     parse_mode="HTML"
                 )
 
-            # Сохраняем в БД
-            add_certificate_purchase(
-                user_id=callback.from_user.id,
-                amount=amount,
-                cert_code=cert_code,
-                payment_id=payment_id
-            )
+            # Сохраняем в БД (сертификат по сохранённому платежу создаётся один раз,
+            # даже если его уже выдала фоновая сверка)
+            if await adb.get_payment(payment_id):
+                await adb.fulfill_payment(payment_id, notify_user=False)
+            else:
+                await adb.add_certificate_purchase(
+                    user_id=callback.from_user.id,
+                    amount=amount,
+                    cert_code=cert_code,
+                    payment_id=payment_id
+                )
 
             # Удаляем временный файл
             if os.path.exists(pdf_path):
@@ -950,7 +1123,7 @@ class ReviewState(StatesGroup):
 @router.message(F.text == "⭐ Отзывы")
 async def reviews_menu(message: Message):
     # Проверяем есть ли доставленные заказы
-    delivered_orders = get_delivered_orders(message.from_user.id)
+    delivered_orders = await adb.get_delivered_orders(message.from_user.id)
     has_delivered_orders = len(delivered_orders) > 0
 
     kb = InlineKeyboardMarkup(inline_keyboard=[])
@@ -977,7 +1150,7 @@ async def reviews_menu(message: Message):
 
 @router.callback_query(F.data == "read_reviews")
 async def read_reviews(callback: CallbackQuery):
-    reviews = get_reviews()
+    reviews = await adb.get_reviews()
     if not reviews:
         await callback.message.answer("📝 Пока нет отзывов. Будьте первым!")
         await callback.answer()
@@ -1016,7 +1189,7 @@ async def start_general_review(callback: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == "rate_order")
 async def select_order_for_review(callback: CallbackQuery, state: FSMContext):
-    delivered_orders = get_delivered_orders(callback.from_user.id)
+    delivered_orders = await adb.get_delivered_orders(callback.from_user.id)
 
     if not delivered_orders:
         await callback.message.answer("❌ У вас нет доставленных заказов для оценки.")
@@ -1050,7 +1223,7 @@ async def start_order_review(callback: CallbackQuery, state: FSMContext):
     order_id = int(callback.data.split("_")[2])
 
     # Проверяем, что заказ действительно доставлен и принадлежит пользователю
-    delivered_orders = get_delivered_orders(callback.from_user.id)
+    delivered_orders = await adb.get_delivered_orders(callback.from_user.id)
     order_exists = any(order['id'] == order_id for order in delivered_orders)
 
     if not order_exists:
@@ -1105,7 +1278,7 @@ async def save_review_with_rating(callback: CallbackQuery, state: FSMContext):
     order_id = data.get('order_id')
 
     # Сохраняем отзыв
-    add_review(
+    await adb.add_review(
         user_id=callback.from_user.id,
         user_name=callback.from_user.full_name,
         text=data['text'],
@@ -1140,39 +1313,21 @@ async def save_review_with_rating(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-async def ask_for_review_after_delivery(user_id: int, order_id: int):
-    """Функция для запроса отзыва после доставки заказа"""
-    try:
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="⭐ Оставить отзыв", callback_data=f"review_order_{order_id}")],
-            [InlineKeyboardButton(text="📞 Написать менеджеру", callback_data="ask_question")]
-        ])
-
-        await bot.send_message(
-            user_id,
-            f"🎉 <b>Ваш заказ #{order_id} доставлен!</b>\n\n"
-            "Понравился ли вам заказ? Поделитесь вашими впечатлениями!",
-            reply_markup=kb,
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        print(f"Не удалось отправить запрос на отзыв: {e}")
-
-
 # --- КОРЗИНА ---
 @router.callback_query(F.data.startswith("add_"))
 async def add_to_cart_handler(callback: CallbackQuery):
     product_id = int(callback.data.split("_")[1])
 
     # Проверяем наличие товара
-    if not check_product_availability(product_id):
+    if not await adb.check_product_availability(product_id):
         await callback.answer("❌ Товара нет в наличии")
         return
 
-    add_to_cart(callback.from_user.id, product_id)
+    await adb.add_to_cart(callback.from_user.id, product_id)
     await callback.answer("✅ Добавлено в корзину")
 
-    count = sum(item['quantity'] for item in get_cart(callback.from_user.id))
+    cart_items = await adb.get_cart(callback.from_user.id)
+    count = sum(item['quantity'] for item in cart_items)
     await callback.message.answer(f"🛒 Товар добавлен в корзину!\nВсего теперь: {count} шт.")
 
 
@@ -1186,7 +1341,7 @@ async def check_availability_product(callback: CallbackQuery):
 
 @router.message(F.text == "🛒 Корзина")
 async def show_cart(message: Message):
-    cart_items = get_cart(message.from_user.id)
+    cart_items = await adb.get_cart(message.from_user.id)
 
     if not cart_items:
         await message.answer("Корзина пуста 🛒", reply_markup=cart_keyboard(cart_items))
@@ -1221,34 +1376,21 @@ async def remove_from_cart(callback: CallbackQuery):
     product_id = int(callback.data.split("_")[1])
     user_id = callback.from_user.id
 
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT quantity FROM cart WHERE user_id=? AND product_id=?", (user_id, product_id))
-        row = cur.fetchone()
-
-        if row and row[0] > 1:
-            # Уменьшаем количество
-            cur.execute("UPDATE cart SET quantity = quantity - 1 WHERE user_id=? AND product_id=?",
-                        (user_id, product_id))
-        else:
-            # Удаляем товар из корзины
-            cur.execute("DELETE FROM cart WHERE user_id=? AND product_id=?", (user_id, product_id))
-
-        conn.commit()
+    await adb.decrease_cart_item(user_id, product_id)
 
     await callback.answer("✅ Количество уменьшено")
     await show_cart(callback.message)
 
 
 async def update_cart_button(message: Message):
-    cart = get_cart(message.from_user.id)
+    cart = await adb.get_cart(message.from_user.id)
     count = sum(item['quantity'] for item in cart)
     text = f"🛒 Корзина ({count})" if count else "🛒 Корзина"
     # Обновите меню с динамическим текстом (нужно хранить сообщение)
 
 
 async def update_main_menu(message: Message):
-    cart = get_cart(message.from_user.id)
+    cart = await adb.get_cart(message.from_user.id)
     count = sum(item['quantity'] for item in cart)
     text = f"🛒 Корзина ({count})" if count else "🛒 Корзина"
     # Но это сложно без хранения message_id
@@ -1256,7 +1398,7 @@ async def update_main_menu(message: Message):
 
 @router.callback_query(F.data == "clear_cart")
 async def clear_cart_handler(callback: CallbackQuery):
-    clear_cart(callback.from_user.id)
+    await adb.clear_cart(callback.from_user.id)
     await callback.answer("Корзина очищена")
     await callback.message.edit_text("Корзина пуста.")
 
@@ -1410,11 +1552,11 @@ async def get_budget_preferences(message: Message, state: FSMContext):
 @router.callback_query(F.data == "checkout")
 async def start_checkout(callback: CallbackQuery, state: FSMContext):
     """Начинает процесс оформления заказа"""
-    if not get_cart(callback.from_user.id):
+    if not await adb.get_cart(callback.from_user.id):
         await callback.answer("Корзина пуста!")
         return
 
-    cart_items = get_cart(callback.from_user.id)
+    cart_items = await adb.get_cart(callback.from_user.id)
     if not all(item['in_stock'] for item in cart_items):
         await callback.answer("❌ Некоторые товары отсутствуют в наличии.")
         return
@@ -1606,15 +1748,13 @@ async def get_delivery_time(callback: CallbackQuery, state: FSMContext):
     await state.update_data(delivery_time=delivery_time)
 
     # Предлагаем выбрать способ оплаты с добавлением "Через менеджера"
-    payment_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💳 Онлайн картой", callback_data="pay_online")],
-        [InlineKeyboardButton(text="💵 Наличными при получении", callback_data="pay_cash")],
-        [InlineKeyboardButton(text="🔄 СБП", callback_data="pay_sbp")],
-        [InlineKeyboardButton(text="🎁 Сертификат", callback_data="pay_cert")],
-        [InlineKeyboardButton(text="💬 Через менеджера", callback_data="pay_manager")]
-    ])
-
-    await callback.message.answer("💳 Выберите способ оплаты:", reply_markup=payment_kb)
+    if gateway.available():
+        await callback.message.answer("💳 Выберите способ оплаты:", reply_markup=payment_methods_keyboard())
+    else:
+        await callback.message.answer(
+            "💳 Выберите способ оплаты:\n\n⚠️ Онлайн-оплата временно недоступна.",
+            reply_markup=payment_methods_keyboard(online=False)
+        )
     await state.set_state(OrderState.payment)
     await callback.answer()
 
@@ -1686,6 +1826,15 @@ async def process_online_payment(message: Message, state: FSMContext):
 async def process_online_payment_selection(callback: CallbackQuery, state: FSMContext):
     """Обработка выбора онлайн-оплаты (карта или СБП)"""
     try:
+        if not gateway.available():
+            # ЮKassa отключена автоматом - не заставляем ждать, сразу предлагаем другие способы
+            await callback.message.answer(
+                "⚠️ Онлайн-оплата временно недоступна.\n"
+                "Вы можете оплатить заказ при получении или через менеджера:",
+                reply_markup=payment_methods_keyboard(online=False)
+            )
+            return
+
         data = await state.get_data()
         payment_method = data.get('payment_method', 'online')
         user_id = callback.from_user.id
@@ -1704,7 +1853,7 @@ async def process_online_payment_selection(callback: CallbackQuery, state: FSMCo
             user_phone = "9999999999"
 
         # Создаем платеж в ЮKassa
-        cart_items = get_cart(user_id)
+        cart_items = await adb.get_cart(user_id)
 
         # Формируем метаданные для платежа
         metadata = {
@@ -1728,10 +1877,13 @@ async def process_online_payment_selection(callback: CallbackQuery, state: FSMCo
         # Создаем платеж
         payment_description = f"Заказ цветов на {total_amount}₽"
 
-        payment = await payment_manager.create_payment(
-            amount=total_amount,
+        # Полные данные заказа сохраняются в payments - по ним заказ создаётся после оплаты
+        payment = await create_checkout_payment(
+            state, user_id, "order", total_amount,
             description=payment_description,
-            metadata=simplified_metadata
+            metadata=simplified_metadata,
+            local_metadata=metadata,
+            items=cart_items
         )
 
         if payment and payment.get("confirmation_url"):
@@ -1759,7 +1911,8 @@ async def process_online_payment_selection(callback: CallbackQuery, state: FSMCo
             )
         else:
             await callback.message.answer(
-                "❌ Не удалось создать платеж. Пожалуйста, попробуйте другой способ оплаты или свяжитесь с менеджером."
+                "❌ Не удалось создать платеж. Пожалуйста, попробуйте другой способ оплаты или свяжитесь с менеджером.",
+                reply_markup=payment_methods_keyboard(online=gateway.available())
             )
 
     except Exception as e:
@@ -1769,7 +1922,7 @@ async def process_online_payment_selection(callback: CallbackQuery, state: FSMCo
         )
 
 
-@router.callback_query(F.data.startswith("check_payment_"))
+@router.callback_query(F.data.startswith("check_payment_"), flags={"send_priority": outbound.PAYMENT})
 async def check_payment_status(callback: CallbackQuery, state: FSMContext):
     """Проверка статуса платежа"""
     try:
@@ -1783,19 +1936,24 @@ async def check_payment_status(callback: CallbackQuery, state: FSMContext):
             data = await state.get_data()
             user_id = callback.from_user.id
 
-            # Создаем заказ
-            order_id = create_order(
-                user_id=user_id,
-                name=data.get('name', ''),
-                phone=data.get('phone', ''),
-                address=data.get('address', ''),
-                delivery_date=data.get('delivery_date', ''),
-                delivery_time=data.get('delivery_time', ''),
-                payment=data.get('payment_method', 'online'),
-                delivery_cost=data.get('delivery_cost', 0),
-                delivery_type=data.get('delivery_type', 'delivery'),
-                bonus_used=data.get('bonus_used', 0)
-            )
+            if await adb.get_payment(payment_id):
+                # Заказ по сохранённому платежу создаётся один раз, даже если
+                # его уже создала фоновая сверка
+                result = await adb.fulfill_payment(payment_id, notify_user=False)
+                order_id = result['order_id'] if result and not result['failed'] else -1
+            else:
+                order_id = await adb.create_order(
+                    user_id=user_id,
+                    name=data.get('name', ''),
+                    phone=data.get('phone', ''),
+                    address=data.get('address', ''),
+                    delivery_date=data.get('delivery_date', ''),
+                    delivery_time=data.get('delivery_time', ''),
+                    payment=data.get('payment_method', 'online'),
+                    delivery_cost=data.get('delivery_cost', 0),
+                    delivery_type=data.get('delivery_type', 'delivery'),
+                    bonus_used=data.get('bonus_used', 0)
+                )
 
             if order_id != -1:
                 await callback.message.answer(
@@ -1805,9 +1963,6 @@ async def check_payment_status(callback: CallbackQuery, state: FSMContext):
                     parse_mode="HTML"
                 )
 
-                # Отправляем уведомление администраторам
-                await notify_admins_about_new_order(order_id, user_id, data)
-
                 await state.clear()
             else:
                 await callback.message.answer(
@@ -1816,6 +1971,8 @@ async def check_payment_status(callback: CallbackQuery, state: FSMContext):
 
         elif status == 'pending':
             await callback.answer("⏳ Платеж еще обрабатывается. Попробуйте через минуту.")
+        elif status is None:
+            await callback.answer("❌ Не удалось проверить статус платежа. Попробуйте позже.")
         else:
             await callback.answer("❌ Платеж не прошел. Попробуйте еще раз или выберите другой способ оплаты.")
 
@@ -1824,49 +1981,86 @@ async def check_payment_status(callback: CallbackQuery, state: FSMContext):
         await callback.answer("❌ Ошибка при проверке статуса платежа.")
 
 
-async def notify_admins_about_new_order(order_id: int, user_id: int, order_data: dict):
-    """Уведомление администраторов о новом заказе"""
-    # Получаем заказ из базы, чтобы взять список товаров
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("SELECT items FROM orders WHERE id = ?", (order_id,))
-        result = cur.fetchone()
+@outbox.renderer("new_order")
+def render_new_order_notification(order: dict):
+    """Уведомление администраторов о новом заказе (ставится в outbox в create_order)"""
+    title = "НОВЫЙ ЗАКАЗ ЧЕРЕЗ МЕНЕДЖЕРА" if order['payment_method'] == 'manager' else "НОВЫЙ ЗАКАЗ"
+    delivery_type_text = "Самовывоз" if order['delivery_type'] == "pickup" else "Доставка"
+    message = (f"🛒 <b>{title} #{order['order_id']}</b>\n"
+               f"👤 <b>Клиент:</b> {html.escape(order['name'] or 'Не указано')}\n"
+               f"📞 <b>Телефон:</b> {html.escape(order['phone'] or 'Не указан')}\n"
+               f"📍 <b>Способ:</b> {delivery_type_text}\n")
+    if order['delivery_type'] != "pickup":
+        message += f"🏠 <b>Адрес:</b> {html.escape(order['address'] or 'Не указан')}\n"
+    message += (f"📅 <b>Дата доставки:</b> {html.escape(order['delivery_date'] or 'Не указана')}\n"
+                f"⏰ <b>Время:</b> {html.escape(order['delivery_time'] or 'Не указано')}\n"
+                f"💳 <b>Способ оплаты:</b> {get_payment_method_name(order['payment_method'])}\n"
+                f"🛒 <b>Товары:</b>\n")
+
+    if order['items']:
+        for item in order['items']:
+            message += f"• {html.escape(item['name'])} ×{item['quantity']} — {item['price'] * item['quantity']} ₽\n"
+    else:
+        message += "❌ Товары не найдены в заказе.\n"
 
-    if not result:
-        logger.error(f"Заказ #{order_id} не найден при отправке уведомления")
-        return
+    if order['bonus_used'] > 0:
+        message += f"💎 <b>Использовано бонусов:</b> {order['bonus_used']} ₽\n"
+    if order['discount'] > 0:
+        message += f"🎉 <b>Скидка на первый заказ:</b> -{order['discount']} ₽\n"
+    message += f"💰 <b>Сумма:</b> {order['total']} ₽\n"
 
-    try:
-        cart_items = json.loads(result['items'])  # Это сохранённый список товаров
-    except Exception as e:
-        logger.error(f"Ошибка парсинга items для заказа #{order_id}: {e}")
-        cart_items = []
-
-    message = (f"🛒 <b>НОВЫЙ ЗАКАЗ #{order_id}</b>\n"
-               f"👤 <b>Клиент:</b> {order_data.get('name', 'Не указано')}\n"
-               f"📞 <b>Телефон:</b> {order_data.get('phone', 'Не указан')}\n"
-               f"📍 <b>Адрес:</b> {order_data.get('address', 'Не указан')}\n"
-               f"📅 <b>Дата доставки:</b> {order_data.get('delivery_date', 'Не указана')}\n"
-               f"⏰ <b>Время:</b> {order_data.get('delivery_time', 'Не указано')}\n"
-               f"💳 <b>Способ оплаты:</b> {get_payment_method_name(order_data.get('payment_method', ''))}\n"
-               f"💰 <b>Сумма:</b> {order_data.get('payment_amount', 0)} ₽\n"
-               f"🛒 <b>Товары:</b>\n")
-
-    if cart_items:
-        for item in cart_items:
-            name = item.get('name', 'Неизвестный товар')
-            price = item.get('price', 0)
-            quantity = item.get('quantity', 1)
-            total_item = price * quantity
-            message += f"• {name} ×{quantity} — {total_item} ₽\n"
+    return message, None
+
+
+@outbox.renderer("payment_fulfilled")
+def render_payment_fulfilled_notification(payment: dict):
+    """Сообщение покупателю об оплате, найденной фоновой сверкой (ставится в outbox в fulfill_payment)"""
+    if payment['type'] == 'certificate':
+        text = (
+            f"🎉 <b>Оплата прошла!</b>\n\n"
+            f"Вы купили сертификат на {int(payment['amount'])} ₽\n"
+            f"Код: <code>{payment['cert_code']}</code>"
+        )
     else:
-        message += "❌ Товары не найдены в заказе.\n"
+        text = (
+            f"✅ <b>Оплата принята!</b>\n\n"
+            f"Заказ #{payment['order_id']} успешно оформлен.\n"
+            f"Менеджер свяжется с вами для подтверждения."
+        )
+    return text, None
+
+
+@outbox.renderer("payment_failed")
+def render_payment_failed_notification(payment: dict):
+    """Сообщение админам о платеже, который не удалось выполнить (ставится в outbox в fail_payment_tx)"""
+    title = "Оплачен, но заказ не создан" if payment['status'] == 'fulfill_failed' else "Платёж не подтверждён"
+    text = (
+        f"🚨 <b>{title}</b>\n\n"
+        f"💳 <b>Платёж:</b> <code>{payment['payment_id']}</code>\n"
+        f"👤 <b>Покупатель:</b> <code>{payment['user_id']}</code>\n"
+        f"💰 <b>Сумма:</b> {payment['amount']} ₽\n"
+        f"⚠️ <b>Причина:</b> {html.escape(payment['error'] or 'неизвестна')}\n\n"
+        f"Свяжитесь с покупателем и проверьте платёж в ЮKassa."
+    )
+    return text, None
 
-    if order_data.get('bonus_used', 0) > 0:
-        message += f"💎 <b>Использовано бонусов:</b> {order_data.get('bonus_used', 0)} ₽\n"
 
-    await notify_admins(message)
+@outbox.renderer("order_status")
+def render_order_status_notification(event: dict):
+    """Сообщение покупателю о смене статуса заказа (ставится в outbox в update_order_status)"""
+    if event['status'] != 'delivered':
+        return None
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⭐ Оставить отзыв", callback_data=f"review_order_{event['order_id']}")],
+        [InlineKeyboardButton(text="📞 Написать менеджеру", callback_data="ask_question")]
+    ])
+    text = (
+        f"🎉 <b>Ваш заказ #{event['order_id']} доставлен!</b>\n\n"
+        f"Спасибо за покупку! Надеемся, вам понравились наши цветы 💐\n\n"
+        f"Понравился ли вам заказ? Поделитесь вашими впечатлениями!"
+    )
+    return text, kb
 
 
 @router.callback_query(F.data.in_(["pay_online", "pay_sbp", "pay_cash"]))
@@ -1937,12 +2131,12 @@ async def process_bonus_amount(message: Message, state: FSMContext):
         user_id = message.from_user.id
 
         # Получаем данные корзины
-        cart_items = get_cart(user_id)
+        cart_items = await adb.get_cart(user_id)
         products_total = sum(item['price'] * item['quantity'] for item in cart_items)
 
         # Проверяем лимиты
         max_bonus_allowed = int(products_total * 0.3)
-        bonus_info = get_bonus_info(user_id)
+        bonus_info = await adb.get_bonus_info(user_id)
 
         if bonus_to_use <= 0:
             await message.answer("❌ Сумма должна быть положительной. Введите еще раз:")
@@ -1993,7 +2187,7 @@ async def process_cash_payment(callback: CallbackQuery, state: FSMContext):
 
     data = await state.get_data()
     user_id = callback.from_user.id
-    cart_items = get_cart(user_id)
+    cart_items = await adb.get_cart(user_id)
 
     # Правильный расчет с учетом бонусов
     delivery_type = data.get('delivery_type', 'delivery')
@@ -2038,7 +2232,7 @@ async def process_certificate_code(message: Message, state: FSMContext):
     cert_code = message.text.strip().upper()
 
     # Проверяем, не заблокирован ли пользователь
-    attempts_info = get_certificate_attempts(user_id)
+    attempts_info = await adb.get_certificate_attempts(user_id)
     if attempts_info and attempts_info.get('blocked_until'):
         blocked_until = datetime.strptime(attempts_info['blocked_until'], "%Y-%m-%d %H:%M:%S")
         if datetime.now() < blocked_until:
@@ -2051,14 +2245,14 @@ async def process_certificate_code(message: Message, state: FSMContext):
             return
 
     # Проверяем валидность сертификата
-    certificate = check_certificate_validity(cert_code)
+    certificate = await adb.check_certificate_validity(cert_code)
 
     if certificate:
         # Сбрасываем счетчик попыток при успешном вводе
-        reset_certificate_attempts(user_id)
+        await adb.reset_certificate_attempts(user_id)
 
         data = await state.get_data()
-        cart_items = get_cart(user_id)
+        cart_items = await adb.get_cart(user_id)
         total = sum(item['price'] * item['quantity'] for item in cart_items) + data.get('delivery_cost', 0)
 
         if certificate['amount'] >= total:
@@ -2087,8 +2281,8 @@ async def process_certificate_code(message: Message, state: FSMContext):
             )
     else:
         # Неверный код - увеличиваем счетчик попыток
-        add_certificate_attempt(user_id)
-        attempts_info = get_certificate_attempts(user_id)
+        await adb.add_certificate_attempt(user_id)
+        attempts_info = await adb.get_certificate_attempts(user_id)
 
         if attempts_info['attempts'] >= 3:
             await message.answer(
@@ -2110,11 +2304,11 @@ async def process_certificate_code(message: Message, state: FSMContext):
     cert_code = message.text.strip().upper()
 
     # Проверяем валидность сертификата
-    certificate = check_certificate_validity(cert_code)
+    certificate = await adb.check_certificate_validity(cert_code)
 
     if certificate:
         data = await state.get_data()
-        cart_items = get_cart(message.from_user.id)
+        cart_items = await adb.get_cart(message.from_user.id)
         total = sum(item['price'] * item['quantity'] for item in cart_items) + data.get('delivery_cost', 0)
 
         if certificate['amount'] >= total:
@@ -2199,7 +2393,7 @@ async def process_manager_payment(callback: CallbackQuery, state: FSMContext):
         user_id = callback.from_user.id
 
         # Получаем корзину
-        cart_items = get_cart(user_id)
+        cart_items = await adb.get_cart(user_id)
         if not cart_items:
             await callback.answer("❌ Корзина пуста")
             return
@@ -2219,7 +2413,7 @@ async def process_manager_payment(callback: CallbackQuery, state: FSMContext):
         total = calculation['final_total']
 
         # Создаем заказ
-        order_id = create_order(
+        order_id = await adb.create_order(
             user_id=user_id,
             name=data.get('name', ''),
             phone=data.get('phone', ''),
@@ -2236,39 +2430,7 @@ async def process_manager_payment(callback: CallbackQuery, state: FSMContext):
             await callback.message.answer("❌ Ошибка при создании заказа.")
             return
 
-        # Отправляем уведомление менеджеру с информацией о бонусах
-        delivery_type_text = "Самовывоз" if delivery_type == "pickup" else "Доставка"
-        admin_msg = (
-            "👤 <b>НОВЫЙ ЗАКАЗ ЧЕРЕЗ МЕНЕДЖЕРА</b>\n\n"
-            f"📦 Заказ #: {order_id}\n"
-            f"👤 Имя: {data.get('name', 'Не указано')}\n"
-            f"📞 Телефон: {data.get('phone', 'Не указан')}\n"
-            f"📍 Способ: {delivery_type_text}\n"
-        )
-
-        if delivery_type == "delivery":
-            admin_msg += f"🏠 Адрес: {data.get('address', 'Не указан')}\n"
-
-        # Добавляем информацию о бонусах
-        if bonus_used > 0:
-            admin_msg += f"💎 Использовано бонусов: {bonus_used} ₽\n"
-
-        admin_msg += (
-            f"📅 Дата: {data.get('delivery_date', 'Не указана')}\n"
-            f"⏰ Время: {data.get('delivery_time', 'Не указано')}\n"
-            f"💰 Сумма товаров: {calculation['products_total_after_discount']} ₽\n"
-        )
-
-        if calculation['discount'] > 0:
-            admin_msg += f"🎉 Скидка на первый заказ: -{calculation['discount']} ₽\n"
-
-        admin_msg += f"💰 Итоговая сумма: {total} ₽\n\n"
-        admin_msg += f"🛒 Товары:\n"
-
-        for item in cart_items:
-            admin_msg += f"• {item['name']} ×{item['quantity']} - {item['price'] * item['quantity']} ₽\n"
-
-        await notify_admins(admin_msg)
+        # Уведомление менеджеру ушло в outbox вместе с заказом
 
         await callback.message.answer(
             f"✅ <b>Заказ #{order_id} оформлен!</b>\n\n"
@@ -2277,7 +2439,7 @@ async def process_manager_payment(callback: CallbackQuery, state: FSMContext):
         )
 
         # Очищаем корзину
-        clear_cart(user_id)
+        await adb.clear_cart(user_id)
         await state.clear()
 
     except Exception as e:
@@ -2303,31 +2465,15 @@ async def check_user_payment_status(callback: CallbackQuery, state: FSMContext):
     status = await payment_manager.check_payment_status(payment_id)
 
     if status == 'succeeded':
-        # Обновляем статус в базе
-        update_payment_status(payment_id, status)
-
-        # Получаем полные данные заказа из базы
-        payment_info = get_payment(payment_id)
-        if payment_info and payment_info.get('metadata'):
-            try:
-                metadata = json.loads(payment_info['metadata'])
-                order_data = metadata.get('order_data', {})
-            except:
-                order_data = data
-        else:
-            order_data = data
-
-        # Создаем заказ
-        order_id = create_order(
-            callback.from_user.id,
-            order_data.get('name', data.get('name', '')),
-            order_data.get('phone', data.get('phone', '')),
-            order_data.get('address', data.get('address', '')),
-            order_data.get('delivery_date', data.get('delivery_date', '')),
-            order_data.get('delivery_time', data.get('delivery_time', '')),
-            order_data.get('payment_method', data.get('payment_method', 'online')),
-            order_data.get('delivery_cost', data.get('delivery_cost', 0))
-        )
+        # Заказ по сохранённому платежу создаётся один раз, даже если его уже создала фоновая сверка
+        result = await adb.fulfill_payment(payment_id, notify_user=False)
+        if result is None or result['failed']:
+            await callback.message.answer(
+                "❌ Ошибка при создании заказа. Пожалуйста, свяжитесь с менеджером."
+            )
+            await callback.answer()
+            return
+        order_id = result['order_id']
 
         await callback.message.answer(
             f"✅ <b>Оплата принята!</b>\n\n"
@@ -2350,17 +2496,8 @@ async def check_user_payment_status(callback: CallbackQuery, state: FSMContext):
 
 # Фоновая задача для проверки pending платежей
 async def check_pending_payments():
-    """Фоновая проверка pending платежей каждые 5 минут"""
-    while True:
-        try:
-            # Здесь будет логика проверки pending платежей
-            # Например: поиск платежей со статусом 'pending' старше 10 минут
-            logger.info("Checking pending payments...")
-            await asyncio.sleep(300)  # Проверяем каждые 5 минут
-
-        except Exception as e:
-            logger.error(f"Pending payments check failed: {e}")
-            await asyncio.sleep(60)  # Ждем минуту при ошибке
+    """Фоновая сверка pending платежей с ЮKassa (см. payment_reconciler.py)"""
+    await reconciler.run_forever()
 
 
 async def show_order_summary_from_message(callback: CallbackQuery, state: FSMContext, total: float):
@@ -2403,8 +2540,8 @@ async def confirm_order(callback: CallbackQuery, state: FSMContext):
     # Проверяем доступность бонусов
     bonus_used = data.get('bonus_used', 0)
     if bonus_used > 0:
-        cart_items = get_cart(user_id)
-        check = can_use_bonus(user_id, bonus_used, cart_items)
+        cart_items = await adb.get_cart(user_id)
+        check = await can_use_bonus(user_id, bonus_used, cart_items)
 
         if not check['can_use'] or check['actual_usable'] < bonus_used:
             await callback.message.answer(
@@ -2416,7 +2553,7 @@ async def confirm_order(callback: CallbackQuery, state: FSMContext):
             return
 
     # Создаем заказ
-    order_id = create_order(
+    order_id = await adb.create_order(
         user_id,
         data['name'],
         data['phone'],
@@ -2437,20 +2574,16 @@ async def confirm_order(callback: CallbackQuery, state: FSMContext):
         return
 
     # ДОПОЛНИТЕЛЬНАЯ ПРОВЕРКА - УБЕДИМСЯ ЧТО КОРЗИНА ОЧИЩЕНА
-    cart_after_order = get_cart(user_id)
+    cart_after_order = await adb.get_cart(user_id)
     if cart_after_order:
-        clear_cart(user_id)
+        await adb.clear_cart(user_id)
         print(f"⚠️ Корзина не очистилась автоматически для пользователя {user_id}, очищаем вручную")
 
     # 🔁 Получаем ИТОГОВУЮ СУММУ ИЗ ЗАКАЗА, А НЕ ИЗ STATE
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT total FROM orders WHERE id = ?", (order_id,))
-        row = cur.fetchone()
-        final_total = row[0] if row else 0
+    final_total = await adb.get_order_total(order_id)
 
     # Получаем информацию о бонусах
-    bonus_info = get_bonus_info(user_id)
+    bonus_info = await adb.get_bonus_info(user_id)
 
     # 🎉 Отправляем сообщение с правильной суммой
     await callback.message.answer(
@@ -2474,12 +2607,12 @@ async def create_yookassa_payment(callback: CallbackQuery, state: FSMContext):
 
     data = await state.get_data()
     user_id = callback.from_user.id
-    cart = get_cart(user_id)
+    cart = await adb.get_cart(user_id)
     total = sum(item['price'] * item['quantity'] for item in cart)
     payment_id = str(uuid.uuid4())
 
     try:
-        payment = Payment.create({
+        payment = await gateway.create_payment({
             "amount": {"value": str(total), "currency": "RUB"},
             "confirmation": {
                 "type": "redirect",
@@ -2503,7 +2636,7 @@ async def create_yookassa_payment(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@router.callback_query(F.data == "check_payment")
+@router.callback_query(F.data == "check_payment", flags={"send_priority": outbound.PAYMENT})
 async def check_payment(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     method = data.get("payment_system", "не указано")
@@ -2511,7 +2644,7 @@ async def check_payment(callback: CallbackQuery, state: FSMContext):
     user_data = data
 
     # Создаем заказ
-    order_id_db = create_order(
+    order_id_db = await adb.create_order(
         callback.from_user.id,
         user_data.get('name', ''),
         user_data.get('phone', ''),
@@ -2535,14 +2668,13 @@ async def check_payment(callback: CallbackQuery, state: FSMContext):
 # --- МОИ ЗАКАЗЫ ---
 @router.message(F.text == "🧾 Мои заказы")
 async def my_orders(message: Message):
-    orders = get_user_orders(message.from_user.id)
+    orders = await adb.get_user_orders(message.from_user.id)
     if not orders:
         await message.answer("У вас пока нет заказов.")
         return
 
     for o in orders:
-        items_data = json.loads(o['items'])
-        items = ", ".join([f"{item['name']} (×{item['quantity']})" for item in items_data])
+        items = ", ".join([f"{item['name']} (×{item['quantity']})" for item in o['items']])
         created_at = o['created_at'].split(".")[0].replace("T", " ")
 
         text = (
@@ -2563,22 +2695,17 @@ async def my_orders(message: Message):
 @router.callback_query(F.data.startswith("repeat_"))
 async def repeat_order(callback: CallbackQuery):
     order_id = int(callback.data.split("_")[1])
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("SELECT items FROM orders WHERE id=? AND user_id=?", (order_id, callback.from_user.id))
-        row = cur.fetchone()
+    order = await adb.get_user_order(order_id, callback.from_user.id)
 
-    if not row:
+    if not order:
         await callback.answer("❌ Заказ не найден")
         return
 
-    items = json.loads(row['items'])
-    clear_cart(callback.from_user.id)
+    await adb.clear_cart(callback.from_user.id)
 
-    for item in items:
+    for item in order['items']:
         for _ in range(item['quantity']):
-            add_to_cart(callback.from_user.id, item['id'])
+            await adb.add_to_cart(callback.from_user.id, item['id'])
 
     await callback.answer("✅ Товары добавлены в корзину!")
     await show_cart(callback.message)
@@ -2588,12 +2715,7 @@ async def repeat_order(callback: CallbackQuery):
 async def track_order(callback: CallbackQuery):
     order_id = callback.data.split("_")[1]
 
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("SELECT status, delivery_date, delivery_time FROM orders WHERE id=? AND user_id=?",
-                    (order_id, callback.from_user.id))
-        order = cur.fetchone()
+    order = await adb.get_user_order(order_id, callback.from_user.id)
 
     if not order:
         await callback.answer("Заказ не найден")
@@ -2629,7 +2751,7 @@ async def show_bonus_info(event: Union[CallbackQuery, Message]):
     message = event.message if is_callback else event
 
     """Показывает информацию о бонусах"""
-    bonus_info = get_bonus_info(user_id)
+    bonus_info = await adb.get_bonus_info(user_id)
 
     text = (
         f"💎 <b>Ваша бонусная программа</b>\n\n"
@@ -2681,7 +2803,7 @@ async def show_bonus_info(event: Union[CallbackQuery, Message]):
 @router.callback_query(F.data == "bonus_history")
 async def show_bonus_history(callback: CallbackQuery):
     """Показывает историю операций с бонусами"""
-    history = get_loyalty_history(callback.from_user.id, 10)
+    history = await adb.get_loyalty_history(callback.from_user.id, 10)
     if not history:
         await callback.message.answer("📊 История операций с бонусами пуста")
         await callback.answer()
@@ -2709,11 +2831,11 @@ async def show_bonus_history(callback: CallbackQuery):
 @router.callback_query(F.data.in_(["pay_online", "pay_sbp", "pay_cash"]))
 async def process_payment_with_bonus(callback: CallbackQuery, state: FSMContext):
     """Предлагаем использовать бонусы перед оплатой"""
-    bonus_info = get_bonus_info(callback.from_user.id)
+    bonus_info = await adb.get_bonus_info(callback.from_user.id)
 
     if bonus_info['current_bonus'] > 0:
         # Получаем данные корзины для расчета максимума
-        cart_items = get_cart(callback.from_user.id)
+        cart_items = await adb.get_cart(callback.from_user.id)
         products_total = sum(item['price'] * item['quantity'] for item in cart_items)
         max_bonus_allowed = int(products_total * 0.3)
         available_bonus = min(bonus_info['current_bonus'], max_bonus_allowed)
@@ -2757,8 +2879,8 @@ async def skip_bonus_usage(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "use_bonus_points", OrderState.use_bonus)
 async def ask_bonus_amount(callback: CallbackQuery, state: FSMContext):
     """Запрашиваем количество бонусов для использования"""
-    bonus_info = get_bonus_info(callback.from_user.id)
-    cart_items = get_cart(callback.from_user.id)
+    bonus_info = await adb.get_bonus_info(callback.from_user.id)
+    cart_items = await adb.get_cart(callback.from_user.id)
     products_total = sum(item['price'] * item['quantity'] for item in cart_items)
     max_bonus_allowed = int(products_total * 0.3)
 
@@ -2779,7 +2901,7 @@ async def ask_about_bonus_usage(callback: CallbackQuery, state: FSMContext):
     await state.update_data(payment_method=payment_method)
 
     # Получаем данные о бонусах пользователя
-    bonus_info = get_bonus_info(callback.from_user.id)
+    bonus_info = await adb.get_bonus_info(callback.from_user.id)
     data = await state.get_data()
     products_total = data.get('products_total', 0)
 
@@ -2808,7 +2930,7 @@ async def ask_about_bonus_usage(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "use_bonus_yes", OrderState.use_bonus)
 async def use_bonus_yes(callback: CallbackQuery, state: FSMContext):
     """Пользователь хочет использовать бонусы"""
-    bonus_info = get_bonus_info(callback.from_user.id)
+    bonus_info = await adb.get_bonus_info(callback.from_user.id)
     data = await state.get_data()
     products_total = data.get('products_total', 0)
     max_bonus_allowed = int(products_total * 0.3)
@@ -2848,7 +2970,7 @@ async def process_bonus_amount(message: Message, state: FSMContext):
     """Обрабатываем ввод количества бонусов"""
     try:
         bonus_to_use = int(message.text)
-        bonus_info = get_bonus_info(message.from_user.id)
+        bonus_info = await adb.get_bonus_info(message.from_user.id)
         data = await state.get_data()
         products_total = data.get('products_total', 0)
         max_bonus_allowed = int(products_total * 0.3)
@@ -2889,7 +3011,7 @@ async def use_actual_bonus(callback: CallbackQuery, state: FSMContext):
     await state.update_data(bonus_used=actual_bonus)
 
     data = await state.get_data()
-    cart_items = get_cart(callback.from_user.id)
+    cart_items = await adb.get_cart(callback.from_user.id)
     delivery_cost = data.get('delivery_cost', 0)
 
     order_calc = calculate_order_total(cart_items, delivery_cost, actual_bonus)
@@ -2916,8 +3038,8 @@ async def use_actual_bonus(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "reenter_bonus")
 async def reenter_bonus(callback: CallbackQuery, state: FSMContext):
     """Запросить повторный ввод количества бонусов"""
-    bonus_info = get_bonus_info(callback.from_user.id)
-    cart_items = get_cart(callback.from_user.id)
+    bonus_info = await adb.get_bonus_info(callback.from_user.id)
+    cart_items = await adb.get_cart(callback.from_user.id)
     products_total = sum(item['price'] * item['quantity'] for item in cart_items)
     max_bonus_allowed = int(products_total * 0.3)
 
@@ -2932,8 +3054,8 @@ async def reenter_bonus(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "reenter_bonus")
 async def reenter_bonus(callback: CallbackQuery, state: FSMContext):
     """Запросить повторный ввод количества бонусов"""
-    bonus_info = get_bonus_info(callback.from_user.id)
-    cart_items = get_cart(callback.from_user.id)
+    bonus_info = await adb.get_bonus_info(callback.from_user.id)
+    cart_items = await adb.get_cart(callback.from_user.id)
     products_total = sum(item['price'] * item['quantity'] for item in cart_items)
     max_bonus_allowed = int(products_total * 0.3)
 
@@ -2947,7 +3069,7 @@ async def reenter_bonus(callback: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == "loyalty_history")
 async def show_loyalty_history(callback: CallbackQuery):
-    history = get_loyalty_history(callback.from_user.id, 10)
+    history = await adb.get_loyalty_history(callback.from_user.id, 10)
     if not history:
         await callback.message.answer("📊 История операций пуста")
         return
@@ -2975,10 +3097,10 @@ async def show_loyalty_history(callback: CallbackQuery):
 async def use_bonus_handler(callback: CallbackQuery, state: FSMContext):
     """Обработка выбора использования бонусов"""
     user_id = callback.from_user.id
-    cart_items = get_cart(user_id)
+    cart_items = await adb.get_cart(user_id)
     products_total = sum(item['price'] * item['quantity'] for item in cart_items)
 
-    bonus_info = get_bonus_info(user_id)
+    bonus_info = await adb.get_bonus_info(user_id)
     max_bonus_allowed = int(products_total * 0.3)
     available_bonus = min(bonus_info['current_bonus'], max_bonus_allowed)
 
@@ -3008,13 +3130,13 @@ async def process_payment(callback: CallbackQuery, state: FSMContext):
 
     # Получаем данные
     data = await state.get_data()
-    cart_items = get_cart(callback.from_user.id)
+    cart_items = await adb.get_cart(callback.from_user.id)
     products_total = sum(item['price'] * item['quantity'] for item in cart_items)
     delivery_cost = data.get('delivery_cost', 0)
     total = products_total + delivery_cost
 
     # Проверяем бонусы
-    bonus_info = get_bonus_info(callback.from_user.id)
+    bonus_info = await adb.get_bonus_info(callback.from_user.id)
     available_bonus = bonus_info['current_bonus']
     max_bonus_allowed = int(products_total * 0.3)  # Максимум 30% от стоимости товаров
 
@@ -3039,7 +3161,7 @@ async def process_payment(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data.in_(["pay_online", "pay_sbp", "pay_cash"]))
 async def process_payment_with_points(callback: CallbackQuery, state: FSMContext):
     """Предлагаем использовать баллы перед оплатой"""
-    loyalty_info = get_loyalty_info(callback.from_user.id)
+    loyalty_info = await adb.get_loyalty_info(callback.from_user.id)
 
     if loyalty_info['current_points'] > 0:
         kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -3060,7 +3182,7 @@ async def process_payment_with_points(callback: CallbackQuery, state: FSMContext
 
 @router.callback_query(F.data == "use_loyalty_points", OrderState.use_bonus)
 async def ask_points_amount(callback: CallbackQuery, state: FSMContext):
-    loyalty_info = get_loyalty_info(callback.from_user.id)
+    loyalty_info = await adb.get_loyalty_info(callback.from_user.id)
     await callback.message.answer(
         f"💎 Введите количество баллов для использования\n"
         f"Доступно: {loyalty_info['current_points']} баллов"
@@ -3071,7 +3193,7 @@ async def ask_points_amount(callback: CallbackQuery, state: FSMContext):
 async def process_points_amount(message: Message, state: FSMContext):
     try:
         points_to_use = int(message.text)
-        loyalty_info = get_loyalty_info(message.from_user.id)
+        loyalty_info = await adb.get_loyalty_info(message.from_user.id)
 
         if points_to_use <= 0 or points_to_use > loyalty_info['current_points']:
             await message.answer("❌ Неверное количество баллов. Попробуйте снова:")
@@ -3107,6 +3229,8 @@ async def help_command(message: Message):
             "• /clear_my_cart - Очистить корзину\n"
             "• /reset_bonus - Сбросить бонусы\n"
             "• /pending_prices - Изменить цену, который по запросу\n"
+            "• /metrics - Технические метрики\n"
+            "• /rebuild_stats - Пересчитать статистику магазина\n"
 
             "📊 <b>Управление через кнопки:</b>\n"
             "• 📦 Управление заказами\n"
@@ -3122,6 +3246,7 @@ async def help_command(message: Message):
             "• /start - Главное меню\n"
             "• /myid - Показать мой ID\n"
             "• /clear_my_cart - Очистить корзину\n"
+            "• /search - Поиск букетов и растений\n"
             "• /help - Помощь по командам\n\n"
 
             "📱 <b>Основное меню:</b>\n"
@@ -3182,6 +3307,38 @@ async def manage_orders(callback: CallbackQuery):
     await callback.answer()
 
 
+async def show_orders_page(callback: CallbackQuery, status: str = "all", direction: str = "next",
+                           anchor_id: int = 0, page: int = 0):
+    """Показывает страницу списка заказов, редактируя текущее сообщение"""
+    page_data = await adb.get_orders_page(
+        status=None if status == "all" else status,
+        direction=direction,
+        anchor_id=anchor_id,
+    )
+    orders = page_data['orders']
+
+    stats = await adb.get_shop_stats()
+    if status == "all":
+        total = stats['total_orders']
+    else:
+        total = {"new": stats['new_orders'], "delivered": stats['delivered_orders']}.get(status)
+
+    text = "📋 <b>Список заказов</b>\n\n"
+    if total is not None:
+        text += f"Всего заказов: {total}\n"
+    text += f"Страница: {page + 1}" if orders else "📦 Заказов пока нет"
+
+    await callback.message.edit_text(
+        text,
+        reply_markup=orders_list_keyboard(
+            orders, page=page, status=status,
+            has_prev=page_data['has_prev'], has_next=page_data['has_next']
+        ),
+        parse_mode="HTML"
+    )
+    await callback.answer()
+
+
 @router.callback_query(F.data == "orders_list")
 async def show_orders_list(callback: CallbackQuery):
     """Показать список всех заказов"""
@@ -3189,29 +3346,28 @@ async def show_orders_list(callback: CallbackQuery):
         await callback.answer("❌ Доступ запрещен")
         return
 
-    # Получаем все заказы
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT o.*, u.first_name, u.last_name 
-            FROM orders o 
-            LEFT JOIN users u ON o.user_id = u.id 
-            ORDER BY o.created_at DESC
-        """)
-        orders = [dict(row) for row in cur.fetchall()]
+    await show_orders_page(callback)
 
-    if not orders:
-        await callback.message.answer("📦 Заказов пока нет")
+
+@router.callback_query(F.data.startswith("orders_page_"))
+async def orders_page(callback: CallbackQuery):
+    """Листание списка заказов: orders_page_{next|prev}_{id заказа-якоря}_{страница}_{статус}"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ запрещен")
         return
 
-    await callback.message.edit_text(
-        f"📋 <b>Список заказов</b>\n\n"
-        f"Всего заказов: {len(orders)}",
-        reply_markup=orders_list_keyboard(orders),
-        parse_mode="HTML"
-    )
-    await callback.answer()
+    try:
+        _, _, direction, anchor_id, page, status = callback.data.split("_", 5)
+        anchor_id, page = int(anchor_id), int(page)
+    except ValueError:
+        await callback.answer("❌ Неверная страница")
+        return
+
+    try:
+        await show_orders_page(callback, status, direction, anchor_id, page)
+    except TelegramBadRequest:
+        # Сообщение не изменилось (повторное нажатие того же фильтра)
+        await callback.answer()
 
 
 @router.callback_query(F.data.startswith("order_detail_"))
@@ -3223,48 +3379,38 @@ async def show_order_detail(callback: CallbackQuery):
 
     order_id = int(callback.data.split("_")[2])
 
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT o.*, u.first_name, u.last_name, u.username 
-            FROM orders o 
-            LEFT JOIN users u ON o.user_id = u.id 
-            WHERE o.id = ?
-        """, (order_id,))
-        order = cur.fetchone()
-
-        if not order:
-            await callback.answer("❌ Заказ не найден")
-            return
+    order = await adb.get_order_with_user(order_id)
 
-        order = dict(order)
-        items = json.loads(order['items'])
-
-        order_text = (
-            f"📦 <b>Заказ #{order['id']}</b>\n\n"
-            f"👤 <b>Клиент:</b> {order['first_name']} {order['last_name']}\n"
-            f"📞 <b>Телефон:</b> {order['phone']}\n"
-            f"📍 <b>Адрес:</b> {order['address'] or 'Самовывоз'}\n"
-            f"📅 <b>Дата доставки:</b> {order['delivery_date']}\n"
-            f"⏰ <b>Время:</b> {order['delivery_time']}\n"
-            f"💳 <b>Оплата:</b> {get_payment_method_name(order['payment_method'])}\n"
-            f"📊 <b>Статус:</b> {order['status']}\n"
-            f"💰 <b>Сумма:</b> {order['total']} ₽\n\n"
-            f"🛒 <b>Товары:</b>\n"
-        )
+    if not order:
+        await callback.answer("❌ Заказ не найден")
+        return
 
-        for item in items:
-            order_text += f"• {item['name']} × {item['quantity']} - {item['price'] * item['quantity']} ₽\n"
+    items = order['items']
+
+    order_text = (
+        f"📦 <b>Заказ #{order['id']}</b>\n\n"
+        f"👤 <b>Клиент:</b> {order['first_name']} {order['last_name']}\n"
+        f"📞 <b>Телефон:</b> {order['phone']}\n"
+        f"📍 <b>Адрес:</b> {order['address'] or 'Самовывоз'}\n"
+        f"📅 <b>Дата доставки:</b> {order['delivery_date']}\n"
+        f"⏰ <b>Время:</b> {order['delivery_time']}\n"
+        f"💳 <b>Оплата:</b> {get_payment_method_name(order['payment_method'])}\n"
+        f"📊 <b>Статус:</b> {order['status']}\n"
+        f"💰 <b>Сумма:</b> {order['total']} ₽\n\n"
+        f"🛒 <b>Товары:</b>\n"
+    )
 
-        if order['bonus_used'] > 0:
-            order_text += f"\n💎 <b>Использовано бонусов:</b> {order['bonus_used']} ₽"
+    for item in items:
+        order_text += f"• {item['name']} × {item['quantity']} - {item['price'] * item['quantity']} ₽\n"
 
-        await callback.message.edit_text(
-            order_text,
-            reply_markup=order_detail_keyboard(order['id']),
-            parse_mode="HTML"
-        )
+    if order['bonus_used'] > 0:
+        order_text += f"\n💎 <b>Использовано бонусов:</b> {order['bonus_used']} ₽"
+
+    await callback.message.edit_text(
+        order_text,
+        reply_markup=order_detail_keyboard(order['id']),
+        parse_mode="HTML"
+    )
 
     await callback.answer()
 
@@ -3278,34 +3424,13 @@ async def mark_order_delivered(callback: CallbackQuery):
 
     order_id = int(callback.data.split("_")[1])
 
-    # Обновляем статус заказа
-    update_order_status(order_id, 'delivered')
-
-    # Получаем информацию о заказе для уведомления пользователя
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("SELECT user_id FROM orders WHERE id = ?", (order_id,))
-        order = cur.fetchone()
-
-    if order:
-        user_id = order['user_id']
-        # Отправляем уведомление пользователю
-        try:
-            await bot.send_message(
-                user_id,
-                f"🎉 <b>Ваш заказ #{order_id} доставлен!</b>\n\n"
-                f"Спасибо за покупку! Надеемся, вам понравились наши цветы 💐\n\n"
-                f"Не забудьте оставить отзыв о заказе!",
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
+    # Обновляем статус заказа; уведомление покупателю ставится в outbox той же транзакцией
+    await adb.update_order_status(order_id, 'delivered')
 
     await callback.answer(f"✅ Заказ #{order_id} отмечен как доставленный")
     await callback.message.edit_text(
         f"✅ <b>Заказ #{order_id} отмечен как доставленный</b>\n\n"
-        f"Клиент получил уведомление о доставке.",
+        f"Клиенту отправлено уведомление о доставке.",
         parse_mode="HTML"
     )
 
@@ -3318,18 +3443,12 @@ async def manage_reviews(callback: CallbackQuery):
         return
 
     # Получаем статистику по отзывам
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM reviews")
-        total_reviews = cur.fetchone()[0]
-
-        cur.execute("SELECT AVG(rating) FROM reviews WHERE rating > 0")
-        avg_rating = cur.fetchone()[0] or 0
+    summary = await adb.get_reviews_summary()
 
     await callback.message.edit_text(
         f"⭐ <b>Управление отзывами</b>\n\n"
-        f"📊 Всего отзывов: {total_reviews}\n"
-        f"🌟 Средний рейтинг: {avg_rating:.1f}/5\n\n"
+        f"📊 Всего отзывов: {summary['total_reviews']}\n"
+        f"🌟 Средний рейтинг: {summary['avg_rating']:.1f}/5\n\n"
         f"Выберите действие:",
         reply_markup=reviews_management_keyboard(),
         parse_mode="HTML"
@@ -3344,7 +3463,7 @@ async def show_all_reviews(callback: CallbackQuery):
         await callback.answer("❌ Доступ запрещен")
         return
 
-    reviews = get_reviews(limit=50)  # Получаем больше отзывов
+    reviews = await adb.get_reviews(limit=50)  # Получаем больше отзывов
 
     if not reviews:
         await callback.message.answer("📝 Отзывов пока нет")
@@ -3375,79 +3494,85 @@ async def show_admin_stats(callback: CallbackQuery):
         await callback.answer("❌ Доступ запрещен")
         return
 
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-
-        # Статистика заказов
-        cur.execute("SELECT COUNT(*) FROM orders")
-        total_orders = cur.fetchone()[0]
-
-        cur.execute("SELECT COUNT(*) FROM orders WHERE status = 'delivered'")
-        delivered_orders = cur.fetchone()[0]
-
-        cur.execute("SELECT COUNT(*) FROM orders WHERE status = 'new'")
-        new_orders = cur.fetchone()[0]
-
-        cur.execute("SELECT SUM(total) FROM orders WHERE status = 'delivered'")
-        total_revenue = cur.fetchone()[0] or 0
-
-        # Статистика пользователей
-        cur.execute("SELECT COUNT(DISTINCT user_id) FROM orders")
-        active_clients = cur.fetchone()[0]
-
-        # Статистика отзывов
-        cur.execute("SELECT COUNT(*) FROM reviews")
-        total_reviews = cur.fetchone()[0]
-
-        cur.execute("SELECT AVG(rating) FROM reviews WHERE rating > 0")
-        avg_rating = cur.fetchone()[0] or 0
+    stats = await adb.get_shop_stats()
 
     stats_text = (
         "📊 <b>Статистика магазина</b>\n\n"
         f"📦 <b>Заказы:</b>\n"
-        f"• Всего заказов: {total_orders}\n"
-        f"• Новые заказы: {new_orders}\n"
-        f"• Доставлено: {delivered_orders}\n"
-        f"• Общая выручка: {total_revenue} ₽\n\n"
+        f"• Всего заказов: {stats['total_orders']}\n"
+        f"• Новые заказы: {stats['new_orders']}\n"
+        f"• Доставлено: {stats['delivered_orders']}\n"
+        f"• Общая выручка: {stats['total_revenue']} ₽\n\n"
 
         f"👥 <b>Клиенты:</b>\n"
-        f"• Активных клиентов: {active_clients}\n\n"
+        f"• Активных клиентов: {stats['active_clients']}\n\n"
 
         f"⭐ <b>Отзывы:</b>\n"
-        f"• Всего отзывов: {total_reviews}\n"
-        f"• Средний рейтинг: {avg_rating:.1f}/5\n\n"
+        f"• Всего отзывов: {stats['total_reviews']}\n"
+        f"• Средний рейтинг: {stats['avg_rating']:.1f}/5\n\n"
+    )
 
+    stats_text += (
         f"<i>Последнее обновление: {datetime.now().strftime('%d.%m.%Y %H:%M')}</i>"
     )
 
-    await callback.message.answer(stats_text, parse_mode="HTML")
+    # Отчёт по товарам проходит по всем заказам, поэтому строится только по отдельной кнопке
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🏆 Отчёт по товарам", callback_data="admin_product_report")]
+    ])
+    await callback.message.answer(stats_text, reply_markup=kb, parse_mode="HTML")
     await callback.answer()
 
 
-@router.callback_query(F.data == "manage_bonuses")
-async def manage_bonuses(callback: CallbackQuery):
-    """Управление бонусной системой"""
+@router.callback_query(F.data == "admin_product_report")
+async def show_product_report(callback: CallbackQuery):
+    """Хиты продаж и выручка по товарам"""
     if not is_admin(callback.from_user.id):
         await callback.answer("❌ Доступ запрещен")
         return
 
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
+    try:
+        best_sellers = await adb.get_best_sellers()
+        revenue_by_product = await adb.get_revenue_by_product()
+    except adb.AnalyticsTimeout:
+        await callback.message.answer("⏱ Отчёт не успел построиться. Попробуйте позже.")
+        await callback.answer()
+        return
+
+    report_text = "📊 <b>Отчёт по товарам</b>\n\n"
+    if best_sellers:
+        report_text += "🏆 <b>Хиты продаж:</b>\n"
+        for item in best_sellers:
+            report_text += f"• {item['name']} — {item['quantity']} шт.\n"
+        report_text += "\n"
 
-        cur.execute("SELECT COUNT(*) FROM loyalty_program WHERE current_bonus > 0")
-        users_with_bonuses = cur.fetchone()[0]
+    if revenue_by_product:
+        report_text += "💰 <b>Выручка по товарам:</b>\n"
+        for item in revenue_by_product:
+            report_text += f"• {item['name']} — {item['revenue']:.0f} ₽\n"
+        report_text += "\n"
 
-        cur.execute("SELECT SUM(current_bonus) FROM loyalty_program")
-        total_bonuses = cur.fetchone()[0] or 0
+    if not (best_sellers or revenue_by_product):
+        report_text += "Продаж пока нет.\n"
 
-        cur.execute("SELECT SUM(total_bonus_earned) FROM loyalty_program")
-        total_earned = cur.fetchone()[0] or 0
+    await callback.message.answer(report_text, parse_mode="HTML")
+    await callback.answer()
+
+
+@router.callback_query(F.data == "manage_bonuses")
+async def manage_bonuses(callback: CallbackQuery):
+    """Управление бонусной системой"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ запрещен")
+        return
+
+    summary = await adb.get_bonus_summary()
 
     bonus_text = (
         "💎 <b>Управление бонусной системой</b>\n\n"
-        f"👥 Пользователей с бонусами: {users_with_bonuses}\n"
-        f"💰 Всего бонусов на счетах: {total_bonuses} ₽\n"
-        f"🏆 Всего начислено бонусов: {total_earned} ₽\n\n"
+        f"👥 Пользователей с бонусами: {summary['users_with_bonuses']}\n"
+        f"💰 Всего бонусов на счетах: {summary['total_bonuses']} ₽\n"
+        f"🏆 Всего начислено бонусов: {summary['total_earned']} ₽\n\n"
 
         "<b>Доступные действия:</b>\n"
         "• /reset_bonus - Сбросить бонусы\n"
@@ -3464,44 +3589,126 @@ async def reviews_debug(message: Message):
         await message.answer("❌ Эта команда только для администратора")
         return
 
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
+    # Проверяем существует ли таблица отзывов
+    info = await adb.get_reviews_debug_info()
 
-        # Проверяем существует ли таблица отзывов
-        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='reviews'")
-        table_exists = cur.fetchone()
+    if info:
+        text = (
+            f"✅ Таблица отзывов существует\n"
+            f"📊 Всего отзывов: {info['count']}\n"
+            f"📦 Отзывов на заказы: {info['order_reviews']}\n"
+            f"🏪 Общих отзывов: {info['general_reviews']}"
+        )
 
-        if table_exists:
-            cur.execute("SELECT COUNT(*) FROM reviews")
-            count = cur.fetchone()[0]
+        await message.answer(text)
 
-            cur.execute("SELECT COUNT(*) FROM reviews WHERE order_id IS NOT NULL")
-            order_reviews = cur.fetchone()[0]
+        # Показываем последние отзывы
+        reviews = info['latest']
+        if reviews:
+            text = "📝 Последние 5 отзывов:\n\n"
+            for review in reviews:
+                order_info = f" (Заказ #{review['order_id']})" if review['order_id'] else " (Общий)"
+                text += f"ID: {review['id']}, User: {review['user_name']}, Rating: {review['rating']}{order_info}\n"
+                text += f"Text: {review['text'][:50]}...\n\n"
+            await message.answer(text)
+    else:
+        await message.answer("❌ Таблица отзывов не существует!")
 
-            cur.execute("SELECT COUNT(*) FROM reviews WHERE order_id IS NULL")
-            general_reviews = cur.fetchone()[0]
 
-            text = (
-                f"✅ Таблица отзывов существует\n"
-                f"📊 Всего отзывов: {count}\n"
-                f"📦 Отзывов на заказы: {order_reviews}\n"
-                f"🏪 Общих отзывов: {general_reviews}"
-            )
+@router.message(Command("metrics"))
+async def show_metrics(message: Message):
+    """Технические метрики бота"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ Эта команда только для администратора")
+        return
 
-            await message.answer(text)
+    db_stats = get_statement_cache_stats()
+    write_stats = adb.get_write_queue_stats()
+    catalog_stats = catalog_cache.get_stats()
+    card_stats = card_cache.get_stats()
+    send_stats = outbound.scheduler.get_stats()
+    notify_stats = notifications.get_stats()
+    outbox_stats = await adb.get_outbox_stats()
+    outbox_sent = outbox.dispatcher.get_stats()
+    gateway_stats = gateway.get_stats()
+    reconcile_stats = reconciler.get_stats()
+    status_stats = payment_manager.get_status_stats()
+    receipt_jobs = await adb.get_receipt_job_stats()
+    receipt_stats = receipts.worker.get_stats()
+    reconcile_backlog = await adb.get_reconcile_backlog()
+    depth = send_stats['depth']
+    breaker_names = {"closed": "работает", "open": "ЮKassa отключена", "half_open": "пробный запрос"}
+    text = (
+        "📈 <b>Метрики</b>\n\n"
+        "🗄 <b>База данных:</b>\n"
+        f"• Подключений: {db_stats['connections']}\n"
+        f"• Кэш выражений: {db_stats['hits']} попаданий / {db_stats['misses']} промахов "
+        f"({db_stats['hit_rate']:.0%})\n"
+        f"• Очередь записи: {write_stats['operations']} операций в {write_stats['batches']} пакетах "
+        f"(в среднем {write_stats['avg_batch']:.1f}, максимум {write_stats['max_batch']}), "
+        f"ошибок {write_stats['errors']}, ждут {write_stats['queued']}\n"
+        f"\n🌸 <b>Кэш каталога:</b>\n"
+        f"• {catalog_stats['hits']} попаданий / {catalog_stats['misses']} промахов, "
+        f"сбросов {catalog_stats['invalidations']}\n"
+        f"• Карточки: {card_stats['hits']} попаданий / {card_stats['misses']} промахов, "
+        f"в кэше {card_stats['size']}\n"
+        f"\n📤 <b>Исходящие сообщения:</b>\n"
+        f"• Отправлено {send_stats['sent']}, ответов 429: {send_stats['retry_after']}, "
+        f"не доставлено {send_stats['failed']}\n"
+        f"• В очереди {send_stats['queued']} (оплата {depth['payment']}, ответы {depth['default']}, "
+        f"админам {depth['notify']}, каталог {depth['catalog']}), максимум {send_stats['max_depth']}\n"
+        f"• Ожидание: в среднем {send_stats['avg_wait_ms']} мс, максимум {send_stats['max_wait_ms']} мс\n"
+        f"• Уведомления админам: доставлено {notify_stats['sent']}, повторов {notify_stats['retries']}, "
+        f"не доставлено {notify_stats['dead']}, в работе {notify_stats['pending']}\n"
+        f"• Outbox: ждут {outbox_stats['pending']} (старейшее {outbox_stats['oldest_pending_sec']} с), "
+        f"отправлено {outbox_stats['sent']}, не доставлено {outbox_stats['dead']}; "
+        f"с запуска {outbox_sent['sent']} в {outbox_sent['batches']} пакетах, повторов {outbox_sent['retried']}\n"
+    )
 
-            # Показываем последние отзывы
-            cur.execute("SELECT * FROM reviews ORDER BY created_at DESC LIMIT 5")
-            reviews = cur.fetchall()
-            if reviews:
-                text = "📝 Последние 5 отзывов:\n\n"
-                for review in reviews:
-                    order_info = f" (Заказ #{review[5]})" if review[5] else " (Общий)"
-                    text += f"ID: {review[0]}, User: {review[2]}, Rating: {review[4]}{order_info}\n"
-                    text += f"Text: {review[3][:50]}...\n\n"
-                await message.answer(text)
-        else:
-            await message.answer("❌ Таблица отзывов не существует!")
+    text += (
+        f"\n💳 <b>ЮKassa:</b>\n"
+        f"• Запросов {gateway_stats['calls']} (в среднем {gateway_stats['avg_ms']} мс), "
+        f"ошибок {gateway_stats['errors']}, таймаутов {gateway_stats['timeouts']}, "
+        f"отказов из-за занятости {gateway_stats['busy']}, выполняется {gateway_stats['in_flight']}\n"
+        f"• Автомат: {breaker_names.get(gateway_stats['breaker'], gateway_stats['breaker'])}, "
+        f"ошибок подряд {gateway_stats['breaker_failures']}, отключений {gateway_stats['breaker_opened']}, "
+        f"отклонено запросов {gateway_stats['rejected']}\n"
+        f"• Проверки статуса: {status_stats['checks']}, из базы {status_stats['local']}, "
+        f"из кэша {status_stats['cached']}, объединено {status_stats['coalesced']}, "
+        f"запросов в ЮKassa {status_stats['upstream']} (ошибок {status_stats['errors']})\n"
+        f"• Чеки ({YOOKASSA_RECEIPT_MODE}): ждут {receipt_jobs['pending']} "
+        f"(старейший {receipt_jobs['oldest_pending_sec']} с), создано {receipt_jobs['done']}, "
+        f"не создано {receipt_jobs['dead']}; с запуска {receipt_stats['created']}, повторов {receipt_stats['retried']}\n"
+        f"• Сверка: ждут {reconcile_backlog['pending']} (пора проверить {reconcile_backlog['due']}, "
+        f"отставание {reconcile_backlog['lag_sec']} с); проверено {reconcile_stats['checked']}, "
+        f"выполнено {reconcile_stats['fulfilled']}, отменено {reconcile_stats['canceled']}, "
+        f"не выполнено {reconcile_stats['failed']}, просрочено {reconcile_stats['expired']}, "
+        f"ошибок {reconcile_stats['errors']}; последняя пачка {reconcile_stats['last_batch']} "
+        f"({reconcile_stats['per_second']}/с)\n"
+    )
+    for name, latency in gateway_stats['latency'].items():
+        histogram = " · ".join(f"{bucket}: {count}" for bucket, count in latency['histogram'].items())
+        text += (f"• {name}: p50 {latency['p50_ms']} мс, p99 {latency['p99_ms']} мс, "
+                 f"таймаут {latency['timeout_s']} с\n  {histogram} (мс)\n")
+
+    await message.answer(text, parse_mode="HTML")
+
+
+@router.message(Command("rebuild_stats"))
+async def rebuild_stats_cmd(message: Message):
+    """Пересчёт сводной статистики магазина"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ Эта команда только для администратора")
+        return
+
+    try:
+        await adb.rebuild_shop_stats()
+    except Exception as e:
+        logger.error(f"Ошибка пересчёта статистики: {e}")
+        await message.answer("❌ Не удалось пересчитать статистику")
+        return
+
+    await message.answer("✅ Статистика магазина пересчитана")
 
 
 @router.message(Command("mark_delivered"))
@@ -3512,17 +3719,15 @@ async def mark_delivered(message: Message):
         return
 
     user_id = message.from_user.id
-    orders = get_user_orders(user_id)
+    orders = await adb.get_user_orders(user_id)
 
     if not orders:
         await message.answer("❌ Нет заказов")
         return
 
     last_order = orders[0]
-    update_order_status(last_order['id'], 'delivered')
-
-    # Имитируем запрос отзыва
-    await ask_for_review_after_delivery(user_id, last_order['id'])
+    # Запрос отзыва уйдёт через outbox вместе со сменой статуса
+    await adb.update_order_status(last_order['id'], 'delivered')
 
     await message.answer(f"✅ Заказ #{last_order['id']} помечен как доставленный")
 
@@ -3541,17 +3746,18 @@ async def add_bouquet_cmd(message: Message, state: FSMContext):
 async def get_bouquet_photo(message: Message, state: FSMContext):
     if message.photo:
         photo = message.photo[-1]
-        file = await bot.get_file(photo.file_id)
+        # Отправляем по file_id, а локальная копия нужна, если Telegram его отзовёт
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         photo_path = f"images/bouquet_{timestamp}.jpg"
         try:
+            file = await bot.get_file(photo.file_id)
             await bot.download_file(file.file_path, photo_path)
-            await state.update_data(photo=photo_path)
         except Exception as e:
-            await message.answer(f"❌ Ошибка сохранения фото: {e}")
-            return
+            logger.warning(f"Не удалось сохранить копию фото букета: {e}")
+            photo_path = None
+        await state.update_data(photo=photo_path, photo_file_id=photo.file_id)
     else:
-        await state.update_data(photo=None)
+        await state.update_data(photo=None, photo_file_id=None)
 
     await message.answer("📝 Введите название букета:")
     await state.set_state(AdminState.name)
@@ -3606,14 +3812,15 @@ async def get_bouquet_price(message: Message, state: FSMContext):
         # Если это число - сохраняем как обычно
         data = await state.get_data()
 
-        product_id = add_product(
+        product_id = await adb.add_product(
             name=data['name'],
             description=data['description'],
             full_description=data['full_description'],
             price=price,
             photo=data.get('photo'),
             category=data['category'],
-            is_daily=True
+            is_daily=True,
+            photo_file_id=data.get('photo_file_id')
         )
 
         await message.answer(f"✅ Букет «{data['name']}» добавлен как букет дня! Цена: {price} ₽")
@@ -3630,7 +3837,7 @@ async def get_bouquet_price(message: Message, state: FSMContext):
         photo_path = data.get('photo')
 
         # Сохраняем товар с меткой "по запросу"
-        product_id = add_product(
+        product_id = await adb.add_product(
             name=name,
             description=description,
             full_description=full_description,
@@ -3638,7 +3845,8 @@ async def get_bouquet_price(message: Message, state: FSMContext):
             photo=photo_path,
             category=category,
             is_daily=True,
-            on_request=True  # или добавь в запрос: DEFAULT FALSE
+            on_request=True,  # или добавь в запрос: DEFAULT FALSE
+            photo_file_id=data.get('photo_file_id')
         )
 
         # Уведомляем, что товар добавлен, но цена по запросу
@@ -3725,14 +3933,15 @@ async def process_admin_budget(message: Message, state: FSMContext):
         product_data = data['admin_product_data']
 
         # Используем бюджет как примерную цену
-        product_id = add_product(
+        product_id = await adb.add_product(
             name=product_data['name'],
             description=product_data['description'],
             full_description=product_data['full_description'],
             price=budget,
             photo=product_data.get('photo'),
             category=product_data['category'],
-            is_daily=True
+            is_daily=True,
+            photo_file_id=product_data.get('photo_file_id')
         )
 
         await message.answer(
@@ -3771,21 +3980,10 @@ async def process_new_price(message: Message, state: FSMContext):
         product_id = data['product_id']
 
         # Обновляем цену и снимаем флаг on_request
-        with sqlite3.connect(DB_PATH) as conn:
-            cur = conn.cursor()
-            cur.execute("""
-                UPDATE products 
-                SET price = ?, on_request = FALSE 
-                WHERE id = ?
-            """, (new_price, product_id))
-            conn.commit()
+        await adb.set_product_price(product_id, new_price)
 
         # Получаем обновлённый товар
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute("SELECT name FROM products WHERE id = ?", (product_id,))
-            product = cur.fetchone()
+        product = await adb.get_product(product_id)
 
         await message.answer(
             f"✅ Цена установлена!\n"
@@ -3834,7 +4032,7 @@ async def auto_cleanup_daily_products():
             wait_seconds = (next_run - now).total_seconds()
             await asyncio.sleep(wait_seconds)
 
-            cleaned = cleanup_old_daily_products()
+            cleaned = await adb.cleanup_old_daily_products()
             logger.info(f"Автоматически очищено {cleaned} старых букетов дня")
 
         except Exception as e:
@@ -3849,12 +4047,12 @@ async def test_create_order(callback: CallbackQuery):
         user_id = callback.from_user.id
 
         # Создаем тестовые товары в корзине
-        clear_cart(user_id)
-        add_to_cart(user_id, 1)  # добавляем тестовый товар
-        add_to_cart(user_id, 1)  # добавляем еще один
+        await adb.clear_cart(user_id)
+        await adb.add_to_cart(user_id, 1)  # добавляем тестовый товар
+        await adb.add_to_cart(user_id, 1)  # добавляем еще один
 
         # Создаем тестовый заказ
-        order_id = create_order(
+        order_id = await adb.create_order(
             user_id=user_id,
             name="Тестовый Пользователь",
             phone="+79999999999",
@@ -3867,7 +4065,7 @@ async def test_create_order(callback: CallbackQuery):
             bonus_used=0
         )
 
-        bonus_info = get_bonus_info(user_id)
+        bonus_info = await adb.get_bonus_info(user_id)
 
         await callback.message.answer(
             f"✅ <b>Тестовый заказ создан!</b>\n\n"
@@ -3886,7 +4084,7 @@ async def test_create_order(callback: CallbackQuery):
 @router.callback_query(F.data == "test_check_balance")
 async def test_check_balance(callback: CallbackQuery):
     """Проверка текущего баланса бонусов"""
-    bonus_info = get_bonus_info(callback.from_user.id)
+    bonus_info = await adb.get_bonus_info(callback.from_user.id)
 
     text = (
         f"💎 <b>Ваш баланс бонусов:</b>\n\n"
@@ -3918,7 +4116,7 @@ async def test_bonus_history(callback: CallbackQuery):
 @router.callback_query(F.data == "test_use_bonus")
 async def test_use_bonus(callback: CallbackQuery, state: FSMContext):
     """Тестирование использования бонусов"""
-    bonus_info = get_bonus_info(callback.from_user.id)
+    bonus_info = await adb.get_bonus_info(callback.from_user.id)
 
     if bonus_info['current_bonus'] == 0:
         await callback.message.answer(
@@ -3929,11 +4127,11 @@ async def test_use_bonus(callback: CallbackQuery, state: FSMContext):
         return
 
     # Добавляем тестовые товары в корзину
-    clear_cart(callback.from_user.id)
-    add_to_cart(callback.from_user.id, 1)
-    add_to_cart(callback.from_user.id, 1)
+    await adb.clear_cart(callback.from_user.id)
+    await adb.add_to_cart(callback.from_user.id, 1)
+    await adb.add_to_cart(callback.from_user.id, 1)
 
-    cart_items = get_cart(callback.from_user.id)
+    cart_items = await adb.get_cart(callback.from_user.id)
     products_total = sum(item['price'] * item['quantity'] for item in cart_items)
     max_bonus_allowed = int(products_total * 0.3)
     available_bonus = min(bonus_info['current_bonus'], max_bonus_allowed)
@@ -3962,27 +4160,9 @@ async def add_test_bonus(message: Message):
     try:
         # Добавляем 1000 бонусов для тестирования
         user_id = message.from_user.id
-        with sqlite3.connect(DB_PATH) as conn:
-            cur = conn.cursor()
-            cur.execute("""
-                UPDATE loyalty_program 
-                SET current_bonus = current_bonus + ?,
-                    total_bonus_earned = total_bonus_earned + ?,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE user_id = ?
-            """, (1000, 1000, user_id))
-
-            cur.execute("""
-                INSERT INTO loyalty_history 
-                (user_id, points_change, reason, remaining_points)
-                SELECT ?, ?, ?, current_bonus 
-                FROM loyalty_program 
-                WHERE user_id = ?
-            """, (user_id, 1000, "Тестовое начисление бонусов", user_id))
-
-            conn.commit()
-
-        bonus_info = get_bonus_info(user_id)
+        await adb.add_test_bonus_points(user_id, 1000)
+
+        bonus_info = await adb.get_bonus_info(user_id)
         await message.answer(
             f"✅ Добавлено 1000 тестовых бонусов!\n"
             f"💎 Текущий баланс: {bonus_info['current_bonus']} ₽"
@@ -4001,19 +4181,7 @@ async def reset_bonus(message: Message):
 
     try:
         user_id = message.from_user.id
-        with sqlite3.connect(DB_PATH) as conn:
-            cur = conn.cursor()
-            cur.execute("""
-                UPDATE loyalty_program 
-                SET current_bonus = 0,
-                    total_bonus_earned = 0,
-                    total_spent = 0,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE user_id = ?
-            """, (user_id,))
-
-            cur.execute("DELETE FROM loyalty_history WHERE user_id = ?", (user_id,))
-            conn.commit()
+        await adb.reset_user_bonus(user_id)
 
         await message.answer("✅ Бонусы сброшены к начальному состоянию!")
 
@@ -4037,11 +4205,7 @@ async def edit_price_cmd(message: Message, state: FSMContext):
         product_id = int(args[1])
 
         # Проверяем, существует ли товар и цена либо 0, либо on_request=True
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-            product = cur.fetchone()
+        product = await adb.get_product(product_id)
 
         if not product:
             await message.answer("❌ Товар не найден.")
@@ -4075,36 +4239,35 @@ async def show_pending_products(message: Message):
         await message.answer("❌ Доступ запрещён.")
         return
 
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT id, name, description, photo, created_date
-            FROM products
-            WHERE (price = 0 OR on_request = TRUE)
-            AND is_daily = TRUE
-            ORDER BY created_date DESC
-        """)
-        products = [dict(row) for row in cur.fetchall()]
+    products = await adb.get_pending_price_products()
 
     if not products:
         await message.answer("🟢 Нет товаров с ценой 'по запросу'.")
         return
 
     for product in products:
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✏️ Установить цену", callback_data=f"set_price_{product['id']}")],
-            [InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_product_{product['id']}")]
-        ])
-        await message.answer_photo(
-            photo=FSInputFile(product['photo']),
-            caption=f"🟡 <b>Товар без цены:</b>\n"
-                    f"📦 <b>{product['name']}</b>\n"
-                    f"📝 {product['description']}\n"
-                    f"🆔 <code>{product['id']}</code>",
-            reply_markup=kb,
-            parse_mode="HTML"
-        )
+        text, kb = card_cache.get_card(product, "pending")
+        if not await answer_product_photo(message, product, text, kb):
+            await message.answer(text, reply_markup=kb, parse_mode="HTML")
+
+
+@router.callback_query(F.data.startswith("delete_product_"))
+async def delete_product_cb(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ запрещён.")
+        return
+
+    product_id = int(callback.data.split("_")[2])
+    if not await adb.delete_product(product_id):
+        await callback.answer("❌ Товар не найден")
+        return
+
+    text = f"🗑 Товар <code>{product_id}</code> удалён"
+    if callback.message.photo:
+        await callback.message.edit_caption(caption=text, parse_mode="HTML")
+    else:
+        await callback.message.edit_text(text, parse_mode="HTML")
+    await callback.answer("✅ Товар удалён")
 
 
 @router.callback_query(F.data.startswith("set_price_"))
@@ -4116,11 +4279,7 @@ async def start_set_price(callback: CallbackQuery, state: FSMContext):
     product_id = int(callback.data.split("_")[2])
 
     # Проверяем, существует ли товар
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("SELECT name FROM products WHERE id = ?", (product_id,))
-        product = cur.fetchone()
+    product = await adb.get_product(product_id)
 
     if not product:
         await callback.answer("❌ Товар не найден.")
@@ -4134,9 +4293,9 @@ async def start_set_price(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-def calculate_order_with_bonus(user_id: int, delivery_cost: int, bonus_to_use: int = 0) -> dict:
+async def calculate_order_with_bonus(user_id: int, delivery_cost: int, bonus_to_use: int = 0) -> dict:
     """Рассчитывает заказ с учетом бонусов"""
-    cart_items = get_cart(user_id)
+    cart_items = await adb.get_cart(user_id)
     products_total = sum(item['price'] * item['quantity'] for item in cart_items)
 
     # Максимально можно использовать бонусов - 30% от суммы товаров
@@ -4155,14 +4314,14 @@ def calculate_order_with_bonus(user_id: int, delivery_cost: int, bonus_to_use: i
     }
 
 
-def can_use_bonus(user_id: int, bonus_amount: int, cart_items: List[Dict] = None) -> Dict:
+async def can_use_bonus(user_id: int, bonus_amount: int, cart_items: List[Dict] = None) -> Dict:
     """Проверяет, можно ли использовать указанное количество бонусов"""
     if cart_items is None:
-        cart_items = get_cart(user_id)
+        cart_items = await adb.get_cart(user_id)
 
     products_total = sum(item['price'] * item['quantity'] for item in cart_items)
     max_bonus_allowed = int(products_total * 0.3)  # 30% от суммы товаров
-    bonus_info = get_bonus_info(user_id)
+    bonus_info = await adb.get_bonus_info(user_id)
     available_bonus = bonus_info['current_bonus']
 
     actual_usable = min(bonus_amount, available_bonus, max_bonus_allowed)
@@ -1,15 +1,103 @@
 import asyncio
+import ipaddress
 import logging
+from decimal import Decimal
 from aiogram import Bot, Dispatcher
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiohttp import web
+from yookassa.domain.notification import WebhookNotificationFactory
 from user_handlers import router as user_router
 from database import init_db
+import async_db
+import outbound
+import notifications
+import outbox
+import receipts
+from payment_gateway import gateway
 from config import *
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Адреса, с которых ЮKassa отправляет HTTP-уведомления
+YOOKASSA_NETWORKS = [ipaddress.ip_network(net) for net in (
+    "185.71.76.0/27",
+    "185.71.77.0/27",
+    "77.75.153.0/25",
+    "77.75.156.11/32",
+    "77.75.156.35/32",
+    "77.75.154.128/25",
+    "2a02:5180::/32",
+)]
+
+
+def is_yookassa_ip(request: web.Request) -> bool:
+    """Пришёл ли запрос с адреса ЮKassa"""
+    address = request.remote
+    if YOOKASSA_TRUST_FORWARDED and request.headers.get("X-Forwarded-For"):
+        address = request.headers["X-Forwarded-For"].split(",")[0].strip()
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in YOOKASSA_NETWORKS)
+
+
+async def yookassa_notification(request: web.Request) -> web.Response:
+    """HTTP-уведомление ЮKassa о платеже (payment.succeeded / payment.canceled).
+
+    Уведомления не подписаны, поэтому кроме проверки IP статус и сумма
+    сверяются с платежом, полученным из API ЮKassa. Заказ или сертификат
+    выполняются через fulfill_payment - тем же путём, что и кнопка
+    «Проверить оплату» и фоновая сверка, поэтому повтор уведомления ничего
+    не задвоит. 500 в ответ заставит ЮKassa повторить уведомление позже.
+    """
+    if not is_yookassa_ip(request):
+        logger.warning(f"Уведомление ЮKassa с недоверенного адреса {request.remote}")
+        return web.Response(status=403)
+
+    try:
+        notification = WebhookNotificationFactory().create(await request.json())
+        event, payment_id = notification.event, notification.object.id
+    except Exception as e:
+        logger.warning(f"Неверное уведомление ЮKassa: {e}")
+        return web.Response(status=400)
+
+    if event not in ("payment.succeeded", "payment.canceled"):
+        return web.Response(status=200)
+
+    local = await async_db.get_payment(payment_id)
+    if local is None:
+        logger.warning(f"Уведомление ЮKassa о неизвестном платеже {payment_id}")
+        return web.Response(status=200)
+
+    try:
+        payment = await gateway.find_payment(payment_id)
+    except Exception as e:
+        logger.error(f"Не удалось проверить платёж {payment_id} из уведомления: {e}")
+        return web.Response(status=500)
+
+    expected_status = event.split(".")[1]
+    if payment.status != expected_status or Decimal(str(payment.amount.value)) != Decimal(str(local['amount'])):
+        logger.warning(f"Уведомление ЮKassa не совпадает с платежом {payment_id}: "
+                       f"{event}, в API {payment.status} на {payment.amount.value}")
+        return web.Response(status=200)
+
+    if payment.status == "succeeded":
+        result = await async_db.fulfill_payment(payment_id)
+        if result is None:
+            # Ошибка базы - пусть ЮKassa повторит уведомление
+            return web.Response(status=500)
+        if result['failed']:
+            # Повтор не поможет: платёж уже в fulfill_failed, админы уведомлены
+            logger.error(f"Платёж {payment_id} оплачен, но не выполнен: {result['error']}")
+        elif result['created']:
+            logger.info(f"Платёж {payment_id} выполнен по уведомлению ЮKassa")
+    elif local['status'] == 'pending':
+        await async_db.update_payment_status(payment_id, 'canceled')
+
+    return web.Response(status=200)
+
 
 async def on_startup(bot: Bot, base_url: str):
     """Действия при запуске бота"""
@@ -22,12 +110,22 @@ async def on_startup(bot: Bot, base_url: str):
     )
     logger.info(f"Вебхук установлен: {base_url}{WEBHOOK_PATH}")
 
+    # Рассылка уведомлений из outbox и очередь фискальных чеков
+    outbox.dispatcher.start(bot)
+    receipts.worker.start()
+
 
 async def on_shutdown(bot: Bot):
     """Действия при остановке бота"""
     logger.info("Бот останавливается...")
     await bot.delete_webhook()
     logger.info("Вебхук удален")
+    await outbox.dispatcher.stop()
+    await receipts.worker.stop()
+    await notifications.drain()
+    await outbound.scheduler.close()
+    gateway.shutdown()
+    await async_db.shutdown()
 
 
 def main():
@@ -35,7 +133,7 @@ def main():
     init_db()
 
     # Создаем экземпляры бота и диспетчера
-    bot = Bot(token=BOT_TOKEN)
+    bot = outbound.install(Bot(token=BOT_TOKEN))
     dp = Dispatcher()
 
     # Регистрируем роутеры
@@ -58,6 +156,9 @@ def main():
     # Регистрируем обработчик
     webhook_requests_handler.register(app, path=WEBHOOK_PATH)
 
+    # Уведомления ЮKassa об оплате
+    app.router.add_post(YOOKASSA_NOTIFY_PATH, yookassa_notification)
+
     # Запускаем приложение
     logger.info(f"Запуск сервера на порту {WEBHOOK_PORT}")
     web.run_app(app, host='0.0.0.0', port=WEBHOOK_PORT)